@@ -0,0 +1,330 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+completion_bench - measure tab completion latency over synthetic reviews.
+
+Each case completes a partial command line through CLI.getCompletions(),
+with readline's line buffer replaced by the case's text, so the whole
+completion path is timed: line parsing, the command's argument completer
+(FileIndexArgument, CommitFileArgument, or completeCommit), and the
+conversion of matches for readline.
+
+Reviews with different numbers of files, and repositories with different
+numbers of refs, are generated in memory.  No git commands are run: the
+repository is a stand-in that returns the generated refs and tree listings,
+so the results measure git-review's own overhead.  The completion caches
+are cleared before every iteration, to time the first Tab press.
+
+The results can be written as JSON, and compared against a previous run.
+The exit status is 1 if any case's p50 latency regressed by more than the
+threshold.  With a few dozen iterations the p99 latency is just the
+slowest run or two, so changes in it are only reported, unless --gate-p99
+is given.
+"""
+
+import json
+import optparse
+import os
+import StringIO
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import gitreview.cli as cli
+import gitreview.git as git
+import gitreview.git.attributes as attributes
+import gitreview.git.textconv as textconv
+import gitreview.review as review
+
+_PARENT_SHA1 = '1' * 40
+_CHILD_SHA1 = '2' * 40
+_FILES_PER_DIR = 100
+
+# (case name, command line to complete, the size that is varied)
+CASES = [
+    ('goto basename', 'goto file1', 'entries'),
+    ('goto path', 'goto dir1/', 'entries'),
+    ('diff path', 'diff child:dir1/file1', 'entries'),
+    ('diff commit or path', 'diff branch1', 'refs'),
+    ('alias commit', 'alias base refs/heads/branch1', 'refs'),
+]
+
+
+class _Config(object):
+    def get(self, name, default=None):
+        return default
+
+
+class SyntheticRepo(object):
+    """
+    A stand-in for git.repo.Repository, with a generated set of refs and
+    files.
+    """
+    def __init__(self, paths, num_refs):
+        self.config = _Config()
+        self.workingDir = None
+        self.textconvCache = textconv.TextconvCache(self)
+        self.refNames = ['refs/heads/branch%d' % (n,)
+                         for n in range(num_refs)]
+
+        # dirname (with trailing slash) --> list of TreeEntry
+        self.trees = {}
+        dirs = set()
+        for path in paths:
+            (dirname, basename) = path.rsplit('/', 1)
+            self.trees.setdefault(dirname + '/', []).append(
+                    git.obj.TreeEntry(basename, 0100644, git.OBJ_BLOB,
+                                      _CHILD_SHA1))
+            dirs.add(dirname)
+        self.trees[None] = [git.obj.TreeEntry(dirname, 040000, git.OBJ_TREE,
+                                              _CHILD_SHA1)
+                            for dirname in sorted(dirs)]
+
+    def getGitDir(self):
+        return '/nonexistent/.git'
+
+    def hasWorkingDirectory(self):
+        return False
+
+    def getCommitSha1(self, name):
+        if name == 'HEAD^':
+            return _PARENT_SHA1
+        return _CHILD_SHA1
+
+    def checkObjects(self, names):
+        # Blob sizes are unknown, so no file is treated as large
+        return dict([(name, None) for name in names])
+
+    def getAttributes(self, paths):
+        default = attributes.PathAttributes()
+        return dict([(path, default) for path in paths])
+
+    def getTextconvCache(self):
+        return self.textconvCache
+
+    def isRevision(self, name):
+        return name.startswith('refs/') or name in ('parent', 'child')
+
+    def getRefNames(self):
+        return self.refNames[:]
+
+    def listTree(self, commit, dirname=None, on_entries=None):
+        entries = self.trees.get(dirname or None, [])
+        if on_entries is not None:
+            on_entries(entries)
+        return entries
+
+
+def make_review(num_entries, num_refs):
+    paths = ['dir%d/file%d.c' % (n // _FILES_PER_DIR, n)
+             for n in range(num_entries)]
+    repo = SyntheticRepo(paths, num_refs)
+    diff = git.diff.DiffFileList('HEAD^', 'HEAD')
+    modified = git.diff.Status(git.diff.Status.MODIFIED)
+    for path in paths:
+        diff.add(git.diff.DiffEntry('100644', '100644', _PARENT_SHA1,
+                                    _CHILD_SHA1, modified, path, path))
+    rev = review.Review(repo, diff)
+    # Hide the "Now processing" message printed by CliReviewer
+    old_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        cli_obj = review.CliReviewer(rev)
+    finally:
+        sys.stdout = old_stdout
+    # Time the complete computation, rather than returning partial results
+    # after a deadline
+    cli_obj.completionDeadline = None
+    return cli_obj
+
+
+class _FakeReadline(object):
+    """
+    Replaces the readline functions used by CLI.getCompletions().
+    """
+    def __init__(self):
+        self.line = ''
+
+    def install(self):
+        cli.readline.get_line_buffer = lambda: self.line
+        cli.readline.get_begidx = lambda: self.line.rfind(' ') + 1
+        cli.readline.get_endidx = lambda: len(self.line)
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def time_case(cli_obj, fake_readline, line, iterations, max_time):
+    fake_readline.line = line
+    text = line[line.rfind(' ') + 1:]
+    times = []
+    deadline = time.time() + max_time
+    num_matches = 0
+    for n in range(iterations):
+        cli_obj.clearCompletionCache(wait=True)
+        cli_obj.repoCache.clearCaches()
+        start = time.time()
+        matches = cli_obj.getCompletions(text)
+        times.append(time.time() - start)
+        num_matches = len(matches or [])
+        if time.time() > deadline:
+            break
+    times.sort()
+    return {
+        'p50_ms': percentile(times, 0.5) * 1000,
+        'p99_ms': percentile(times, 0.99) * 1000,
+        'iterations': len(times),
+        'matches': num_matches,
+    }
+
+
+def compare(results, baseline, threshold, min_delta, keys):
+    """
+    Return a list of messages describing the cases whose latencies for the
+    specified keys regressed.
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        try:
+            old = baseline[name]
+        except KeyError:
+            continue
+        for key in keys:
+            delta = result[key] - old[key]
+            if delta > min_delta and delta > old[key] * threshold:
+                regressions.append('%s: %s went from %.3f to %.3f' %
+                                   (name, key, old[key], result[key]))
+    return regressions
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-e', '--entries',
+                      action='store', dest='entries',
+                      default='10,1000,100000',
+                      help='Comma-separated numbers of files in the review '
+                           '(up to 1000000 works, but needs several GB of '
+                           'memory)')
+    parser.add_option('-r', '--refs',
+                      action='store', dest='refs',
+                      default='10,1000,100000,1000000',
+                      help='Comma-separated numbers of refs in the '
+                           'repository')
+    parser.add_option('-n', '--iterations',
+                      action='store', type='int', dest='iterations',
+                      default=50,
+                      help='Maximum number of times to time each case')
+    parser.add_option('-t', '--max-time',
+                      action='store', type='float', dest='maxTime',
+                      default=5.0,
+                      help='Stop timing a case after this many seconds')
+    parser.add_option('-o', '--output',
+                      action='store', dest='output', default=None,
+                      help='Write the results to this file as JSON')
+    parser.add_option('-b', '--baseline',
+                      action='store', dest='baseline', default=None,
+                      help='Compare against results previously written '
+                           'with --output')
+    parser.add_option('--threshold',
+                      action='store', type='float', dest='threshold',
+                      default=0.2,
+                      help='Fractional increase in latency that counts as '
+                           'a regression (default 0.2)')
+    parser.add_option('--min-delta',
+                      action='store', type='float', dest='minDelta',
+                      default=0.5,
+                      help='Ignore increases smaller than this many '
+                           'milliseconds (default 0.5)')
+    parser.add_option('--gate-p99',
+                      action='store_true', dest='gateP99', default=False,
+                      help='Also fail if the p99 latency regressed.  This '
+                           'is only reliable with several hundred '
+                           'iterations.')
+    (options, args) = parser.parse_args(argv[1:])
+
+    baseline = None
+    if options.baseline is not None:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)['results']
+        finally:
+            f.close()
+
+    fake_readline = _FakeReadline()
+    fake_readline.install()
+
+    # Each dimension is varied with the other held at its smallest size
+    entry_sizes = parse_sizes(options.entries)
+    ref_sizes = parse_sizes(options.refs)
+    configs = [(n, min(ref_sizes), 'entries') for n in entry_sizes]
+    configs += [(min(entry_sizes), n, 'refs') for n in ref_sizes]
+
+    print '%-22s %10s %10s %10s %8s' % ('case', 'size', 'p50 (ms)',
+                                        'p99 (ms)', 'matches')
+    results = {}
+    for (num_entries, num_refs, dimension) in configs:
+        cli_obj = make_review(num_entries, num_refs)
+        for (case_name, line, case_dimension) in CASES:
+            if case_dimension != dimension:
+                continue
+            if dimension == 'entries':
+                size = num_entries
+            else:
+                size = num_refs
+            result = time_case(cli_obj, fake_readline, line,
+                               options.iterations, options.maxTime)
+            results['%s/%s=%d' % (case_name, dimension, size)] = result
+            print '%-22s %10s %10.3f %10.3f %8d' % \
+                    (case_name, '%s=%d' % (dimension[0], size),
+                     result['p50_ms'], result['p99_ms'], result['matches'])
+            sys.stdout.flush()
+        del cli_obj
+
+    if options.output is not None:
+        f = open(options.output, 'w')
+        try:
+            json.dump({'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        finally:
+            f.close()
+
+    if baseline is not None:
+        gated_keys = ['p50_ms']
+        if options.gateP99:
+            gated_keys.append('p99_ms')
+        regressions = compare(results, baseline, options.threshold,
+                              options.minDelta, gated_keys)
+        if not options.gateP99:
+            for msg in compare(results, baseline, options.threshold,
+                               options.minDelta, ['p99_ms']):
+                print 'NOTE: %s' % (msg,)
+        for msg in regressions:
+            print 'REGRESSION: %s' % (msg,)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,285 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+fork_budget - check how many times git-review runs git for each operation.
+
+Most of git-review's latency comes from launching git.  This creates a
+scratch repository, drives Review and CliReviewer through a scripted
+session, and records every command launched through gitreview.proc during
+each step.  Each step has a budget: the maximum number of git commands it
+may run, and which git subcommands those may be.  The exit status is 1 if
+any step exceeds its budget, so this can be run before committing changes
+that affect how git is invoked.
+
+No network access is needed; the repository is created locally, and all
+git configuration outside of it is ignored.
+"""
+
+import optparse
+import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import gitreview.git as git
+import gitreview.proc as proc
+import gitreview.review as review
+
+# step name --> (maximum number of git commands,
+#                {git subcommand: maximum number of times})
+# Subcommands that aren't listed may not be run at all.
+BUDGETS = {
+    'diff commits': (1, {'diff': 1}),
+    'diff working dir': (1, {'diff': 1}),
+    'review setup': (1, {'cat-file': 1}),
+    'cli setup': (0, {}),
+    'list': (0, {}),
+    'next': (0, {}),
+    'goto': (0, {}),
+    'diff': (2, {'cat-file': 2}),
+    'view': (1, {'cat-file': 1}),
+    'diff revisions': (2, {'cat-file': 2}),
+    'alias': (0, {}),
+    'complete commit': (2, {'ls-remote': 1, 'ls-tree': 1}),
+    'complete path': (1, {'ls-tree': 1}),
+    'commits (cold)': (1, {'cat-file': 1}),
+    'commits (warm)': (0, {}),
+}
+
+_GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Fork Budget',
+    'GIT_AUTHOR_EMAIL': 'budget@localhost',
+    'GIT_COMMITTER_NAME': 'Fork Budget',
+    'GIT_COMMITTER_EMAIL': 'budget@localhost',
+    'GIT_CONFIG_NOSYSTEM': '1',
+    'GIT_REVIEW_DIFF': 'true',
+    'GIT_REVIEW_VIEW': 'true',
+    'GIT_REVIEW_SESSION': 'process',
+}
+
+
+class Recorder(object):
+    """
+    Records the git commands launched through gitreview.proc.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def __call__(self, args, cwd):
+        self.commands.append(list(args))
+
+    def reset(self):
+        commands = self.commands
+        self.commands = []
+        return commands
+
+
+def get_subcommand(args):
+    """
+    Return the git subcommand name from a command line, or None if the
+    command isn't git.
+    """
+    if os.path.basename(args[0]) != os.path.basename(git.GIT_EXE):
+        return None
+    for arg in args[1:]:
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+
+def run_git(work_dir, *args):
+    subprocess.check_call([git.GIT_EXE] + list(args), cwd=work_dir,
+                          stdout=open(os.devnull, 'w'))
+
+
+def create_repo(work_dir, num_files):
+    run_git(work_dir, 'init', '-q')
+    for n in range(num_files):
+        dirname = os.path.join(work_dir, 'dir%d' % (n % 4,))
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+        f = open(os.path.join(dirname, 'file%d.txt' % (n,)), 'w')
+        f.write(''.join(['line %d\n' % (i,) for i in range(50)]))
+        f.close()
+    run_git(work_dir, 'add', '.')
+    run_git(work_dir, 'commit', '-q', '-m', 'Initial commit')
+
+    # A second commit modifying every other file
+    for n in range(0, num_files, 2):
+        path = os.path.join(work_dir, 'dir%d' % (n % 4,), 'file%d.txt' % (n,))
+        f = open(path, 'a')
+        f.write('changed\n')
+        f.close()
+    run_git(work_dir, 'commit', '-q', '-a', '-m', 'Modify some files')
+
+    # Leave some changes in the working directory
+    for n in range(1, num_files, 3):
+        path = os.path.join(work_dir, 'dir%d' % (n % 4,), 'file%d.txt' % (n,))
+        f = open(path, 'a')
+        f.write('uncommitted\n')
+        f.close()
+
+
+class Session(object):
+    def __init__(self, recorder, verbose):
+        self.recorder = recorder
+        self.verbose = verbose
+        # list of (step name, commands, errors)
+        self.results = []
+
+    def step(self, name, function, *args):
+        """
+        Run function(*args), and check the git commands it ran against the
+        budget for the step.
+        """
+        self.recorder.reset()
+        old_stdout = sys.stdout
+        if not self.verbose:
+            # Hide output from CLI commands
+            sys.stdout = StringIO.StringIO()
+        try:
+            result = function(*args)
+        finally:
+            sys.stdout = old_stdout
+        commands = self.recorder.reset()
+        self.results.append((name, commands, self.check(name, commands)))
+        return result
+
+    def check(self, name, commands):
+        (max_total, max_counts) = BUDGETS[name]
+        errors = []
+        git_cmds = [cmd for cmd in commands if get_subcommand(cmd)]
+        if len(git_cmds) > max_total:
+            errors.append('ran git %d times; the budget is %d' %
+                          (len(git_cmds), max_total))
+        counts = {}
+        for cmd in git_cmds:
+            subcommand = get_subcommand(cmd)
+            counts[subcommand] = counts.get(subcommand, 0) + 1
+        for (subcommand, count) in sorted(counts.items()):
+            limit = max_counts.get(subcommand, 0)
+            if count > limit:
+                errors.append('ran "git %s" %d times; the budget is %d' %
+                              (subcommand, count, limit))
+        return errors
+
+    def report(self):
+        print '%-20s %6s %6s  %s' % ('step', 'runs', 'budget', 'result')
+        failed = False
+        for (name, commands, errors) in self.results:
+            if errors:
+                failed = True
+                status = 'FAIL: ' + '; '.join(errors)
+            else:
+                status = 'ok'
+            print '%-20s %6d %6d  %s' % (name, len(commands),
+                                         BUDGETS[name][0], status)
+            if self.verbose or errors:
+                for cmd in commands:
+                    print '    %s' % (' '.join(cmd),)
+        return failed
+
+
+def run_session(work_dir, session):
+    repo = git.get_repo(working_dir=work_dir,
+                        git_dir=os.path.join(work_dir, '.git'))
+
+    session.step('diff commits', repo.getDiff, 'HEAD~1', 'HEAD')
+    session.step('diff working dir', repo.getDiff, git.COMMIT_INDEX,
+                 git.COMMIT_WD)
+
+    diff = repo.getDiff('HEAD~1', 'HEAD')
+    journal = review.get_review_journal(repo)
+    rev = session.step('review setup', review.Review, repo, diff, journal)
+    cli_obj = session.step('cli setup', review.CliReviewer, rev)
+
+    session.step('list', cli_obj.runCommand, 'list')
+    session.step('next', cli_obj.runCommand, 'next')
+    session.step('goto', cli_obj.runCommand, 'goto 0')
+    session.step('diff', cli_obj.runCommand, 'diff')
+    session.step('view', cli_obj.runCommand, 'view')
+    session.step('diff revisions', cli_obj.runCommand, 'diff HEAD~1 HEAD')
+    session.step('alias', cli_obj.runCommand, 'alias base HEAD~1')
+
+    # Complete the arguments to the diff command directly, since there
+    # is no terminal for readline to read from
+    command = cli_obj.getCommand('diff')
+    cli_obj.repoCache.clearCaches()
+    session.step('complete commit', command.complete, cli_obj, 'diff',
+                 ['diff'], 'HEAD')
+    cli_obj.repoCache.clearCaches()
+    session.step('complete path', command.complete, cli_obj, 'diff',
+                 ['diff'], 'child:dir1/')
+
+    sha1s = [repo.getCommitSha1('HEAD'), repo.getCommitSha1('HEAD~1')]
+    session.step('commits (cold)', repo.getCommits, sha1s)
+    session.step('commits (warm)', repo.getCommits, sha1s)
+
+    cli_obj.viewer.close()
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--num-files',
+                      action='store', type='int', dest='numFiles',
+                      default=40,
+                      help='Number of files in the test repository')
+    parser.add_option('-k', '--keep',
+                      action='store_true', dest='keep', default=False,
+                      help='Keep the test repository, and print its path')
+    parser.add_option('-v', '--verbose',
+                      action='store_true', dest='verbose', default=False,
+                      help='Show every command run, and the output of CLI '
+                           'commands')
+    (options, args) = parser.parse_args(argv[1:])
+
+    tmp_dir = tempfile.mkdtemp(prefix='git-review-fork-budget-')
+    os.environ.update(_GIT_ENV)
+    # Ignore the user's own git configuration
+    os.environ['HOME'] = tmp_dir
+    os.environ.setdefault('USER', 'nobody')
+    for name in ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_INDEX_FILE'):
+        os.environ.pop(name, None)
+
+    recorder = Recorder()
+    proc.add_spawn_hook(recorder)
+    try:
+        work_dir = os.path.join(tmp_dir, 'repo')
+        os.mkdir(work_dir)
+        create_repo(work_dir, options.numFiles)
+
+        session = Session(recorder, options.verbose)
+        run_session(work_dir, session)
+        failed = session.report()
+    finally:
+        proc.remove_spawn_hook(recorder)
+        if options.keep:
+            print 'Test repository: %s' % (tmp_dir,)
+        else:
+            shutil.rmtree(tmp_dir)
+
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
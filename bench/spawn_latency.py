@@ -0,0 +1,124 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+spawn_latency - measure per-command launch latency of the gitreview.proc
+spawn backends, as the resident set size of the parent process grows.
+
+For each RSS step, the parent allocates and touches more memory, then runs
+a trivial command repeatedly with each backend, and reports the median and
+90th percentile latency per launch.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import gitreview.proc as proc
+
+MB = 1024 * 1024
+PAGE_SIZE = 4096
+
+
+def get_rss():
+    """
+    Return the resident set size of the current process, in bytes.
+    """
+    try:
+        f = open('/proc/self/statm', 'r')
+    except IOError:
+        import resource
+        # ru_maxrss is in kilobytes on Linux, and bytes on macOS.
+        # We only get here on non-Linux platforms.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        fields = f.read().split()
+    finally:
+        f.close()
+    return int(fields[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def grow(ballast, target_bytes):
+    """
+    Allocate and touch memory until the process RSS reaches target_bytes.
+    """
+    while get_rss() < target_bytes:
+        chunk = bytearray(64 * MB)
+        # Touch every page, so the memory is actually resident
+        for offset in xrange(0, len(chunk), PAGE_SIZE):
+            chunk[offset] = 1
+        ballast.append(chunk)
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def time_spawns(backend, cmd, count):
+    proc.set_spawn_backend(backend)
+    times = []
+    for n in xrange(count):
+        start = time.time()
+        proc.run_cmd(cmd)
+        times.append(time.time() - start)
+    times.sort()
+    return (percentile(times, 0.5), percentile(times, 0.9))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--count',
+                      action='store', type='int', dest='count', default=200,
+                      help='Number of launches per measurement')
+    parser.add_option('-s', '--steps',
+                      action='store', dest='steps', default='0,256,1024,2048',
+                      help='Comma-separated list of RSS sizes, in MB')
+    parser.add_option('-c', '--command',
+                      action='store', dest='command', default='true',
+                      help='The command to launch')
+    (options, args) = parser.parse_args(argv[1:])
+
+    backends = [proc.SPAWN_FORK]
+    try:
+        proc.set_spawn_backend(proc.SPAWN_POSIX)
+        backends.append(proc.SPAWN_POSIX)
+    except proc.ProcError, ex:
+        sys.stderr.write('warning: %s\n' % (ex,))
+
+    cmd = options.command.split()
+    steps = [int(step) * MB for step in options.steps.split(',')]
+
+    print '%10s  %-12s  %10s  %10s' % ('RSS (MB)', 'backend',
+                                       'p50 (ms)', 'p90 (ms)')
+    ballast = []
+    for step in steps:
+        grow(ballast, step)
+        rss_mb = get_rss() / MB
+        for backend in backends:
+            (p50, p90) = time_spawns(backend, cmd, options.count)
+            print '%10d  %-12s  %10.3f  %10.3f' % (rss_mb, backend,
+                                                   p50 * 1000, p90 * 1000)
+        sys.stdout.flush()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,172 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+tokenize_bench - check and time gitreview.cli.tokenize.SimpleTokenizer.
+
+First, SimpleTokenizer is checked against SimpleStateTokenizer, the
+character-at-a-time implementation it replaces, on randomly generated
+strings.  The strings are built mostly from the characters the tokenizers
+treat specially (quotes, backslashes, and delimiters), so that unusual
+combinations such as empty quotes, escaped delimiters, and unterminated
+quotes and escapes are all covered.  Both the complete results
+(getTokens()) and the partial results used for completion
+(getTokens(stop_at_end=False) and getPartialToken()) must be identical,
+including any PartialTokenError.  Failing strings are printed, shortest
+first, and the exit status is 1.
+
+Then both tokenizers are timed on command lines of increasing length.
+"""
+
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import gitreview.cli.tokenize as tokenize
+
+_SPECIAL_CHARS = ' \t\n"\'\\'
+_PLAIN_CHARS = 'ab/.:'
+
+
+def get_results(tokenizer_class, value):
+    """
+    Return everything that can be observed about how a tokenizer handles
+    value.
+    """
+    results = []
+    for stop_at_end in (True, False):
+        tokenizer = tokenizer_class(value)
+        try:
+            tokens = tokenizer.getTokens(stop_at_end=stop_at_end)
+            error = None
+        except tokenize.PartialTokenError, ex:
+            tokens = None
+            error = (ex.token, ex.error)
+        results.append((tokens, error, tokenizer.getPartialToken()))
+    return results
+
+
+def random_string(rng, max_length):
+    length = rng.randint(0, max_length)
+    chars = []
+    for n in range(length):
+        if rng.random() < 0.6:
+            chars.append(rng.choice(_SPECIAL_CHARS))
+        else:
+            chars.append(rng.choice(_PLAIN_CHARS))
+    return ''.join(chars)
+
+
+def check(num_cases, max_length, seed):
+    rng = random.Random(seed)
+    failures = set()
+    for n in range(num_cases):
+        value = random_string(rng, max_length)
+        expected = get_results(tokenize.SimpleStateTokenizer, value)
+        actual = get_results(tokenize.SimpleTokenizer, value)
+        if actual != expected:
+            failures.add(value)
+
+    failures = sorted(failures, key=lambda value: (len(value), value))
+    for value in failures[:10]:
+        print 'MISMATCH for %r' % (value,)
+        print '    expected: %r' % \
+                (get_results(tokenize.SimpleStateTokenizer, value),)
+        print '    actual:   %r' % \
+                (get_results(tokenize.SimpleTokenizer, value),)
+    print 'checked %d strings: %d mismatches' % (num_cases, len(failures))
+    return not failures
+
+
+def make_line(num_args):
+    args = ['diff']
+    for n in range(num_args):
+        if n % 3 == 0:
+            args.append('HEAD~%d:dir%d/file%d.c' % (n, n % 7, n))
+        elif n % 3 == 1:
+            args.append('"a quoted \\"arg\\" %d"' % (n,))
+        else:
+            args.append('escaped\\ space\\ %d' % (n,))
+    return ' '.join(args)
+
+
+def time_tokenizer(tokenizer_class, line, max_time):
+    times = []
+    deadline = time.time() + max_time
+    while True:
+        start = time.time()
+        tokenizer_class(line).getTokens(stop_at_end=False)
+        times.append(time.time() - start)
+        if time.time() > deadline:
+            break
+    times.sort()
+    return times[len(times) // 2]
+
+
+def benchmark(sizes, max_time):
+    print '%8s %8s %14s %14s %8s' % ('args', 'chars', 'state (ms)',
+                                     'regex (ms)', 'speedup')
+    for num_args in sizes:
+        line = make_line(num_args)
+        old_time = time_tokenizer(tokenize.SimpleStateTokenizer, line,
+                                  max_time)
+        new_time = time_tokenizer(tokenize.SimpleTokenizer, line, max_time)
+        print '%8d %8d %14.3f %14.3f %7.1fx' % \
+                (num_args, len(line), old_time * 1000, new_time * 1000,
+                 old_time / max(new_time, 1e-9))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-c', '--cases',
+                      action='store', type='int', dest='cases',
+                      default=20000,
+                      help='Number of random strings to check')
+    parser.add_option('-l', '--max-length',
+                      action='store', type='int', dest='maxLength',
+                      default=12,
+                      help='Maximum length of the random strings')
+    parser.add_option('-s', '--seed',
+                      action='store', type='int', dest='seed', default=None,
+                      help='Seed for the random strings')
+    parser.add_option('-a', '--args',
+                      action='store', dest='args', default='1,10,100,1000',
+                      help='Comma-separated numbers of arguments in the '
+                           'command lines to time')
+    parser.add_option('-t', '--max-time',
+                      action='store', type='float', dest='maxTime',
+                      default=1.0,
+                      help='Time each tokenizer for this many seconds per '
+                           'line')
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.seed is None:
+        options.seed = random.randrange(1 << 32)
+    print 'seed: %d' % (options.seed,)
+    if not check(options.cases, options.maxLength, options.seed):
+        return 1
+
+    sizes = [int(size) for size in options.args.split(',')]
+    benchmark(sizes, options.maxTime)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
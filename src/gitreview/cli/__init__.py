@@ -16,9 +16,12 @@
 #
 import readline
 import sys
+import threading
+import time
 import traceback
 
 from exceptions import *
+import timing
 import tokenize
 
 # Import everything from our command and args submodules
@@ -26,6 +29,47 @@ import tokenize
 from command import *
 from args import *
 
+# The maximum number of completion results to remember
+_MAX_COMPLETION_CACHE = 64
+
+
+class _CompletionJob(threading.Thread):
+    """
+    Computes the completions for a partial command line in a background
+    thread.
+
+    The matches found so far are available in self.partial while the job
+    is running.  Once it has finished, the full list of matches is in
+    self.matches, or the exception information in self.excInfo if it
+    failed.
+    """
+    def __init__(self, function):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.partial = []
+        self.matches = None
+        self.excInfo = None
+        self.finished = threading.Event()
+
+    def run(self):
+        _local.job = self
+        try:
+            self.matches = self.function()
+        except:
+            self.excInfo = sys.exc_info()
+        _local.job = None
+        self.finished.set()
+
+    def getMatches(self):
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.matches
+
+
+# Per-thread state.  job is the _CompletionJob running in the thread, if any.
+_local = threading.local()
+
 
 class CLI(object):
     """
@@ -50,6 +94,17 @@ class CLI(object):
         # self.prevLine will be updated
         self.rememberEmptyLine = False
 
+        # The number of seconds to wait for completions to be computed
+        # before returning the matches found so far.  Completion continues
+        # in the background, and the full list of matches is returned the
+        # next time completion is requested for the same text.  If None,
+        # always wait for completion to finish.
+        self.completionDeadline = 0.05
+
+        # The number of upcoming commands passed to prepareCommands() when
+        # running a script
+        self.scriptLookahead = 8
+
         # State, modifiable by subclasses
         self.stop = False
         self.line = None
@@ -58,8 +113,13 @@ class CLI(object):
         self.prevLine = None
         self.commands = {}
 
+        # Latency histograms for each command and completion
+        self.timings = timing.TimingRegistry()
+
         # Private state
         self.__oldCompleter = None
+        # (line, begidx) --> _CompletionJob
+        self.__completionJobs = {}
 
     def addCommand(self, name, command):
         if self.commands.has_key(name):
@@ -139,6 +199,44 @@ class CLI(object):
 
         return rc
 
+    def runScript(self, lines):
+        """
+        cli.runScript(lines) --> return code of the first failed command
+
+        Run a list of command lines non-interactively, stopping early if a
+        command sets self.stop.  The remaining commands still run after a
+        command fails, but the return code is that of the first command that
+        returned a non-zero code, or 0 if none did.  Each line is echoed
+        after the prompt before it is run.  Empty lines and lines starting
+        with '#' are skipped, rather than repeating the previous command.
+
+        Before each command runs, prepareCommands() is given it and the
+        commands after it, up to self.scriptLookahead commands in total.
+        """
+        self.stop = False
+        lines = [line for line in lines
+                 if line.strip() and not line.lstrip().startswith('#')]
+
+        rc = 0
+        for index in range(len(lines)):
+            if self.stop:
+                break
+            line = lines[index]
+            self.output(self.prompt + line)
+            self.prepareCommands(lines[index:index + self.scriptLookahead])
+            cmd_rc = self.runCommand(line)
+            if not rc and cmd_rc:
+                rc = cmd_rc
+        return rc
+
+    def prepareCommands(self, lines):
+        """
+        Called by runScript() with the command lines that are about to be
+        run, in order.  Subclasses may override this to start work for them
+        in advance.  The lines have not been checked, and may be invalid.
+        """
+        pass
+
     def runCommand(self, line, store=True):
         if line == None:
             return self.handleEof()
@@ -146,6 +244,11 @@ class CLI(object):
         if not line:
             return self.handleEmptyLine()
 
+        # Commands may change the available completions.  Completions still
+        # running in the background are not waited for; their results are
+        # just discarded.
+        self.clearCompletionCache()
+
         (cmd_name, args) = self.parseLine(line)
         rc = self.invokeCommand(cmd_name, args, line)
 
@@ -165,10 +268,23 @@ class CLI(object):
         except AmbiguousCommandError, ex:
             return self.handleAmbiguousCommand(cmd_name, ex.matches)
 
+        start = time.time()
         try:
             return cmd_entry.run(self, cmd_name, args, line)
         except:
             return self.handleCommandException()
+        finally:
+            self.timings.record(self.__getFullCommandName(cmd_name),
+                                time.time() - start)
+
+    def __getFullCommandName(self, cmd_name):
+        """
+        Get the full name of a command that may have been abbreviated.
+        The name must refer to a valid command.
+        """
+        if self.commands.has_key(cmd_name):
+            return cmd_name
+        return self.completeCommand(cmd_name)[0]
 
     def handleEof(self):
         self.output()
@@ -252,7 +368,23 @@ class CLI(object):
                 # Not a valid command.  No matches
                 return None
 
-            matches = command.complete(self, cmd_name, args, part)
+            def function():
+                start = time.time()
+                try:
+                    return command.complete(self, cmd_name, args, part)
+                finally:
+                    name = self.__getFullCommandName(cmd_name)
+                    self.timings.record('complete ' + name,
+                                        time.time() - start)
+            (matches, complete) = self.__runCompletion((line, begidx),
+                                                       function)
+            if not complete:
+                # Include the text itself as a match.  This way readline
+                # lists the partial matches, but doesn't insert any of
+                # them, since they may not include the correct one.
+                if not matches:
+                    return []
+                matches = matches + [part]
 
         # Massage matches to look like what readline expects
         # (since readline doesn't know about our exact tokenization routine)
@@ -279,6 +411,79 @@ class CLI(object):
 
         return ret
 
+    def __runCompletion(self, key, function):
+        """
+        cli.__runCompletion(key, function) --> (matches, complete)
+
+        Run a completion function, waiting no longer than
+        self.completionDeadline for it.
+
+        If it doesn't finish in time, the matches it has reported so far
+        with addPartialCompletions() are returned, and it keeps running in
+        the background.  Its full results are returned the next time
+        completion is requested for the same key.
+        """
+        if self.completionDeadline is None:
+            return (function(), True)
+
+        job = self.__completionJobs.get(key)
+        if job is None:
+            if len(self.__completionJobs) >= _MAX_COMPLETION_CACHE:
+                self.__dropFinishedCompletions()
+            job = _CompletionJob(function)
+            self.__completionJobs[key] = job
+            job.start()
+
+        job.finished.wait(self.completionDeadline)
+        if not job.finished.isSet():
+            return (job.partial[:], False)
+
+        try:
+            return (job.getMatches(), True)
+        except:
+            # Don't cache failures, so the next attempt tries again
+            del self.__completionJobs[key]
+            raise
+
+    def addPartialCompletions(self, matches):
+        """
+        Report some of the matches for the completion currently being
+        computed.
+
+        Slow completion functions can call this with the matches they have
+        found so far, so that they are available to the user if completion
+        takes longer than self.completionDeadline.
+        """
+        job = getattr(_local, 'job', None)
+        if job is not None:
+            # list.extend() is atomic
+            job.partial.extend(matches)
+
+    def clearCompletionCache(self, wait=False):
+        """
+        Forget all cached completion results.  Completions still being
+        computed in the background keep running, and their results are
+        discarded when they finish.  If wait is True, they are waited for
+        first.
+        """
+        if wait:
+            for job in self.__completionJobs.itervalues():
+                job.finished.wait()
+        self.__completionJobs = {}
+
+    def __dropFinishedCompletions(self):
+        """
+        Make room in the completion cache by forgetting the results of the
+        completions that have finished.  Unfinished ones are kept, so that
+        their results can still be used, and a slow completion the user
+        gave up on never delays the next one.
+        """
+        jobs = {}
+        for (key, job) in self.__completionJobs.iteritems():
+            if not job.finished.isSet():
+                jobs[key] = job
+        self.__completionJobs = jobs
+
     def completeCommand(self, text, add_space=False):
         matches = [cmd_name for cmd_name in self.commands.keys()
                    if cmd_name.startswith(text)]
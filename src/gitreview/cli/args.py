@@ -29,6 +29,16 @@ class ArgCommand(command.Command):
         self.helpText = help
 
     def run(self, cli_obj, name, args, line):
+        parsed_args = self.parseArgs(cli_obj, args)
+        return self.runParsed(cli_obj, name, parsed_args)
+
+    def parseArgs(self, cli_obj, args):
+        """
+        command.parseArgs(cli_obj, args) --> ParsedArgs
+
+        Parse the tokens of a command line (including the command name) into
+        the argument values passed to runParsed().
+        """
         args = args[1:]
         num_args = len(args)
         num_arg_types = len(self.argTypes)
@@ -57,7 +67,7 @@ class ArgCommand(command.Command):
             arg_type = self.argTypes[n]
             setattr(parsed_args, arg_type.getName(), arg_type.getDefaultValue())
 
-        return self.runParsed(cli_obj, name, parsed_args)
+        return parsed_args
 
     def help(self, cli_obj, name, args, line):
         args = args[1:]
@@ -164,3 +174,27 @@ class IntArgument(Argument):
             raise CommandArgumentsError(msg)
 
         return value
+
+
+class ChoiceArgument(Argument):
+    """
+    An argument that must be one of a fixed set of strings.
+    """
+    def __init__(self, name, choices, **kwargs):
+        Argument.__init__(self, name, **kwargs)
+        self.choices = choices
+
+    def parse(self, cli_obj, arg):
+        if arg not in self.choices:
+            msg = '%s must be one of: %s' % (self.getHrName(),
+                                             ', '.join(self.choices))
+            raise CommandArgumentsError(msg)
+        return arg
+
+    def complete(self, cli_obj, text):
+        matches = [choice for choice in self.choices
+                   if choice.startswith(text)]
+        # If only 1 choice matches, append a space
+        if len(matches) == 1:
+            return [matches[0] + ' ']
+        return matches
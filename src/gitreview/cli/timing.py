@@ -0,0 +1,186 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Latency histograms for CLI commands.
+
+Latencies are recorded in microseconds, in buckets with a fixed relative
+precision, similar to HdrHistogram.  Each power of two is divided into
+SUB_BUCKETS linear buckets, so any recorded value is within about 6% of the
+value reported for its bucket.  Recording a value takes constant time, and
+each histogram uses a fixed amount of memory regardless of how many values
+are recorded.
+"""
+
+import json
+import threading
+import time
+
+# The number of buckets each power of two is divided into.  Must be a power
+# of two.
+SUB_BUCKETS = 16
+_SUB_BUCKET_BITS = 4
+
+# Values up to 2**_MAX_BITS microseconds (about 19 hours) can be recorded.
+# Larger values are counted in the last bucket.
+_MAX_BITS = 36
+_NUM_BUCKETS = (_MAX_BITS - _SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+
+def _get_bucket(value):
+    if value < SUB_BUCKETS:
+        return value
+    # Shift the value right until it fits in the sub-bucket range.  The
+    # number of bits shifted selects the power of two.
+    shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+    index = (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+    return min(index, _NUM_BUCKETS - 1)
+
+
+def _get_bucket_limit(index):
+    """
+    Return the largest value counted in the specified bucket.
+    """
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    sub_bucket = index % SUB_BUCKETS + SUB_BUCKETS
+    return ((sub_bucket + 1) << shift) - 1
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * _NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """
+        Record a value, in microseconds.
+        """
+        value = max(int(value), 0)
+        self.counts[_get_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def getMean(self):
+        if not self.count:
+            return 0
+        return self.total / float(self.count)
+
+    def getPercentile(self, percentile):
+        """
+        histogram.getPercentile(percentile) --> microseconds
+
+        Returns the value below which the specified percentage of the
+        recorded values fall, to the precision of the buckets.
+        """
+        if not self.count:
+            return 0
+        # The number of values that must be at or below the result
+        needed = max(int(self.count * percentile / 100.0 + 0.5), 1)
+        seen = 0
+        for index in range(_NUM_BUCKETS):
+            seen += self.counts[index]
+            if seen >= needed:
+                return min(_get_bucket_limit(index), self.max)
+        return self.max
+
+    def toJson(self):
+        """
+        Return the histogram as an object that can be encoded as JSON.
+        Only buckets with non-zero counts are included, keyed by the
+        largest value in the bucket.
+        """
+        buckets = {}
+        for index in range(_NUM_BUCKETS):
+            if self.counts[index]:
+                buckets[str(_get_bucket_limit(index))] = self.counts[index]
+        return {
+            'count': self.count,
+            'total_us': self.total,
+            'min_us': self.min,
+            'max_us': self.max,
+            'buckets': buckets,
+        }
+
+
+class TimingRegistry(object):
+    """
+    A set of named latency histograms.
+    """
+    def __init__(self):
+        self.startTime = time.time()
+        # name --> Histogram
+        self.histograms = {}
+        # Completions are timed in background threads
+        self.__lock = threading.Lock()
+
+    def record(self, name, seconds):
+        self.__lock.acquire()
+        try:
+            try:
+                histogram = self.histograms[name]
+            except KeyError:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            histogram.record(seconds * 1000000)
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.histograms = {}
+            self.startTime = time.time()
+        finally:
+            self.__lock.release()
+
+    def getHistograms(self):
+        """
+        registry.getHistograms() --> list of (name, Histogram), sorted by name
+        """
+        self.__lock.acquire()
+        try:
+            items = self.histograms.items()
+        finally:
+            self.__lock.release()
+        items.sort()
+        return items
+
+    def toJson(self):
+        timings = {}
+        for (name, histogram) in self.getHistograms():
+            timings[name] = histogram.toJson()
+        return {
+            'start': self.startTime,
+            'end': time.time(),
+            'timings': timings,
+        }
+
+    def writeJson(self, path):
+        f = open(path, 'w')
+        try:
+            json.dump(self.toJson(), f, indent=2, sort_keys=True)
+            f.write('\n')
+        finally:
+            f.close()
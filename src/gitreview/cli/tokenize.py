@@ -189,11 +189,141 @@ class Tokenizer(object):
         self.currentToken = None
 
 
-class SimpleTokenizer(Tokenizer):
+class SimpleStateTokenizer(Tokenizer):
+    """
+    The State-based equivalent of SimpleTokenizer.
+
+    This is much slower, but is built from the same State classes that
+    custom tokenizers use.  It is kept as the reference that SimpleTokenizer
+    is checked against.
+    """
     def __init__(self, value):
         Tokenizer.__init__(self, [NormalState()], value)
 
 
+# Each match is one piece of a token, or a run of delimiters.  Quoted
+# strings must be terminated; if nothing matches, the string ends with an
+# unterminated quote or escape sequence.
+_PIECE_RE = re.compile(r'''
+    ([^ \t\n"'\\]+)               # unquoted text
+    | \\(.)                         # an escaped character
+    | "((?:[^"\\]|\\.)*)"           # a double quoted string
+    | '((?:[^'\\]|\\.)*)'           # a single quoted string
+    | ([ \t\n]+)                    # delimiters
+    ''', re.DOTALL | re.VERBOSE)
+_UNTERMINATED_QUOTE_RE = re.compile(r'((?:[^\\]|\\.)*)(\\?)\Z', re.DOTALL)
+_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+
+def _unescape(value):
+    if '\\' not in value:
+        return value
+    return _ESCAPE_RE.sub(r'\1', value)
+
+
+class SimpleTokenizer(object):
+    """
+    Splits a string on spaces, tabs, and newlines, handling single and
+    double quotes and backslash escapes.
+
+    This behaves the same as SimpleStateTokenizer, but scans the string
+    with a regular expression instead of processing one character at a
+    time.  The whole string is scanned when the tokenizer is created, so
+    getPartialToken() always returns the unfinished token at the end of the
+    string, rather than the one at the current position.
+    """
+    def __init__(self, value):
+        self.value = value
+        # The finished tokens.  Those from self.__nextIndex on haven't been
+        # returned yet.  (Removing them from the front of the list would
+        # make getTokens() quadratic.)
+        self.tokens = []
+        self.__nextIndex = 0
+        self.currentToken = None
+        # The message for the PartialTokenError to raise at the end of the
+        # string, or None
+        self.error = None
+        self.__processedEnd = False
+        self.__scan()
+
+    def __scan(self):
+        value = self.value
+        end = len(value)
+        tokens = self.tokens
+        current = None
+        index = 0
+        match_piece = _PIECE_RE.match
+        while index < end:
+            match = match_piece(value, index)
+            if match is None:
+                current = self.__scanUnterminated(current, index)
+                break
+            index = match.end()
+            group = match.lastindex
+            if group == 5:
+                if current is not None:
+                    tokens.append(current)
+                    current = None
+                continue
+            piece = match.group(group)
+            if group >= 3:
+                piece = _unescape(piece)
+            if current is None:
+                current = piece
+            else:
+                current += piece
+        self.currentToken = current
+
+    def __scanUnterminated(self, current, index):
+        if self.value[index] == '\\':
+            # A backslash at the end of the string.  Nothing is added to the
+            # token for it.
+            self.error = 'unterminated escape sequence'
+            return current
+
+        # An opening quote starts the token, even if nothing follows it
+        if current is None:
+            current = ''
+        match = _UNTERMINATED_QUOTE_RE.match(self.value, index + 1)
+        current += _unescape(match.group(1))
+        if match.group(2):
+            self.error = 'unterminated escape sequence'
+        else:
+            self.error = 'unterminated quote'
+        return current
+
+    def getTokens(self, stop_at_end=True):
+        tokens = []
+
+        while True:
+            token = self.getNextToken(stop_at_end)
+            if token == None:
+                break
+            tokens.append(token)
+
+        return tokens
+
+    def getNextToken(self, stop_at_end=True):
+        if self.__nextIndex < len(self.tokens):
+            token = self.tokens[self.__nextIndex]
+            self.__nextIndex += 1
+            return token
+        if not stop_at_end or self.__processedEnd:
+            # As with Tokenizer, when stop_at_end is False the string may
+            # be partial, so its end isn't processed.
+            return None
+
+        self.__processedEnd = True
+        if self.error is not None:
+            raise PartialTokenError(self.currentToken, self.error)
+        token = self.currentToken
+        self.currentToken = None
+        return token
+
+    def getPartialToken(self):
+        return self.currentToken
+
+
 def escape_arg(arg):
     """
     escape_arg(arg) --> escaped_arg
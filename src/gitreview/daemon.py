@@ -0,0 +1,797 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A per-repository daemon that keeps git information cached between git-review
+invocations.
+
+The daemon listens on a Unix domain socket in the git directory.  Each
+request and response is a single line of JSON.  A request is an object with
+"method" and "params" keys.  The response is an object with either a
+"result" or an "error" key.
+
+The daemon caches the repository configuration, the list of refs, resolved
+commit names, tree listings, and diffs between commits or against the index.
+Caches are invalidated by checking the stat information of the files git
+modifies when refs, the index, or the configuration change.  Diffs against
+the working directory are never cached, since the working directory can
+change without git noticing.
+
+Clients use the daemon opportunistically: any failure to talk to the daemon
+falls back to running git directly.
+"""
+
+import collections
+import errno
+import hashlib
+import json
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+import gitreview.git as git
+
+# How long the daemon waits without any connections before exiting,
+# in seconds.  Can be overridden with the review.daemonIdleTimeout config
+# setting.
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+# The approximate amount of memory the daemon may use, in megabytes.
+# Can be overridden with the review.daemonMemoryLimit config setting.
+DEFAULT_MEMORY_LIMIT = 256
+
+MB = 1024 * 1024
+
+# Environment variables that change what git commands operate on.  If any of
+# these are set, the daemon (which was started with its own environment)
+# can't be used.
+_UNSHAREABLE_ENV = ('GIT_INDEX_FILE', 'GIT_OBJECT_DIRECTORY',
+                    'GIT_ALTERNATE_OBJECT_DIRECTORIES', 'GIT_CONFIG',
+                    'GIT_CONFIG_PARAMETERS', 'GIT_NAMESPACE',
+                    'GIT_REPLACE_REF_BASE')
+
+# Unix domain socket paths are limited to about 108 bytes
+_MAX_SOCKET_PATH = 100
+
+_CONNECT_TIMEOUT = 1.0
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonConnectionError(DaemonError):
+    """
+    The connection to the daemon was lost, or it sent an invalid response.
+    """
+    pass
+
+
+def get_socket_path(git_dir):
+    """
+    get_socket_path(git_dir) --> path
+
+    Get the path of the daemon socket for the specified git directory.
+    """
+    git_dir = os.path.abspath(git_dir)
+    path = os.path.join(git_dir, 'git-review', 'daemon.sock')
+    if len(path) <= _MAX_SOCKET_PATH:
+        return path
+
+    # The git directory path is too long.  Use a private directory in /tmp
+    # instead, named after the git directory.
+    tmp_dir = os.path.join(tempfile.gettempdir(),
+                           'git-review-%d' % (os.getuid(),))
+    name = hashlib.sha1(git_dir).hexdigest()[:16] + '.sock'
+    return os.path.join(tmp_dir, name)
+
+
+def _make_private_dir(path):
+    try:
+        os.makedirs(path, 0700)
+    except OSError, ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise DaemonError('%s is not a directory owned by the current user' %
+                          (path,))
+
+
+def _from_json(obj):
+    """
+    Convert the unicode strings returned by json.loads() back to byte
+    strings.  All strings are encoded as latin-1 by _to_json(), so that
+    paths that are not valid UTF-8 survive the round trip.
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    if isinstance(obj, list):
+        return [_from_json(item) for item in obj]
+    if isinstance(obj, dict):
+        result = {}
+        for (key, value) in obj.iteritems():
+            result[_from_json(key)] = _from_json(value)
+        return result
+    return obj
+
+
+def _to_json(obj):
+    return json.dumps(obj, encoding='latin-1', separators=(',', ':')) + '\n'
+
+
+def _get_stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError, ex:
+        if ex.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+    return (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+
+
+def _get_rss():
+    """
+    Return the resident set size of the current process, in bytes, or None
+    if it can't be determined.
+    """
+    try:
+        f = open('/proc/self/statm', 'r')
+    except IOError:
+        return None
+    try:
+        fields = f.read().split()
+    finally:
+        f.close()
+    return int(fields[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _encode_diff(diff):
+    entries = []
+    for entry in diff:
+        entries.append([entry.old.mode, entry.new.mode,
+                        entry.old.sha1, entry.new.sha1, str(entry.status),
+                        entry.old.path, entry.new.path,
+                        entry.linesAdded, entry.linesRemoved, entry.binary,
+                        entry.patchId])
+    return entries
+
+
+def _decode_diff(parent, child, paths, entries):
+    diff = git.diff.DiffFileList(parent, child, paths)
+    for (old_mode, new_mode, old_sha1, new_sha1, status, old_path, new_path,
+         added, removed, binary, patch_id) in entries:
+        entry = git.diff.DiffEntry(old_mode, new_mode, old_sha1, new_sha1,
+                                   git.diff.Status(status), old_path,
+                                   new_path)
+        entry.linesAdded = added
+        entry.linesRemoved = removed
+        entry.binary = binary
+        entry.patchId = patch_id
+        diff.add(entry)
+    return diff
+
+
+def _encode_tree(entries):
+    return [[entry.name, entry.mode, entry.type, entry.sha1]
+            for entry in entries]
+
+
+def _decode_tree(entries):
+    return [git.obj.TreeEntry(name, mode, type, sha1)
+            for (name, mode, type, sha1) in entries]
+
+
+class _SizedCache(object):
+    """
+    A least-recently-used cache, limited by the approximate size of its
+    contents.
+    """
+    def __init__(self, max_size):
+        self.maxSize = max_size
+        self.size = 0
+        self.__items = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        cache.get(key) --> value
+
+        Raises KeyError if the key is not present.
+        """
+        (value, size) = self.__items.pop(key)
+        self.__items[key] = (value, size)
+        return value
+
+    def put(self, key, value, size):
+        try:
+            (old_value, old_size) = self.__items.pop(key)
+            self.size -= old_size
+        except KeyError:
+            pass
+        if size > self.maxSize:
+            return
+        self.__items[key] = (value, size)
+        self.size += size
+        while self.size > self.maxSize:
+            (old_key, (old_value, old_size)) = \
+                    self.__items.popitem(last=False)
+            self.size -= old_size
+
+    def clear(self):
+        self.__items.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.__items)
+
+
+class DaemonServer(object):
+    """
+    Serves cached git information for one repository.
+
+    Each client connection is handled in its own thread.  Requests are
+    processed one at a time.  The daemon exits when it has had no
+    connections for idle_timeout seconds.  If it uses more than
+    memory_limit bytes, its caches are cleared, and it exits as soon as it
+    is idle, so the memory is returned to the system.
+    """
+    def __init__(self, repo, socket_path=None, idle_timeout=None,
+                 memory_limit=None):
+        self.repo = repo
+        if socket_path is None:
+            socket_path = get_socket_path(repo.getGitDir())
+        self.socketPath = socket_path
+
+        if idle_timeout is None:
+            idle_timeout = int(repo.config.get('review.daemonidletimeout',
+                                               DEFAULT_IDLE_TIMEOUT))
+        if memory_limit is None:
+            memory_limit = int(repo.config.get('review.daemonmemorylimit',
+                                               DEFAULT_MEMORY_LIMIT)) * MB
+        self.idleTimeout = idle_timeout
+        self.memoryLimit = memory_limit
+
+        self.__lock = threading.Lock()
+        self.__sock = None
+        self.__numConnections = 0
+        self.__lastActivity = time.time()
+        self.__stop = False
+        self.__exitWhenIdle = False
+
+        # Caches.  Diffs and tree listings get most of the memory budget.
+        self.__objectCache = _SizedCache(memory_limit / 2)
+        self.__refsKey = None
+        self.__refs = {}
+        self.__commitSha1s = {}
+        self.__configKey = self.__getConfigKey()
+        self.__methods = {
+            'ping': self.__ping,
+            'shutdown': self.__shutdown,
+            'stats': self.__stats,
+            'getConfig': self.__getConfig,
+            'getRefs': self.__getRefs,
+            'getCommitSha1': self.__getCommitSha1,
+            'listTree': self.__listTree,
+            'getDiff': self.__getDiff,
+        }
+
+    def __getConfigKey(self):
+        paths = [os.path.join(self.repo.getGitDir(), 'config')]
+        home = os.environ.get('HOME')
+        if home:
+            paths.append(os.path.join(home, '.gitconfig'))
+        xdg_home = os.environ.get('XDG_CONFIG_HOME')
+        if not xdg_home and home:
+            xdg_home = os.path.join(home, '.config')
+        if xdg_home:
+            paths.append(os.path.join(xdg_home, 'git', 'config'))
+        return [_get_stat_key(path) for path in paths]
+
+    def __getRefsKey(self):
+        """
+        Compute a key that changes whenever any ref is updated.
+
+        git updates loose refs by renaming a lock file into place, which
+        modifies the directory containing the ref.  So it suffices to check
+        the refs directories, rather than every ref file.
+        """
+        git_dir = self.repo.getGitDir()
+        key = [_get_stat_key(os.path.join(git_dir, 'HEAD')),
+               _get_stat_key(os.path.join(git_dir, 'packed-refs'))]
+        for (dirpath, dirnames, filenames) in \
+                os.walk(os.path.join(git_dir, 'refs')):
+            key.append((dirpath, _get_stat_key(dirpath)))
+        return key
+
+    def __getIndexKey(self):
+        return _get_stat_key(os.path.join(self.repo.getGitDir(), 'index'))
+
+    def __checkInvalidation(self):
+        config_key = self.__getConfigKey()
+        if config_key != self.__configKey:
+            self.repo.config = git.config.load(self.repo.getGitDir())
+            self.__configKey = config_key
+
+        refs_key = self.__getRefsKey()
+        if refs_key != self.__refsKey:
+            # Diffs and trees are keyed by SHA1 or index state, so they
+            # remain valid
+            self.__refs = {}
+            self.__commitSha1s = {}
+            self.repo.getBatchChecker().clearCache()
+            self.__refsKey = refs_key
+
+    def __checkMemory(self):
+        rss = _get_rss()
+        if rss is None or rss <= self.memoryLimit:
+            return
+        self.__objectCache.clear()
+        self.__refs = {}
+        self.__commitSha1s = {}
+        self.__exitWhenIdle = True
+
+    def __ping(self):
+        return {'gitDir': os.path.abspath(self.repo.getGitDir()),
+                'workingDir': self.repo.getWorkingDir(),
+                'pid': os.getpid()}
+
+    def __shutdown(self):
+        self.__stop = True
+        return True
+
+    def __stats(self):
+        return {'cachedObjects': len(self.__objectCache),
+                'cacheSize': self.__objectCache.size,
+                'rss': _get_rss()}
+
+    def __getConfig(self):
+        config = self.repo.config
+        return [[name, config.getAll(name)] for name in config.getNames()]
+
+    def __getRefs(self, glob=None):
+        if isinstance(glob, list):
+            key = tuple(glob)
+        else:
+            key = glob
+        try:
+            return self.__refs[key]
+        except KeyError:
+            refs = self.repo.getRefs(glob)
+            self.__refs[key] = refs
+            return refs
+
+    def __getCommitSha1(self, name, extra_args=None):
+        if extra_args is None:
+            key = (name, None)
+        else:
+            key = (name, tuple(extra_args))
+        try:
+            return self.__commitSha1s[key]
+        except KeyError:
+            sha1 = self.repo.getCommitSha1(name, extra_args)
+            self.__commitSha1s[key] = sha1
+            return sha1
+
+    def __getCommitKey(self, name):
+        if name == git.COMMIT_INDEX:
+            return ('index', self.__getIndexKey())
+        if name == git.COMMIT_WD:
+            raise DaemonError('diffs against the working directory are '
+                              'not cached')
+        return self.__getCommitSha1(name)
+
+    def __listTree(self, commit, dirname=None):
+        # Only trees named by SHA1 can be cached, since they never change
+        sha1 = self.__getCommitKey(commit)
+        if not isinstance(sha1, str):
+            raise DaemonError('only commit trees are cached')
+        key = ('tree', sha1, dirname)
+        try:
+            return self.__objectCache.get(key)
+        except KeyError:
+            pass
+        entries = _encode_tree(self.repo.listTree(sha1, dirname))
+        self.__objectCache.put(key, entries, 150 * (len(entries) + 1))
+        return entries
+
+    def __getDiff(self, parent, child, paths=None, numstat=False):
+        parent_key = self.__getCommitKey(parent)
+        child_key = self.__getCommitKey(child)
+        if paths is not None:
+            paths = tuple(paths)
+        key = ('diff', parent_key, child_key, paths, numstat)
+        try:
+            return self.__objectCache.get(key)
+        except KeyError:
+            pass
+
+        if isinstance(parent_key, str):
+            parent = parent_key
+        if isinstance(child_key, str):
+            child = child_key
+        diff = self.repo.getDiff(parent, child, paths=paths and list(paths),
+                                 numstat=numstat)
+        entries = _encode_diff(diff)
+        self.__objectCache.put(key, entries, 300 * (len(entries) + 1))
+        return entries
+
+    def __dispatch(self, request):
+        try:
+            method = self.__methods[request['method']]
+        except KeyError:
+            return {'error': 'unknown method %r' % (request.get('method'),)}
+        params = request.get('params', [])
+
+        self.__lock.acquire()
+        try:
+            try:
+                self.__checkInvalidation()
+                result = method(*params)
+            except Exception, ex:
+                return {'error': '%s: %s' % (type(ex).__name__, ex)}
+            self.__checkMemory()
+        finally:
+            self.__lock.release()
+        return {'result': result}
+
+    def __handleConnection(self, conn):
+        try:
+            f = conn.makefile('rb')
+            try:
+                while not self.__stop:
+                    line = f.readline()
+                    if not line:
+                        break
+                    self.__lastActivity = time.time()
+                    try:
+                        request = _from_json(json.loads(line))
+                        response = self.__dispatch(request)
+                    except (ValueError, TypeError, AttributeError), ex:
+                        response = {'error': 'invalid request: %s' % (ex,)}
+                    conn.sendall(_to_json(response))
+            finally:
+                f.close()
+        except socket.error:
+            # The client went away
+            pass
+        finally:
+            conn.close()
+            self.__lock.acquire()
+            try:
+                self.__numConnections -= 1
+                self.__lastActivity = time.time()
+            finally:
+                self.__lock.release()
+
+    def bind(self):
+        """
+        Create the listening socket.
+
+        Raises DaemonError if another daemon is already running for this
+        repository.
+        """
+        _make_private_dir(os.path.dirname(self.socketPath))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the current user may connect to the socket
+        old_umask = os.umask(077)
+        try:
+            try:
+                sock.bind(self.socketPath)
+            except socket.error, ex:
+                if ex.errno != errno.EADDRINUSE:
+                    raise
+                if connect(self.socketPath) is not None:
+                    raise DaemonError('a daemon is already running for %s' %
+                                      (self.repo,))
+                # A stale socket left by a daemon that didn't exit cleanly
+                os.unlink(self.socketPath)
+                sock.bind(self.socketPath)
+            sock.listen(16)
+        except:
+            os.umask(old_umask)
+            sock.close()
+            raise
+        os.umask(old_umask)
+        self.__sock = sock
+
+    def serve(self):
+        """
+        Handle requests until the daemon has been idle for too long, or is
+        asked to shut down.
+        """
+        if self.__sock is None:
+            self.bind()
+        self.__sock.settimeout(1.0)
+        try:
+            while not self.__stop:
+                try:
+                    (conn, addr) = self.__sock.accept()
+                except socket.timeout:
+                    if self.__isIdle():
+                        break
+                    continue
+                except socket.error, ex:
+                    if ex.errno == errno.EINTR:
+                        continue
+                    raise
+                conn.settimeout(None)
+                self.__lock.acquire()
+                try:
+                    self.__numConnections += 1
+                    self.__lastActivity = time.time()
+                finally:
+                    self.__lock.release()
+                thread = threading.Thread(target=self.__handleConnection,
+                                          args=(conn,))
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self.__sock.close()
+            self.__sock = None
+            try:
+                os.unlink(self.socketPath)
+            except OSError:
+                pass
+
+    def __isIdle(self):
+        if self.__numConnections > 0:
+            return False
+        if self.__exitWhenIdle:
+            return True
+        return time.time() - self.__lastActivity >= self.idleTimeout
+
+
+class DaemonClient(object):
+    def __init__(self, sock):
+        self.__sock = sock
+        self.__file = sock.makefile('rb')
+
+    def close(self):
+        self.__file.close()
+        self.__sock.close()
+
+    def call(self, method, *params):
+        """
+        client.call(method, *params) --> result
+
+        Raises DaemonConnectionError if the daemon can't be reached, or
+        DaemonError if it couldn't answer the request.
+        """
+        try:
+            self.__sock.sendall(_to_json({'method': method,
+                                          'params': params}))
+            line = self.__file.readline()
+        except socket.error, ex:
+            raise DaemonConnectionError('lost connection to the daemon: %s' %
+                                        (ex,))
+        if not line:
+            raise DaemonConnectionError('lost connection to the daemon')
+        try:
+            response = _from_json(json.loads(line))
+        except ValueError:
+            raise DaemonConnectionError('invalid response from the daemon')
+        if response.has_key('error'):
+            raise DaemonError(response['error'])
+        return response['result']
+
+
+def connect(socket_path):
+    """
+    connect(socket_path) --> DaemonClient or None
+
+    Connect to the daemon listening on the specified socket.  Returns None
+    if no daemon is running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(_CONNECT_TIMEOUT)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return DaemonClient(sock)
+
+
+class DaemonRepository(object):
+    """
+    A Repository that answers queries through the daemon where possible.
+
+    All other methods are passed through to the underlying Repository.  If
+    the daemon cannot answer a query, the query is run locally instead.  If
+    the connection to the daemon is lost, it is not used again.
+    """
+    def __init__(self, repo, client):
+        self.__repo = repo
+        self.__client = client
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.__repo, name)
+
+    def __str__(self):
+        return str(self.__repo)
+
+    def close(self):
+        if self.__client is not None:
+            self.__client.close()
+            self.__client = None
+
+    def __call(self, method, *params):
+        """
+        Returns the result of the request, or None if the daemon can't
+        answer it.
+        """
+        if self.__client is None:
+            return None
+        client = self.__client
+        try:
+            return client.call(method, *params)
+        except DaemonConnectionError:
+            # Stop using the daemon if the connection was lost
+            self.__client = None
+            client.close()
+            return None
+        except DaemonError:
+            # Errors from git are reproduced by running the command locally
+            return None
+
+    def getCommitSha1(self, name, extra_args=None):
+        sha1 = self.__call('getCommitSha1', name, extra_args)
+        if sha1 is None:
+            return self.__repo.getCommitSha1(name, extra_args)
+        return sha1
+
+    def getRefs(self, glob=None):
+        refs = self.__call('getRefs', glob)
+        if refs is None:
+            return self.__repo.getRefs(glob)
+        return refs
+
+    def getRefNames(self, glob=None):
+        return sorted(self.getRefs(glob).iterkeys())
+
+    def listTree(self, commit, dirname=None, on_entries=None):
+        if commit in (git.COMMIT_WD, git.COMMIT_INDEX):
+            return self.__repo.listTree(commit, dirname, on_entries)
+        entries = self.__call('listTree', commit, dirname)
+        if entries is None:
+            return self.__repo.listTree(commit, dirname, on_entries)
+        entries = _decode_tree(entries)
+        if on_entries is not None:
+            on_entries(entries)
+        return entries
+
+    def getDiff(self, parent, child, paths=None, numstat=False):
+        if git.COMMIT_WD in (parent, child):
+            return self.__repo.getDiff(parent, child, paths=paths,
+                                       numstat=numstat)
+        entries = self.__call('getDiff', parent, child, paths, numstat)
+        if entries is None:
+            return self.__repo.getDiff(parent, child, paths=paths,
+                                       numstat=numstat)
+        return _decode_diff(parent, child, paths, entries)
+
+
+def _can_use_daemon():
+    for name in _UNSHAREABLE_ENV:
+        if os.environ.has_key(name):
+            return False
+    return True
+
+
+def get_repo(git_dir=None, working_dir=None):
+    """
+    get_repo(git_dir=None, working_dir=None) --> Repository object
+
+    Like git.get_repo(), but returns a DaemonRepository if a daemon is
+    running for the repository.
+    """
+    if not _can_use_daemon():
+        return git.get_repo(git_dir=git_dir, working_dir=working_dir)
+
+    state = {}
+
+    def load_config(git_dir):
+        client = connect(get_socket_path(git_dir))
+        if client is not None:
+            try:
+                info = client.call('ping')
+                items = client.call('getConfig')
+            except DaemonError:
+                client.close()
+            else:
+                state['client'] = client
+                state['info'] = info
+                config = git.config.Config()
+                for (name, values) in items:
+                    for value in values:
+                        config.add(name, value)
+                return config
+        return git.config.load(git_dir)
+
+    repo = git.get_repo(git_dir=git_dir, working_dir=working_dir,
+                        load_config=load_config)
+    client = state.get('client')
+    if client is None:
+        return repo
+
+    # The daemon runs git commands in its own working directory
+    info = state['info']
+    if not _same_path(info['workingDir'], repo.getWorkingDir()):
+        client.close()
+        return repo
+    return DaemonRepository(repo, client)
+
+
+def _same_path(path1, path2):
+    if path1 is None or path2 is None:
+        return path1 == path2
+    return os.path.realpath(path1) == os.path.realpath(path2)
+
+
+def start_daemon(repo):
+    """
+    Start a daemon for the repository in the background.
+
+    Returns once the daemon is accepting connections.  Raises DaemonError
+    if a daemon is already running.
+    """
+    server = DaemonServer(repo)
+    server.bind()
+
+    pid = os.fork()
+    if pid != 0:
+        # The parent.  Wait for the intermediate child, so it doesn't
+        # become a zombie.  The socket is already listening, so clients
+        # can connect immediately.
+        os.waitpid(pid, 0)
+        return
+
+    # Detach from the terminal, and fork again so the daemon isn't a
+    # session leader
+    try:
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        server.serve()
+    finally:
+        os._exit(0)
+
+
+def stop_daemon(git_dir):
+    """
+    Ask the daemon for the specified git directory to exit.
+
+    Returns False if no daemon was running.
+    """
+    client = connect(get_socket_path(git_dir))
+    if client is None:
+        return False
+    try:
+        client.call('shutdown')
+    except DaemonError:
+        pass
+    client.close()
+    return True
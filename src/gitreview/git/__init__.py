@@ -123,9 +123,10 @@ def _get_git_dir(git_dir=None, cwd=None):
         dir = parent_dir
 
 
-def get_repo(git_dir=None, working_dir=None):
+def get_repo(git_dir=None, working_dir=None, load_config=None):
     """
-    get_repo(git_dir=None) --> Repository object
+    get_repo(git_dir=None, working_dir=None, load_config=None) -->
+            Repository object
 
     Create a Repository object.  The repository is found similarly to the way
     git itself works:
@@ -134,12 +135,17 @@ def get_repo(git_dir=None, working_dir=None):
       the git directory
     - Otherwise, the current working directory and its parents are searched to
       find the git directory
+
+    load_config is called with the git directory to load the repository
+    configuration.  It defaults to config.load().
     """
     # Find the git directory and the default working directory
     (git_dir, default_working_dir) = _get_git_dir(git_dir)
 
     # Load the git configuration for this repository
-    git_config = config.load(git_dir)
+    if load_config is None:
+        load_config = config.load
+    git_config = load_config(git_dir)
 
     # If working_dir wasn't explicitly specified, but GIT_WORK_TREE is set in
     # the environment, use that.
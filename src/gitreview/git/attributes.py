@@ -0,0 +1,243 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Batch lookups of gitattributes.
+
+An AttributeChecker looks up the attributes git-review cares about for any
+number of paths with a single "git check-attr --stdin -z" command.  Results
+are cached by path.  The cache is tied to the state of the attributes files
+that apply to the cached paths: whenever one of them is created, modified,
+or removed, the whole cache is discarded.
+
+When none of the attributes files exist, every path has the default
+attributes, and no git command is run at all.
+"""
+
+import os
+import stat
+import tempfile
+import threading
+
+import gitreview.proc as proc
+
+from exceptions import *
+import constants
+
+# The attributes looked up for each path
+ATTR_GENERATED = 'linguist-generated'
+ATTR_BINARY = 'binary'
+ATTR_DIFF = 'diff'
+ATTRIBUTES = (ATTR_GENERATED, ATTR_BINARY, ATTR_DIFF)
+
+# The special values reported by "git check-attr"
+VALUE_SET = 'set'
+VALUE_UNSET = 'unset'
+VALUE_UNSPECIFIED = 'unspecified'
+
+
+class PathAttributes(object):
+    def __init__(self, values=None):
+        """
+        PathAttributes(values=None)
+
+        values is a dict of attribute name --> value, as reported by
+        "git check-attr".  Attributes that are missing are unspecified.
+        """
+        if values is None:
+            values = {}
+        generated = values.get(ATTR_GENERATED, VALUE_UNSPECIFIED)
+        binary = values.get(ATTR_BINARY, VALUE_UNSPECIFIED)
+        diff = values.get(ATTR_DIFF, VALUE_UNSPECIFIED)
+
+        # True if the file is marked as generated (e.g., a lockfile or
+        # compiler output)
+        self.generated = generated in (VALUE_SET, 'true')
+        # True if git treats the file as binary when diffing it.  The
+        # "binary" attribute is a macro for "-diff -merge -text".
+        self.binary = binary == VALUE_SET or diff == VALUE_UNSET
+        # The name of the diff driver, or None
+        if diff in (VALUE_SET, VALUE_UNSET, VALUE_UNSPECIFIED):
+            self.diffDriver = None
+        else:
+            self.diffDriver = diff
+
+    def __repr__(self):
+        return 'PathAttributes(generated=%r, binary=%r, diffDriver=%r)' % \
+                (self.generated, self.binary, self.diffDriver)
+
+
+_DEFAULT_ATTRIBUTES = PathAttributes()
+
+
+def _get_file_state(path):
+    """
+    _get_file_state(path) --> tuple, or None if path doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+class AttributeChecker(object):
+    def __init__(self, repo):
+        self.repo = repo
+        # path --> PathAttributes
+        self.__cache = {}
+        # attributes file --> _get_file_state() result, for every attributes
+        # file that may affect a cached path
+        self.__fileStates = {}
+        # Prefetch threads may look up attributes at the same time
+        self.__lock = threading.Lock()
+
+    def check(self, paths):
+        """
+        checker.check(paths) --> dict of path --> PathAttributes
+
+        Look up the attributes of a list of paths, which are relative to the
+        top of the repository.
+        """
+        self.__lock.acquire()
+        try:
+            self.__checkFileStates(paths)
+
+            results = {}
+            unknown = []
+            for path in paths:
+                try:
+                    results[path] = self.__cache[path]
+                except KeyError:
+                    if not results.has_key(path):
+                        unknown.append(path)
+                        results[path] = _DEFAULT_ATTRIBUTES
+
+            if unknown:
+                if self.__hasAttributesFiles():
+                    new_results = self.__runCheckAttr(unknown)
+                else:
+                    new_results = dict([(path, _DEFAULT_ATTRIBUTES)
+                                        for path in unknown])
+                self.__cache.update(new_results)
+                results.update(new_results)
+            return results
+        finally:
+            self.__lock.release()
+
+    def checkOne(self, path):
+        """
+        checker.checkOne(path) --> PathAttributes
+        """
+        return self.check([path])[path]
+
+    def clearCache(self):
+        self.__lock.acquire()
+        try:
+            self.__cache = {}
+            self.__fileStates = {}
+        finally:
+            self.__lock.release()
+
+    def __getAttributesFiles(self, paths):
+        """
+        Get the attributes files that can affect the specified paths, other
+        than the system-wide file, whose location depends on how git was
+        built.
+        """
+        files = set()
+        try:
+            attrs_file = self.repo.config.get('core.attributesfile')
+            files.add(os.path.expanduser(attrs_file))
+        except NoSuchConfigError:
+            config_home = os.environ.get('XDG_CONFIG_HOME')
+            if not config_home:
+                config_home = os.path.expanduser('~/.config')
+            files.add(os.path.join(config_home, 'git', 'attributes'))
+        files.add(os.path.join(self.repo.getGitDir(), 'info', 'attributes'))
+
+        # .gitattributes files are read from the working directory, in every
+        # directory containing one of the paths
+        work_dir = self.repo.getWorkingDir()
+        if work_dir is not None:
+            dirs = set([''])
+            for path in paths:
+                dirname = os.path.dirname(path)
+                while dirname not in dirs:
+                    dirs.add(dirname)
+                    dirname = os.path.dirname(dirname)
+            for dirname in dirs:
+                files.add(os.path.join(work_dir, dirname, '.gitattributes'))
+        return files
+
+    def __checkFileStates(self, paths):
+        """
+        Record the state of the attributes files for the specified paths.
+        If any file seen before has changed, clear the cache.
+        """
+        changed = False
+        for attrs_file in self.__getAttributesFiles(paths):
+            state = _get_file_state(attrs_file)
+            try:
+                if self.__fileStates[attrs_file] != state:
+                    changed = True
+            except KeyError:
+                # No cached path depends on this file yet
+                pass
+            self.__fileStates[attrs_file] = state
+
+        if changed:
+            self.__cache = {}
+
+    def __hasAttributesFiles(self):
+        for state in self.__fileStates.itervalues():
+            if state is not None:
+                return True
+        return False
+
+    def __runCheckAttr(self, paths):
+        # Write the paths to a temporary file rather than a pipe.  git
+        # writes its results while it is still reading paths, so writing a
+        # long list to a pipe could deadlock once both pipes fill up.
+        input_file = tempfile.TemporaryFile()
+        try:
+            input_file.write(''.join([path + '\0' for path in paths]))
+            input_file.seek(0)
+            cmd = ['check-attr', '--stdin', '-z'] + list(ATTRIBUTES)
+            p = self.repo.popenGitCmd(cmd, stdin=input_file)
+            # Read stdout and stderr together, so git can't block writing
+            # to one while we wait for the other
+            (cmd_out, cmd_err) = p.communicate()
+            status = p.wait()
+        finally:
+            input_file.close()
+        proc.check_status([constants.GIT_EXE] + cmd, status,
+                          cmd_err=cmd_err)
+
+        # The output is a sequence of "<path> NUL <attribute> NUL <value>
+        # NUL" records
+        values = {}
+        fields = cmd_out.split('\0')
+        for n in range(0, len(fields) - 2, 3):
+            (path, attr, value) = fields[n:n + 3]
+            values.setdefault(path, {})[attr] = value
+
+        results = {}
+        for path in paths:
+            results[path] = PathAttributes(values.get(path))
+        return results
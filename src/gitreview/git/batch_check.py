@@ -0,0 +1,180 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Object lookups through a long-running "git cat-file --batch-check" process.
+
+Checking whether a name refers to a revision, or finding the type of an
+object, would otherwise run a separate git command for each name.  A
+BatchChecker starts one "git cat-file --batch-check" process the first time
+it is used, and sends it every later lookup, so any number of names can be
+checked without starting another process.
+
+Results are cached by name.  Names such as branch names and index paths can
+change meaning when the repository is modified, so clearCache() should be
+called whenever that may have happened.  Results for full SHA1s never
+change, and are kept.
+"""
+
+import re
+import subprocess
+import threading
+
+import gitreview.proc as proc
+
+from exceptions import *
+
+# The number of names written to the process before reading the results.
+# This keeps both pipes from filling up, which would deadlock.
+_CHUNK_SIZE = 256
+
+_SHA1_RE = re.compile('^[0-9a-f]{40}$')
+
+
+class ObjectInfo(object):
+    def __init__(self, sha1, type, size):
+        self.sha1 = sha1
+        self.type = type
+        self.size = size
+
+    def __repr__(self):
+        return 'ObjectInfo(%r, %r, %r)' % (self.sha1, self.type, self.size)
+
+
+def can_check(name):
+    """
+    can_check(name) --> bool
+
+    Returns False for names that can't be sent to "git cat-file
+    --batch-check", since it reads one name per line.
+    """
+    return bool(name) and '\n' not in name and name.strip() == name
+
+
+class BatchChecker(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.__process = None
+        # name --> ObjectInfo, or None if the object doesn't exist
+        self.__cache = {}
+        # Prefetch and completion threads may check names at the same time
+        self.__lock = threading.Lock()
+
+    def check(self, names):
+        """
+        checker.check(names) --> dict of name --> ObjectInfo or None
+
+        Look up a list of object names.  Names that don't refer to an
+        object map to None.  All of the names must pass can_check().
+        """
+        self.__lock.acquire()
+        try:
+            results = {}
+            unknown = []
+            for name in names:
+                try:
+                    results[name] = self.__cache[name]
+                except KeyError:
+                    if not results.has_key(name):
+                        unknown.append(name)
+                        results[name] = None
+
+            for start in range(0, len(unknown), _CHUNK_SIZE):
+                chunk = unknown[start:start + _CHUNK_SIZE]
+                for (name, info) in zip(chunk, self.__checkChunk(chunk)):
+                    # Objects can be written while we run (for example, by
+                    # a snapshot), so don't remember missing SHA1s
+                    if info is not None or not _SHA1_RE.match(name):
+                        self.__cache[name] = info
+                    results[name] = info
+            return results
+        finally:
+            self.__lock.release()
+
+    def checkOne(self, name):
+        """
+        checker.checkOne(name) --> ObjectInfo or None
+        """
+        return self.check([name])[name]
+
+    def clearCache(self):
+        """
+        Forget the results for everything except full SHA1s.
+        """
+        self.__lock.acquire()
+        try:
+            cache = {}
+            for (name, info) in self.__cache.iteritems():
+                if _SHA1_RE.match(name):
+                    cache[name] = info
+            self.__cache = cache
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        self.__lock.acquire()
+        try:
+            self.__stop()
+        finally:
+            self.__lock.release()
+
+    def __start(self):
+        cmd = ['cat-file', '--batch-check']
+        self.__process = self.repo.popenGitCmd(cmd, stdin=subprocess.PIPE,
+                                               stderr='/dev/null')
+
+    def __stop(self):
+        if self.__process is None:
+            return
+        p = self.__process
+        self.__process = None
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+        p.wait()
+
+    def __checkChunk(self, names):
+        if self.__process is None:
+            self.__start()
+        try:
+            return self.__communicate(names)
+        except (IOError, proc.CmdFailedError):
+            # The process may have exited since it was last used.
+            # Start a new one, and try once more.
+            self.__stop()
+            self.__start()
+            return self.__communicate(names)
+
+    def __communicate(self, names):
+        p = self.__process
+        p.stdin.write(''.join([name + '\n' for name in names]))
+        p.stdin.flush()
+
+        results = []
+        for name in names:
+            line = p.stdout.readline()
+            if not line:
+                raise proc.CmdFailedError(['git', 'cat-file', '--batch-check'],
+                                          'unexpected end of output')
+            fields = line.rstrip('\n').split(' ')
+            if len(fields) == 3 and _SHA1_RE.match(fields[0]):
+                results.append(ObjectInfo(fields[0], fields[1],
+                                          int(fields[2])))
+            else:
+                # "<name> missing", or "<name> ambiguous"
+                results.append(None)
+        return results
@@ -16,14 +16,21 @@
 #
 import datetime
 import os
+import subprocess
 import time
 
 import gitreview.proc as proc
 
 from exceptions import *
+import commit_cache
 import constants
 import obj as git_obj
 
+# The number of SHA1s written to "git cat-file --batch" before reading the
+# results.  The names for one chunk easily fit in the pipe to git, so
+# writing them never blocks while git is waiting for us to read its output.
+_BATCH_CHUNK_SIZE = 64
+
 
 class GitTimezone(datetime.tzinfo):
     """
@@ -34,10 +41,14 @@ class GitTimezone(datetime.tzinfo):
         self.name = tz_str
 
         tz = int(tz_str)
-        min_offset = tz % 100
-        hour_offset = tz / 100
+        # Split the absolute value, so that "-0130" is 90 minutes behind UTC
+        # rather than 50
+        min_offset = abs(tz) % 100
+        hour_offset = abs(tz) / 100
         self.offset = datetime.timedelta(hours = hour_offset,
                                          minutes = min_offset)
+        if tz < 0:
+            self.offset = -self.offset
 
     def utcoffset(self, dt):
         return self.offset
@@ -49,6 +60,23 @@ class GitTimezone(datetime.tzinfo):
         return self.name
 
 
+# Timezone string --> GitTimezone
+_timezones = {}
+
+def get_timezone(tz_str):
+    """
+    get_timezone(tz_str) --> GitTimezone
+
+    Get the GitTimezone object for a "+HHMM" or "-HHMM" string.  The same
+    object is returned for every timestamp in a given timezone.
+    """
+    tz = _timezones.get(tz_str)
+    if tz is None:
+        tz = GitTimezone(tz_str)
+        _timezones[tz_str] = tz
+    return tz
+
+
 class AuthorInfo(object):
     """
     An AuthorInfo object represents the committer or author information
@@ -119,9 +147,10 @@ def _parse_timestamp(value):
     (timestamp_str, tz_str) = value.split(' ', 1)
 
     timestamp = int(timestamp_str)
-    tz = GitTimezone(tz_str)
+    # Check that the timezone is valid
+    get_timezone(tz_str)
 
-    return datetime.datetime.fromtimestamp(timestamp, tz)
+    return (timestamp, tz_str)
 
 
 def _parse_author(commit_name, value, type):
@@ -138,12 +167,12 @@ def _parse_author(commit_name, value, type):
         raise BadCommitError(commit_name, msg)
 
     try:
-        timestamp = _parse_timestamp(rest)
+        (timestamp, tz_str) = _parse_timestamp(rest)
     except ValueError:
         msg = 'error parsing %s: malformatted timestamp' % (type,)
         raise BadCommitError(commit_name, msg)
 
-    return AuthorInfo(real_name, email, timestamp)
+    return (real_name, email, timestamp, tz_str)
 
 
 def _parse_header(commit_name, header):
@@ -205,7 +234,7 @@ def _get_current_tzinfo():
     if tz_sec > 0:
         tz_hour *= -1
     tz_str = '%+02d%02d' % (tz_hour, tz_min)
-    return GitTimezone(tz_str)
+    return get_timezone(tz_str)
 
 
 def _get_bogus_author():
@@ -256,20 +285,27 @@ def get_working_dir_commit(repo):
                   comment)
 
 
-def get_commit(repo, name):
-    # Handle the special internal commit names COMMIT_INDEX and COMMIT_WD
-    if name == constants.COMMIT_INDEX:
-        return get_index_commit(repo)
-    elif name == constants.COMMIT_WD:
-        return get_working_dir_commit(repo)
+def _get_author_info(name, email, timestamp, tz_str):
+    tz = get_timezone(tz_str)
+    return AuthorInfo(name, email,
+                      datetime.datetime.fromtimestamp(timestamp, tz))
+
 
-    # Get the SHA1 value for this commit.
-    sha1 = repo.getCommitSha1(name)
+def _commit_from_record(repo, record):
+    author = _get_author_info(record.authorName, record.authorEmail,
+                              record.authorTime, record.authorTz)
+    committer = _get_author_info(record.committerName, record.committerEmail,
+                                 record.committerTime, record.committerTz)
+    return Commit(repo, record.sha1, record.tree, list(record.parents),
+                  author, committer, record.comment)
 
-    # Run "git cat-file commit <name>"
-    cmd = ['cat-file', 'commit', str(name)]
-    out = repo.runSimpleGitCmd(cmd)
 
+def _parse_commit(name, sha1, out):
+    """
+    _parse_commit(name, sha1, out) --> CommitRecord
+
+    Parse the contents of a commit object.
+    """
     # Split the header and body
     try:
         (header, body) = out.split('\n\n', 1)
@@ -284,7 +320,98 @@ def get_commit(repo, name):
     # Parse the header
     (tree, parents, author, committer) = _parse_header(name, header)
 
-    return Commit(repo, sha1, tree, parents, author, committer, body)
+    args = [sha1, tree, parents] + list(author) + list(committer) + [body]
+    return commit_cache.CommitRecord(*args)
+
+
+def get_commit(repo, name):
+    # Handle the special internal commit names COMMIT_INDEX and COMMIT_WD
+    if name == constants.COMMIT_INDEX:
+        return get_index_commit(repo)
+    elif name == constants.COMMIT_WD:
+        return get_working_dir_commit(repo)
+
+    return repo.getCommits([name])[0]
+
+
+def _is_sha1(name):
+    if len(name) != 40:
+        return False
+    try:
+        int(name, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _read_commits(repo, sha1s):
+    """
+    _read_commits(repo, sha1s) --> list of CommitRecord
+
+    Read and parse many commits with a single "git cat-file --batch"
+    command.
+    """
+    records = []
+    p = repo.popenGitCmd(['cat-file', '--batch'], stdin=subprocess.PIPE,
+                         stderr='/dev/null')
+    try:
+        for start in range(0, len(sha1s), _BATCH_CHUNK_SIZE):
+            chunk = sha1s[start:start + _BATCH_CHUNK_SIZE]
+            p.stdin.write(''.join([sha1 + '\n' for sha1 in chunk]))
+            p.stdin.flush()
+            for sha1 in chunk:
+                fields = p.stdout.readline().rstrip('\n').split(' ')
+                if len(fields) != 3 or fields[1] != 'commit':
+                    raise NoSuchCommitError(sha1)
+                size = int(fields[2])
+                out = p.stdout.read(size)
+                # Skip the newline after the contents
+                p.stdout.read(1)
+                records.append(_parse_commit(sha1, sha1, out))
+    finally:
+        # Read any output left over after an error, so git can exit
+        p.stdin.close()
+        p.stdout.read()
+        p.wait()
+    return records
+
+
+def get_commits(repo, names):
+    """
+    get_commits(repo, names) --> list of Commit
+
+    Get Commit objects for many commits at once.  Commits are read from the
+    commit cache where possible.  The remainder are read with a single
+    "git cat-file --batch" command, and added to the cache.
+    """
+    # Resolve every name except the SHA1s of cached commits.  Other SHA1s
+    # may name tags, which getCommitSha1s() peels to the tagged commit.
+    cache = repo.getCommitCache()
+    sha1s = list(names)
+    to_resolve = [n for n in range(len(sha1s))
+                  if not _is_sha1(sha1s[n]) or cache.get(sha1s[n]) is None]
+    if to_resolve:
+        resolved = repo.getCommitSha1s([sha1s[n] for n in to_resolve])
+        for (n, sha1) in zip(to_resolve, resolved):
+            sha1s[n] = sha1
+
+    records = {}
+    missing = []
+    for sha1 in sha1s:
+        if records.has_key(sha1):
+            continue
+        record = cache.get(sha1)
+        if record is None:
+            missing.append(sha1)
+        records[sha1] = record
+
+    if missing:
+        for record in _read_commits(repo, missing):
+            cache.add(record)
+            records[record.sha1] = record
+        cache.maybeSave()
+
+    return [_commit_from_record(repo, records[sha1]) for sha1 in sha1s]
 
 
 def split_rev_name(name):
@@ -0,0 +1,461 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A persistent cache of parsed commit information.
+
+Commit objects never change, so once a commit has been parsed the results
+can be kept forever.  The cache is stored in $GIT_DIR/git-review/commit-cache
+and is shared by all git-review processes using the repository.
+
+The file is mapped into memory, and is laid out in columns rather than
+records, so looking up a commit only touches the columns that are needed.
+All integers are little-endian.
+
+    header          magic, version, commit count, parent count, string count
+    fanout          256 uint32s, as in git's pack index files
+    sha1            20 bytes per commit, sorted
+    tree            20 bytes per commit
+    parent index    uint32 per commit, plus one, into the parent column
+    parent          20 bytes per parent
+    author name     uint32 string number per commit
+    author email    uint32 string number per commit
+    author tz       uint32 string number per commit
+    committer name, committer email, committer tz
+                    as for the author
+    comment         uint32 string number per commit
+    author time     int64 per commit
+    committer time  int64 per commit
+    string index    uint32 offset per string, plus one, into the string data
+    string data
+
+Strings are stored only once, so names, email addresses, and timezones that
+appear in many commits take little space.
+"""
+
+import atexit
+import binascii
+import errno
+import mmap
+import os
+import struct
+import tempfile
+
+from exceptions import *
+
+MAGIC = 'GRCC'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sIIII')
+_UINT32 = struct.Struct('<I')
+_INT64 = struct.Struct('<q')
+_HASH_LEN = 20
+
+# Columns holding one uint32 string number per commit, in file order
+_AUTHOR_NAME = 0
+_AUTHOR_EMAIL = 1
+_AUTHOR_TZ = 2
+_COMMITTER_NAME = 3
+_COMMITTER_EMAIL = 4
+_COMMITTER_TZ = 5
+_COMMENT = 6
+
+# Don't add more commits than this to the cache file
+_MAX_COMMITS = 500000
+
+# maybeSave() only saves once at least this many commits are pending
+_SAVE_BATCH_SIZE = 1024
+
+
+class CommitRecord(object):
+    """
+    The cached information about a single commit.
+
+    Timestamps are in seconds since the epoch.  Timezones are strings of the
+    form "+HHMM" or "-HHMM".  All other fields are exactly as they appear in
+    the commit object.
+    """
+    __slots__ = ('sha1', 'tree', 'parents',
+                 'authorName', 'authorEmail', 'authorTime', 'authorTz',
+                 'committerName', 'committerEmail', 'committerTime',
+                 'committerTz', 'comment')
+
+    def __init__(self, sha1, tree, parents,
+                 author_name, author_email, author_time, author_tz,
+                 committer_name, committer_email, committer_time,
+                 committer_tz, comment):
+        self.sha1 = sha1
+        self.tree = tree
+        self.parents = parents
+        self.authorName = author_name
+        self.authorEmail = author_email
+        self.authorTime = author_time
+        self.authorTz = author_tz
+        self.committerName = committer_name
+        self.committerEmail = committer_email
+        self.committerTime = committer_time
+        self.committerTz = committer_tz
+        self.comment = comment
+
+
+class _Layout(object):
+    """
+    The offsets of each column in a cache file.
+    """
+    def __init__(self, num_commits, num_parents, num_strings):
+        self.numCommits = num_commits
+        self.numParents = num_parents
+        self.numStrings = num_strings
+
+        offset = _HEADER.size
+        self.fanout = offset
+        offset += 256 * 4
+        self.sha1 = offset
+        offset += num_commits * _HASH_LEN
+        self.tree = offset
+        offset += num_commits * _HASH_LEN
+        self.parentIndex = offset
+        offset += (num_commits + 1) * 4
+        self.parent = offset
+        offset += num_parents * _HASH_LEN
+
+        # The string number columns, in the order of the _AUTHOR_NAME etc.
+        # constants
+        self.strings = []
+        for n in range(_COMMENT + 1):
+            self.strings.append(offset)
+            offset += num_commits * 4
+        self.authorTime = offset
+        offset += num_commits * 8
+        self.committerTime = offset
+        offset += num_commits * 8
+
+        self.stringIndex = offset
+        offset += (num_strings + 1) * 4
+        self.stringData = offset
+
+
+class CommitCache(object):
+    """
+    A cache of parsed commits, keyed by SHA1.
+
+    Lookups are served from the memory-mapped cache file.  Commits added with
+    add() are kept in memory until save() is called, which merges them into
+    the file.  Saving rewrites the whole file, so callers that add commits
+    one at a time should use maybeSave() instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__data = None
+        self.__layout = None
+        # Commits that have been added, but not yet saved.
+        # binary SHA1 --> CommitRecord
+        self.__pending = {}
+        self.__load()
+
+    def __load(self):
+        self.close()
+        try:
+            f = open(self.path, 'rb')
+        except IOError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                # An empty file can't be mapped
+                return
+        finally:
+            f.close()
+
+        if len(data) < _HEADER.size:
+            data.close()
+            return
+        (magic, version, num_commits, num_parents, num_strings) = \
+                _HEADER.unpack_from(data, 0)
+        layout = _Layout(num_commits, num_parents, num_strings)
+        if magic != MAGIC or version != VERSION or \
+                len(data) < layout.stringData:
+            # Ignore caches written by a different version, or that are
+            # damaged.  They will be replaced the next time we save.
+            data.close()
+            return
+        string_len = _UINT32.unpack_from(data, layout.stringIndex +
+                                         num_strings * 4)[0]
+        if len(data) < layout.stringData + string_len:
+            data.close()
+            return
+
+        self.__data = data
+        self.__layout = layout
+
+    def close(self):
+        if self.__data is not None:
+            self.__data.close()
+        self.__data = None
+        self.__layout = None
+
+    def __len__(self):
+        if self.__layout is None:
+            num_commits = 0
+        else:
+            num_commits = self.__layout.numCommits
+        return num_commits + len(self.__pending)
+
+    def __find(self, oid):
+        """
+        Return the position of the binary SHA1 oid in the file,
+        or -1 if the file does not contain it.
+        """
+        data = self.__data
+        layout = self.__layout
+        if data is None:
+            return -1
+
+        first_byte = ord(oid[0])
+        if first_byte == 0:
+            lo = 0
+        else:
+            lo = _UINT32.unpack_from(data, layout.fanout +
+                                     (first_byte - 1) * 4)[0]
+        hi = _UINT32.unpack_from(data, layout.fanout + first_byte * 4)[0]
+
+        base = layout.sha1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * _HASH_LEN
+            value = data[start:start + _HASH_LEN]
+            if value < oid:
+                lo = mid + 1
+            elif value > oid:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def __getString(self, column, pos):
+        data = self.__data
+        layout = self.__layout
+        num = _UINT32.unpack_from(data, layout.strings[column] + pos * 4)[0]
+        (start, end) = struct.unpack_from('<II', data,
+                                          layout.stringIndex + num * 4)
+        return data[layout.stringData + start:layout.stringData + end]
+
+    def __getHash(self, offset):
+        return binascii.hexlify(self.__data[offset:offset + _HASH_LEN])
+
+    def __getRecord(self, pos):
+        data = self.__data
+        layout = self.__layout
+
+        (parent_start, parent_end) = \
+                struct.unpack_from('<II', data, layout.parentIndex + pos * 4)
+        parents = [self.__getHash(layout.parent + n * _HASH_LEN)
+                   for n in range(parent_start, parent_end)]
+
+        author_time = _INT64.unpack_from(data, layout.authorTime + pos * 8)[0]
+        committer_time = _INT64.unpack_from(data, layout.committerTime +
+                                            pos * 8)[0]
+
+        get_string = self.__getString
+        return CommitRecord(self.__getHash(layout.sha1 + pos * _HASH_LEN),
+                            self.__getHash(layout.tree + pos * _HASH_LEN),
+                            parents,
+                            get_string(_AUTHOR_NAME, pos),
+                            get_string(_AUTHOR_EMAIL, pos),
+                            author_time,
+                            get_string(_AUTHOR_TZ, pos),
+                            get_string(_COMMITTER_NAME, pos),
+                            get_string(_COMMITTER_EMAIL, pos),
+                            committer_time,
+                            get_string(_COMMITTER_TZ, pos),
+                            get_string(_COMMENT, pos))
+
+    def get(self, sha1):
+        """
+        cache.get(sha1) --> CommitRecord or None
+
+        Look up a commit by its hexadecimal SHA1.
+        Returns None if the commit is not in the cache.
+        """
+        try:
+            oid = binascii.unhexlify(sha1)
+        except TypeError:
+            return None
+        if len(oid) != _HASH_LEN:
+            return None
+
+        record = self.__pending.get(oid)
+        if record is not None:
+            return record
+        pos = self.__find(oid)
+        if pos < 0:
+            return None
+        return self.__getRecord(pos)
+
+    def add(self, record):
+        """
+        Add a commit to the cache.  It won't be written to disk until save()
+        is called.
+        """
+        oid = binascii.unhexlify(record.sha1)
+        if self.__find(oid) >= 0:
+            return
+        self.__pending[oid] = record
+
+    def __getAllRecords(self):
+        records = {}
+        if self.__layout is not None:
+            for pos in range(self.__layout.numCommits):
+                record = self.__getRecord(pos)
+                records[binascii.unhexlify(record.sha1)] = record
+        records.update(self.__pending)
+        return records
+
+    def maybeSave(self):
+        """
+        Save the pending commits if there are enough of them to be worth
+        rewriting the cache file for.  Any that are left are saved when the
+        process exits.
+        """
+        if len(self.__pending) >= _SAVE_BATCH_SIZE:
+            self.save()
+
+    def save(self):
+        """
+        Merge the commits added since the last save into the cache file.
+        """
+        if not self.__pending:
+            return
+        if self.__layout is not None and \
+                self.__layout.numCommits >= _MAX_COMMITS:
+            self.__pending = {}
+            return
+
+        # Another process may have saved new commits since we loaded the
+        # file.  Merge with the current contents, so they aren't lost.
+        pending = self.__pending
+        self.__load()
+        self.__pending = pending
+        records = self.__getAllRecords()
+
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            (fd, tmp_path) = tempfile.mkstemp(dir=dirname,
+                                              prefix='.commit-cache-')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    _write_cache(f, records)
+                finally:
+                    f.close()
+                os.rename(tmp_path, self.path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError):
+            # The cache is only an optimization.  If we can't write to the
+            # git directory, just keep the pending commits in memory.
+            return
+
+        self.__pending = {}
+        self.__load()
+
+
+def _write_cache(f, records):
+    oids = records.keys()
+    oids.sort()
+
+    strings = []
+    string_nums = {}
+    def intern(value):
+        num = string_nums.get(value)
+        if num is None:
+            num = len(strings)
+            string_nums[value] = num
+            strings.append(value)
+        return num
+
+    fanout = [0] * 256
+    trees = []
+    parent_index = []
+    parents = []
+    string_columns = [[] for n in range(_COMMENT + 1)]
+    author_times = []
+    committer_times = []
+    for oid in oids:
+        record = records[oid]
+        fanout[ord(oid[0])] += 1
+        trees.append(binascii.unhexlify(record.tree))
+        parent_index.append(len(parents))
+        parents.extend([binascii.unhexlify(p) for p in record.parents])
+        string_columns[_AUTHOR_NAME].append(intern(record.authorName))
+        string_columns[_AUTHOR_EMAIL].append(intern(record.authorEmail))
+        string_columns[_AUTHOR_TZ].append(intern(record.authorTz))
+        string_columns[_COMMITTER_NAME].append(intern(record.committerName))
+        string_columns[_COMMITTER_EMAIL].append(
+                intern(record.committerEmail))
+        string_columns[_COMMITTER_TZ].append(intern(record.committerTz))
+        string_columns[_COMMENT].append(intern(record.comment))
+        author_times.append(record.authorTime)
+        committer_times.append(record.committerTime)
+    parent_index.append(len(parents))
+
+    total = 0
+    for n in range(256):
+        total += fanout[n]
+        fanout[n] = total
+
+    string_index = []
+    offset = 0
+    for value in strings:
+        string_index.append(offset)
+        offset += len(value)
+    string_index.append(offset)
+
+    def write_ints(fmt, values):
+        f.write(struct.pack('<%d%s' % (len(values), fmt), *values))
+
+    f.write(_HEADER.pack(MAGIC, VERSION, len(oids), len(parents),
+                         len(strings)))
+    write_ints('I', fanout)
+    f.write(''.join(oids))
+    f.write(''.join(trees))
+    write_ints('I', parent_index)
+    f.write(''.join(parents))
+    for column in string_columns:
+        write_ints('I', column)
+    write_ints('q', author_times)
+    write_ints('q', committer_times)
+    write_ints('I', string_index)
+    f.write(''.join(strings))
+
+
+def get_cache(repo):
+    """
+    get_cache(repo) --> CommitCache
+
+    Open the commit cache for the specified repository.
+    """
+    path = os.path.join(repo.getGitDir(), 'git-review', 'commit-cache')
+    cache = CommitCache(path)
+    # Save any commits that were added, but never saved by maybeSave()
+    atexit.register(cache.save)
+    return cache
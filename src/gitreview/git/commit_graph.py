@@ -0,0 +1,486 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A reader for git's commit-graph files.
+
+The commit-graph file (objects/info/commit-graph, or a chain of files in
+objects/info/commit-graphs/) stores the parents and generation number of
+every commit it contains.  This allows ancestry queries to be answered
+in-process, without running "git rev-list" and buffering its output.
+
+See Documentation/technical/commit-graph-format.txt in the git sources for
+details of the file format.
+"""
+import binascii
+import heapq
+import mmap
+import os
+import struct
+
+from exceptions import *
+
+SIGNATURE = 'CGPH'
+HASH_VERSION_SHA1 = 1
+HASH_LEN = 20
+
+CHUNK_OID_FANOUT = 'OIDF'
+CHUNK_OID_LOOKUP = 'OIDL'
+CHUNK_COMMIT_DATA = 'CDAT'
+CHUNK_EXTRA_EDGES = 'EDGE'
+
+PARENT_NONE = 0x70000000
+EDGE_FLAG = 0x80000000
+EDGE_MASK = 0x7fffffff
+
+# Flags used while walking the graph
+_FLAG_CHILD = 0x1
+_FLAG_PARENT = 0x2
+_FLAG_STALE = 0x4
+
+
+class CommitGraphError(GitError):
+    pass
+
+
+class _GraphFile(object):
+    """
+    A single commit-graph file, mapped into memory.
+
+    Positions are local to this file.  CommitGraph converts between local and
+    global positions when files are chained together.
+    """
+    def __init__(self, path, base_count):
+        self.path = path
+        self.baseCount = base_count
+
+        f = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        self.__parseHeader()
+
+    def __parseHeader(self):
+        data = self.data
+        if len(data) < 8 or data[0:4] != SIGNATURE:
+            raise CommitGraphError('%s: bad commit-graph signature' %
+                                   (self.path,))
+        (version, hash_version, num_chunks, num_bases) = \
+                struct.unpack_from('>BBBB', data, 4)
+        if version != 1:
+            raise CommitGraphError('%s: unsupported commit-graph version %d' %
+                                   (self.path, version))
+        if hash_version != HASH_VERSION_SHA1:
+            raise CommitGraphError('%s: unsupported hash version %d' %
+                                   (self.path, hash_version))
+        self.numBases = num_bases
+
+        # The chunk lookup table has one extra entry, marking the end of the
+        # last chunk.
+        chunks = {}
+        offset = 8
+        prev_id = None
+        for n in range(num_chunks + 1):
+            (chunk_id, chunk_offset) = struct.unpack_from('>4sQ', data, offset)
+            if prev_id is not None:
+                chunks[prev_id] = (chunks[prev_id], chunk_offset)
+            if n < num_chunks:
+                chunks[chunk_id] = chunk_offset
+            prev_id = chunk_id
+            offset += 12
+
+        for chunk_id in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP,
+                         CHUNK_COMMIT_DATA):
+            if not chunks.has_key(chunk_id):
+                raise CommitGraphError('%s: missing %s chunk' %
+                                       (self.path, chunk_id))
+
+        self.fanoutOffset = chunks[CHUNK_OID_FANOUT][0]
+        self.oidOffset = chunks[CHUNK_OID_LOOKUP][0]
+        self.dataOffset = chunks[CHUNK_COMMIT_DATA][0]
+        if chunks.has_key(CHUNK_EXTRA_EDGES):
+            self.edgeOffset = chunks[CHUNK_EXTRA_EDGES][0]
+        else:
+            self.edgeOffset = None
+
+        self.numCommits = struct.unpack_from('>I', data,
+                                             self.fanoutOffset + 255 * 4)[0]
+
+    def close(self):
+        self.data.close()
+
+    def find(self, oid):
+        """
+        Return the local position of the binary object ID oid,
+        or -1 if this file does not contain it.
+        """
+        data = self.data
+        first_byte = ord(oid[0])
+        if first_byte == 0:
+            lo = 0
+        else:
+            lo_offset = self.fanoutOffset + (first_byte - 1) * 4
+            lo = struct.unpack_from('>I', data, lo_offset)[0]
+        hi = struct.unpack_from('>I', data,
+                                self.fanoutOffset + first_byte * 4)[0]
+
+        base = self.oidOffset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * HASH_LEN
+            value = data[start:start + HASH_LEN]
+            if value < oid:
+                lo = mid + 1
+            elif value > oid:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def getOid(self, pos):
+        start = self.oidOffset + pos * HASH_LEN
+        return self.data[start:start + HASH_LEN]
+
+    def getCommitData(self, pos):
+        """
+        Return a tuple of (parent1, parent2, generation) for the commit at the
+        specified local position.  Parent values are returned exactly as
+        stored in the file.
+        """
+        offset = self.dataOffset + pos * (HASH_LEN + 16) + HASH_LEN
+        (parent1, parent2, gen_and_date) = \
+                struct.unpack_from('>III', self.data, offset)
+        # The topological level is stored in the upper 30 bits
+        generation = gen_and_date >> 2
+        return (parent1, parent2, generation)
+
+    def getExtraEdges(self, index):
+        if self.edgeOffset is None:
+            raise CommitGraphError('%s: octopus merge without an %s chunk' %
+                                   (self.path, CHUNK_EXTRA_EDGES))
+        edges = []
+        offset = self.edgeOffset + index * 4
+        while True:
+            value = struct.unpack_from('>I', self.data, offset)[0]
+            edges.append(value & EDGE_MASK)
+            if value & EDGE_FLAG:
+                return edges
+            offset += 4
+
+
+class CommitGraph(object):
+    """
+    An in-memory view of a repository's commit-graph.
+
+    Commits are identified by their global position in the graph.  Use
+    lookup() to convert a SHA1 to a position, and getSha1() to convert back.
+    """
+    def __init__(self, files):
+        # files is ordered from the base of the chain to the tip
+        self.files = files
+        self.numCommits = 0
+        for f in files:
+            self.numCommits += f.numCommits
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+
+    def __len__(self):
+        return self.numCommits
+
+    def __contains__(self, sha1):
+        return self.lookup(sha1) >= 0
+
+    def __getFile(self, pos):
+        # The chain is usually only a few files long, so a linear search is
+        # fine here.
+        for f in reversed(self.files):
+            if pos >= f.baseCount:
+                return f
+        raise IndexError(pos)
+
+    def lookup(self, sha1):
+        """
+        graph.lookup(sha1) --> position
+
+        Returns the position of the commit with the specified hex SHA1, or -1
+        if the commit is not in the graph.
+        """
+        try:
+            oid = binascii.unhexlify(sha1)
+        except (TypeError, binascii.Error):
+            return -1
+        if len(oid) != HASH_LEN:
+            return -1
+
+        # Newer files are at the end of the chain; search them first.
+        for f in reversed(self.files):
+            pos = f.find(oid)
+            if pos >= 0:
+                return f.baseCount + pos
+        return -1
+
+    def getSha1(self, pos):
+        f = self.__getFile(pos)
+        return binascii.hexlify(f.getOid(pos - f.baseCount))
+
+    def getGeneration(self, pos):
+        f = self.__getFile(pos)
+        return f.getCommitData(pos - f.baseCount)[2]
+
+    def getParents(self, pos):
+        """
+        graph.getParents(pos) --> list of positions
+        """
+        f = self.__getFile(pos)
+        (parent1, parent2, generation) = f.getCommitData(pos - f.baseCount)
+        if parent1 == PARENT_NONE:
+            return []
+        if parent2 == PARENT_NONE:
+            return [parent1]
+        if parent2 & EDGE_FLAG:
+            return [parent1] + f.getExtraEdges(parent2 & EDGE_MASK)
+        return [parent1, parent2]
+
+    def hasGenerations(self):
+        """
+        Graphs written by very old versions of git store a generation number
+        of zero for every commit.  Such graphs can't be used for pruning.
+        """
+        if not self.numCommits:
+            return True
+        return self.getGeneration(0) != 0
+
+    def isAncestor(self, ancestor, descendant):
+        """
+        graph.isAncestor(ancestor, descendant) --> bool
+
+        Returns True if the commit at position ancestor is reachable from the
+        commit at position descendant.  (A commit is considered its own
+        ancestor.)
+        """
+        if ancestor == descendant:
+            return True
+
+        min_gen = self.getGeneration(ancestor)
+        seen = set([descendant])
+        stack = [descendant]
+        while stack:
+            pos = stack.pop()
+            for parent in self.getParents(pos):
+                if parent == ancestor:
+                    return True
+                if parent in seen:
+                    continue
+                seen.add(parent)
+                # Commits with a generation number no greater than the
+                # ancestor's can't have it as an ancestor.
+                if self.getGeneration(parent) > min_gen:
+                    stack.append(parent)
+        return False
+
+    def __paint(self, starts, is_done):
+        """
+        Walk the graph from the specified (position, flags) pairs, in order of
+        decreasing generation number, propagating flags from each commit to
+        its parents.
+
+        Since a commit always has a higher generation number than its
+        parents, a commit's flags are final by the time it is popped from the
+        queue.  For each commit popped, yields (position, flags).  The walk
+        stops once is_done(flags) is true for every commit in the queue.
+        """
+        flags = {}
+        for (pos, pos_flags) in starts:
+            flags[pos] = flags.get(pos, 0) | pos_flags
+
+        queue = [(-self.getGeneration(pos), pos) for pos in flags]
+        heapq.heapify(queue)
+        # The number of commits in the queue for which is_done() is false
+        num_pending = len([f for f in flags.itervalues() if not is_done(f)])
+
+        while queue and num_pending > 0:
+            (neg_gen, pos) = heapq.heappop(queue)
+            pos_flags = flags[pos]
+            if not is_done(pos_flags):
+                num_pending -= 1
+
+            parent_flags = pos_flags
+            if (pos_flags & _FLAG_CHILD) and (pos_flags & _FLAG_PARENT):
+                parent_flags |= _FLAG_STALE
+            yield (pos, pos_flags)
+
+            for parent in self.getParents(pos):
+                old_flags = flags.get(parent)
+                if old_flags is None:
+                    flags[parent] = parent_flags
+                    heapq.heappush(queue, (-self.getGeneration(parent),
+                                           parent))
+                    if not is_done(parent_flags):
+                        num_pending += 1
+                    continue
+
+                new_flags = old_flags | parent_flags
+                if new_flags == old_flags:
+                    continue
+                flags[parent] = new_flags
+                # The parent has a lower generation number than the commit we
+                # just popped, so it must still be in the queue.
+                if not is_done(old_flags) and is_done(new_flags):
+                    num_pending -= 1
+
+    def getRange(self, excludes, includes):
+        """
+        graph.getRange(excludes, includes) --> list of positions
+
+        Return the positions of all commits reachable from the commits in
+        includes, but not from any commit in excludes.  This is equivalent to
+        "git rev-list ^<exclude>... <include>...".
+
+        Results are ordered by decreasing generation number, so every commit
+        appears before its parents.
+        """
+        starts = [(pos, _FLAG_PARENT) for pos in excludes]
+        starts += [(pos, _FLAG_CHILD) for pos in includes]
+
+        def is_done(flags):
+            return bool(flags & _FLAG_PARENT)
+
+        results = []
+        for (pos, flags) in self.__paint(starts, is_done):
+            if flags == _FLAG_CHILD:
+                results.append(pos)
+        return results
+
+    def getMergeBases(self, pos1, pos2):
+        """
+        graph.getMergeBases(pos1, pos2) --> list of positions
+
+        Return the best common ancestors of the two commits, like
+        "git merge-base --all".
+        """
+        if pos1 == pos2:
+            return [pos1]
+
+        starts = [(pos1, _FLAG_CHILD), (pos2, _FLAG_PARENT)]
+
+        def is_done(flags):
+            return bool(flags & _FLAG_STALE)
+
+        both = _FLAG_CHILD | _FLAG_PARENT
+        candidates = []
+        for (pos, flags) in self.__paint(starts, is_done):
+            if (flags & both) == both and not (flags & _FLAG_STALE):
+                candidates.append(pos)
+
+        # Remove any candidate that is an ancestor of another candidate
+        results = []
+        for pos in candidates:
+            redundant = False
+            for other in candidates:
+                if other != pos and self.isAncestor(pos, other):
+                    redundant = True
+                    break
+            if not redundant:
+                results.append(pos)
+        return results
+
+
+def _get_info_dir(git_dir):
+    if os.environ.has_key('GIT_OBJECT_DIRECTORY'):
+        object_dir = os.environ['GIT_OBJECT_DIRECTORY']
+    else:
+        object_dir = os.path.join(git_dir, 'objects')
+    return os.path.join(object_dir, 'info')
+
+
+def _load_chain(graphs_dir):
+    chain_path = os.path.join(graphs_dir, 'commit-graph-chain')
+    try:
+        f = open(chain_path, 'r')
+    except IOError:
+        return None
+    try:
+        hashes = [line.strip() for line in f if line.strip()]
+    finally:
+        f.close()
+
+    files = []
+    base_count = 0
+    for graph_hash in hashes:
+        path = os.path.join(graphs_dir, 'graph-%s.graph' % (graph_hash,))
+        graph_file = _GraphFile(path, base_count)
+        if graph_file.numBases != len(files):
+            msg = '%s: expected %d base graphs, found %d' % \
+                    (path, len(files), graph_file.numBases)
+            raise CommitGraphError(msg)
+        files.append(graph_file)
+        base_count += graph_file.numCommits
+    return files
+
+
+def get_stat_key(git_dir):
+    """
+    get_stat_key(git_dir) --> key
+
+    Return a value that changes whenever the commit-graph files are
+    rewritten.  This can be used to decide when a cached CommitGraph
+    needs to be reloaded.
+    """
+    info_dir = _get_info_dir(git_dir)
+    key = []
+    for path in (os.path.join(info_dir, 'commit-graph'),
+                 os.path.join(info_dir, 'commit-graphs',
+                              'commit-graph-chain')):
+        try:
+            s = os.stat(path)
+            key.append((s.st_ino, s.st_mtime, s.st_size))
+        except OSError:
+            key.append(None)
+    return tuple(key)
+
+
+def load(git_dir):
+    """
+    load(git_dir) --> CommitGraph or None
+
+    Load the commit-graph for the repository.  Returns None if the repository
+    does not have a usable commit-graph.
+    """
+    info_dir = _get_info_dir(git_dir)
+
+    # git prefers a commit-graph chain over a single commit-graph file
+    try:
+        files = _load_chain(os.path.join(info_dir, 'commit-graphs'))
+        if files is None:
+            path = os.path.join(info_dir, 'commit-graph')
+            if not os.path.exists(path):
+                return None
+            files = [_GraphFile(path, 0)]
+    except (IOError, OSError, CommitGraphError, struct.error):
+        # The graph is only an optimization.
+        # If it can't be read, callers fall back to running git.
+        return None
+
+    graph = CommitGraph(files)
+    if not graph.hasGenerations():
+        graph.close()
+        return None
+    return graph
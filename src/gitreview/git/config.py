@@ -39,6 +39,9 @@ class Config(object):
 
         return value_list[0]
 
+    def getNames(self):
+        return self.__contents.keys()
+
     def getAll(self, name):
         try:
             return self.__contents[name]
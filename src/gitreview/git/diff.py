@@ -14,6 +14,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 #
+import hashlib
+import os
 import re
 import UserDict
 
@@ -22,6 +24,8 @@ import gitreview.proc as proc
 from exceptions import *
 import constants
 
+_NULL_SHA1 = '0' * 40
+
 
 class Status(object):
     ADDED               = 'A'
@@ -109,6 +113,9 @@ class BlobInfo(object):
         self.sha1 = sha1
         self.path = path
         self.mode = mode
+        # The size in bytes.  This is None until sizes have been loaded
+        # with add_blob_sizes().
+        self.size = None
 
 
 class DiffEntry(object):
@@ -118,6 +125,16 @@ class DiffEntry(object):
         self.new = BlobInfo(new_sha1, new_path, new_mode)
         self.status = status
 
+        # Line statistics, from "git diff --numstat".
+        # These are None until line statistics have been computed.
+        self.linesAdded = None
+        self.linesRemoved = None
+        self.binary = None
+
+        # A hash of the normalized patch for this entry.
+        # This is None until patch IDs have been computed.
+        self.patchId = None
+
     def __str__(self):
         if self.status == Status.RENAMED or self.status == Status.COPIED:
             return 'DiffEntry(%s: %s --> %s)' % \
@@ -130,6 +147,10 @@ class DiffEntry(object):
         self.old = self.new
         self.new = tmp_info
 
+        tmp_lines = self.linesAdded
+        self.linesAdded = self.linesRemoved
+        self.linesRemoved = tmp_lines
+
         if self.status == Status.ADDED:
             self.status = Status(Status.DELETED)
         elif self.status == Status.COPIED:
@@ -151,11 +172,48 @@ class DiffEntry(object):
         # so return old.path
         return self.old.path
 
+    def setLineStats(self, added, removed, binary):
+        self.linesAdded = added
+        self.linesRemoved = removed
+        self.binary = binary
+
+    def hasLineStats(self):
+        return self.binary is not None
+
+    def getMaxSize(self):
+        """
+        entry.getMaxSize() --> size in bytes, or None
+
+        Returns the size of the larger of the two blobs, or None if neither
+        size is known.
+        """
+        sizes = [info.size for info in (self.old, self.new)
+                 if info.size is not None]
+        if not sizes:
+            return None
+        return max(sizes)
+
+    def getChurn(self):
+        """
+        entry.getChurn() --> number of lines added plus lines removed
+
+        Returns 0 for binary files, and None if line statistics have not been
+        computed for this entry.
+        """
+        if self.binary is None:
+            return None
+        if self.binary:
+            return 0
+        return self.linesAdded + self.linesRemoved
+
 
 class DiffFileList(UserDict.DictMixin):
-    def __init__(self, parent, child):
+    def __init__(self, parent, child, paths=None):
         self.parent = parent
         self.child = child
+        # The paths the diff was limited to, or None if it covers the
+        # whole tree
+        self.paths = paths
         self.entries = {}
 
     def add(self, entry):
@@ -184,6 +242,15 @@ class DiffFileList(UserDict.DictMixin):
                 raise GitError(msg)
         self.entries[path] = entry
 
+    def remove(self, path):
+        """
+        Remove the entry for the specified path.
+
+        This is used to replace entries when the diff is recomputed for
+        just some of the files.
+        """
+        del self.entries[path]
+
     def __repr__(self):
         return 'DiffFileList(' + repr(self.entries) + ')'
 
@@ -216,9 +283,28 @@ class DiffFileList(UserDict.DictMixin):
     def __nonzero__(self):
         return bool(self.entries)
 
+    def hasLineStats(self):
+        for entry in self.entries.itervalues():
+            if not entry.hasLineStats():
+                return False
+        return True
+
+    def hasPatchIds(self):
+        for entry in self.entries.itervalues():
+            if entry.patchId is None:
+                return False
+        return True
 
-def get_diff_list(repo, parent, child, paths=None):
-    # Compute the args to specify the commits to 'git diff'
+
+def _get_commit_args(parent, child):
+    """
+    _get_commit_args(parent, child) --> (commit_args, reverse)
+
+    Compute the arguments to pass to "git diff" to compare the specified
+    commits.  commit_args is None if there can be no differences.  If reverse
+    is True, git will compare the commits in the opposite order, and the
+    results need to be reversed.
+    """
     reverse = False
     if parent == constants.COMMIT_WD:
         if child == constants.COMMIT_WD:
@@ -246,6 +332,38 @@ def get_diff_list(repo, parent, child, paths=None):
     else:
         commit_args = [str(parent), str(child)]
 
+    return (commit_args, reverse)
+
+
+def _run_diff(repo, cmd, handler, delimiter='\0'):
+    """
+    Run a "git diff" command, passing an iterator over the output fields to
+    handler().  The fields are NUL-separated by default.
+    """
+    fields = repo.streamSimpleGitCmd(cmd, delimiter=delimiter)
+    try:
+        handler(fields)
+    except proc.CmdFailedError, ex:
+        match = re.search("bad revision '(.*)'\n", ex.stderr)
+        if match:
+            bad_rev = match.group(1)
+            raise NoSuchCommitError(bad_rev)
+        raise
+
+
+def get_diff_list(repo, parent, child, paths=None, numstat=False):
+    """
+    get_diff_list(repo, parent, child, paths=None, numstat=False) -->
+            DiffFileList
+
+    Get the list of files that differ between parent and child.
+
+    If numstat is True, line statistics are computed for each entry in the
+    same git invocation.  (This requires git to read the contents of every
+    modified file, so it is more expensive than just listing the files.)
+    """
+    (commit_args, reverse) = _get_commit_args(parent, child)
+
     # The arguments to select by path
     if paths == None:
         path_args = []
@@ -255,33 +373,411 @@ def get_diff_list(repo, parent, child, paths=None):
     else:
         path_args = paths
 
+    entries = DiffFileList(parent, child, paths)
     if commit_args == None or path_args == None:
         # No diffs
-        out = ''
+        return entries
+
+    cmd = ['diff', '--raw', '--abbrev=40', '-z', '-C']
+    if numstat:
+        cmd.append('--numstat')
+    cmd += commit_args + ['--'] + path_args
+
+    def handler(fields):
+        _parse_diff_raw(fields, entries, reverse)
+    _run_diff(repo, cmd, handler)
+
+    _add_working_dir_sha1s(repo, entries)
+    return entries
+
+
+def _get_working_dir_infos(diff_list):
+    """
+    Returns the BlobInfos for the working directory side of each entry in a
+    DiffFileList, or an empty list if neither side is the working directory.
+    """
+    if diff_list.child == constants.COMMIT_WD:
+        return [entry.new for entry in diff_list if entry.new.path is not None]
+    if diff_list.parent == constants.COMMIT_WD:
+        return [entry.old for entry in diff_list if entry.old.path is not None]
+    return []
+
+
+def _add_working_dir_sha1s(repo, diff_list):
+    """
+    git reports a null SHA1 for files in the working directory that differ
+    from the index.  Replace these with the SHA1s the files would have if
+    they were added, so working directory entries can be cached and
+    recorded like committed ones.  Files that can't be hashed (e.g.,
+    because they were deleted after git diff ran, or are submodules) keep
+    the null SHA1.
+    """
+    infos = [info for info in _get_working_dir_infos(diff_list)
+             if info.sha1 == _NULL_SHA1]
+    if not infos or not repo.hasWorkingDirectory():
+        return
+    sha1s = repo.hashWorkingDirFiles([info.path for info in infos])
+    for info in infos:
+        try:
+            info.sha1 = sha1s[info.path]
+        except KeyError:
+            pass
+
+
+def add_line_stats(repo, diff_list, paths=None):
+    """
+    add_line_stats(repo, diff_list, paths=None)
+
+    Compute line statistics for all entries in a DiffFileList, using a single
+    "git diff --numstat" invocation.  If paths is specified, only entries
+    for those paths are updated.  Otherwise the diff is limited to the same
+    paths as the DiffFileList.
+    """
+    (commit_args, reverse) = _get_commit_args(diff_list.parent,
+                                              diff_list.child)
+    if paths is None:
+        paths = diff_list.paths
+    if commit_args is None or paths == []:
+        return
+    if paths is None:
+        paths = []
+
+    entries_by_git_path = _get_entries_by_git_path(diff_list, reverse)
+    cmd = ['diff', '--numstat', '-z', '-C'] + commit_args + ['--'] + paths
+
+    def handler(fields):
+        for field in fields:
+            (git_path, stats) = _parse_numstat_field(fields, field)
+            try:
+                entry = entries_by_git_path[git_path]
+            except KeyError:
+                msg = 'unexpected output from git diff: ' \
+                        'numstat for unknown path %r' % (git_path,)
+                raise GitError(msg)
+            _set_line_stats(entry, stats, reverse)
+    _run_diff(repo, cmd, handler)
+
+
+def add_blob_sizes(repo, diff_list):
+    """
+    add_blob_sizes(repo, diff_list)
+
+    Look up the size of every blob in a DiffFileList whose size isn't known
+    yet, using the repository's batch checker, so no blob is read.  Files in
+    the working directory, whose blobs may not have been written, are
+    measured with lstat().
+    """
+    wd_infos = set([id(info) for info in _get_working_dir_infos(diff_list)])
+    infos = []
+    sha1s = []
+    for entry in diff_list:
+        for info in (entry.old, entry.new):
+            if info.size is not None or info.path is None:
+                continue
+            if id(info) in wd_infos:
+                # The blob may not be in the object database
+                if not repo.hasWorkingDirectory():
+                    continue
+                try:
+                    st = os.lstat(os.path.join(repo.workingDir, info.path))
+                except OSError:
+                    continue
+                info.size = st.st_size
+            elif info.sha1 != _NULL_SHA1:
+                infos.append(info)
+                sha1s.append(info.sha1)
+
+    if not sha1s:
+        return
+    objects = repo.checkObjects(list(set(sha1s)))
+    for info in infos:
+        obj = objects[info.sha1]
+        if obj is not None:
+            info.size = obj.size
+
+
+def _get_entries_by_git_path(diff_list, reverse):
+    """
+    Index the entries in a DiffFileList by the path git reports for them.
+    For renames and copies this is the new path.  For entries that we
+    reversed, it is the path on the other side of the diff.
+    """
+    entries_by_git_path = {}
+    for entry in diff_list:
+        if reverse:
+            git_path = entry.old.path or entry.new.path
+        else:
+            git_path = entry.getPath()
+        entries_by_git_path[git_path] = entry
+    return entries_by_git_path
+
+
+def add_patch_ids(repo, diff_list, paths=None):
+    """
+    add_patch_ids(repo, diff_list, paths=None)
+
+    Compute a patch ID for every entry in a DiffFileList, using a single
+    streaming "git diff -p" invocation.  If paths is specified, only entries
+    for those paths are updated.
+
+    Like "git patch-id", the ID is a hash of the added and removed lines with
+    all whitespace removed.  Unlike "git patch-id", file names and context
+    lines are not included, so the same change made to different files gets
+    the same ID.  The entry's status and any mode changes are included.
+    """
+    (commit_args, reverse) = _get_commit_args(diff_list.parent,
+                                              diff_list.child)
+    if commit_args is None or paths == []:
+        return
+    if paths is None:
+        paths = []
+
+    entries_by_git_path = _get_entries_by_git_path(diff_list, reverse)
+
+    # Context lines aren't hashed, so don't ask git for any
+    cmd = ['diff', '-p', '-U0', '-C', '--full-index', '--no-color',
+           '--no-ext-diff', '--no-textconv', '--src-prefix=a/',
+           '--dst-prefix=b/'] + commit_args + ['--'] + paths
+
+    def handler(lines):
+        for (git_path, patch_id) in _iter_patch_ids(lines):
+            try:
+                entry = entries_by_git_path[git_path]
+            except KeyError:
+                msg = 'unexpected output from git diff: ' \
+                        'patch for unknown path %r' % (git_path,)
+                raise GitError(msg)
+            entry.patchId = patch_id
+    _run_diff(repo, cmd, handler, delimiter='\n')
+
+
+# Translations for the escape sequences git uses in quoted path names
+_QUOTE_ESCAPES = {
+    'a': '\a', 'b': '\b', 't': '\t', 'n': '\n', 'v': '\v', 'f': '\f',
+    'r': '\r', '"': '"', '\\': '\\',
+}
+
+
+def _unquote_path(path):
+    """
+    Undo the C-style quoting git applies to path names that contain
+    special characters.  Paths that aren't quoted are returned unchanged.
+    """
+    if not path.startswith('"') or not path.endswith('"'):
+        return path
+
+    result = []
+    n = 1
+    end = len(path) - 1
+    while n < end:
+        c = path[n]
+        if c != '\\':
+            result.append(c)
+            n += 1
+            continue
+        next_c = path[n + 1]
+        if next_c in '01234567':
+            result.append(chr(int(path[n + 1:n + 4], 8)))
+            n += 4
+        else:
+            result.append(_QUOTE_ESCAPES.get(next_c, next_c))
+            n += 2
+    return ''.join(result)
+
+
+def _parse_patch_header(line):
+    """
+    Get the path from a "diff --git a/<path> b/<path>" or
+    "diff --cc <path>" line.
+
+    For renames and copies the header contains two different paths, and
+    can't always be split reliably.  None is returned if the header does not
+    contain the same path twice.  The caller should use the path from the
+    subsequent "rename to" or "copy to" line instead.
+    """
+    if line.startswith('diff --cc '):
+        return _unquote_path(line[len('diff --cc '):])
+
+    names = line[len('diff --git '):]
+    if names.startswith('"'):
+        # Both paths are quoted
+        half = len(names) / 2
+        old_name = _unquote_path(names[:half])
+        new_name = _unquote_path(names[half + 1:])
     else:
-        cmd = ['diff', '--raw', '--abbrev=40', '-z', '-C'] + \
-                commit_args + ['--'] + path_args
+        half = (len(names) - 1) / 2
+        old_name = names[:half]
+        new_name = names[half + 1:]
+    if old_name[2:] != new_name[2:] or not new_name.startswith('b/'):
+        return None
+    return new_name[2:]
+
+
+def _iter_patch_ids(lines):
+    """
+    Parse the output of "git diff -p", and yield (path, patch_id) for each
+    file.
+    """
+    path = None
+    old_path = None
+    in_header = False
+    index_line = None
+    patch_hash = None
+    # True once something that identifies the change (a changed line, or
+    # the SHA1s of a binary file) has been hashed
+    has_content = False
+    for line in lines:
+        if line.startswith('diff '):
+            new_path = _parse_patch_header(line)
+            if path is not None and new_path == path:
+                # A type change is shown as a deletion followed by an
+                # addition of the same path.  Hash both as one patch.
+                in_header = True
+                continue
+            if patch_hash is not None:
+                path = _check_patch_path(path, line)
+                yield (path, _get_patch_id(patch_hash, has_content,
+                                           old_path, path))
+            path = new_path
+            old_path = None
+            in_header = True
+            index_line = None
+            patch_hash = hashlib.sha1()
+            has_content = False
+            continue
+        if patch_hash is None:
+            # Lines such as "* Unmerged path <path>" that come before the
+            # first patch
+            continue
+
+        if in_header:
+            if line.startswith('@@'):
+                in_header = False
+            elif line.startswith('rename to ') or \
+                    line.startswith('copy to '):
+                path = _unquote_path(line.split(' ', 2)[2])
+                patch_hash.update(line.split(' ', 1)[0] + '\n')
+            elif line.startswith('rename from ') or \
+                    line.startswith('copy from '):
+                old_path = _unquote_path(line.split(' ', 2)[2])
+            elif line.startswith('old mode ') or \
+                    line.startswith('new mode ') or \
+                    line.startswith('new file mode ') or \
+                    line.startswith('deleted file mode '):
+                patch_hash.update(line + '\n')
+            elif line.startswith('index '):
+                index_line = line
+            elif line.startswith('Binary files ') and index_line is not None:
+                # For binary files, the full blob SHA1s on the index line
+                # identify the change.  For text files they would make the
+                # IDs specific to each file, so they are only hashed once
+                # we know the file is binary.
+                patch_hash.update(index_line.split(' ')[1] + '\n')
+                has_content = True
+            continue
+
+        if line.startswith('+') or line.startswith('-'):
+            has_content = True
+            patch_hash.update(line[0])
+            patch_hash.update(''.join(line[1:].split()))
+            patch_hash.update('\n')
+        # Everything else is hunk headers, which contain line numbers that
+        # are different for each file, and "\ No newline at end of file"
+
+    if patch_hash is not None:
+        path = _check_patch_path(path, None)
+        yield (path, _get_patch_id(patch_hash, has_content, old_path, path))
+
+
+def _get_patch_id(patch_hash, has_content, old_path, path):
+    """
+    Finish computing a patch ID.
+
+    A patch with no changed lines (such as a pure rename, or a mode change)
+    only hashes its status and modes, which unrelated files can share.
+    The paths are included for these, so that they are only identical to
+    the same change to the same file.
+    """
+    if not has_content:
+        patch_hash.update('%s\0%s\n' % (old_path or path, path))
+    return patch_hash.hexdigest()
+
+
+def _check_patch_path(path, line):
+    if path is None:
+        msg = 'unexpected output from git diff: ' \
+                'unable to determine path for patch'
+        if line is not None:
+            msg += ' before %r' % (line,)
+        raise GitError(msg)
+    return path
+
+
+def _parse_numstat_field(fields, field):
+    """
+    Parse a "git diff --numstat -z" record.
+
+    Returns (path, (added, removed, binary)).  For renames and copies, the
+    path is the new path.
+    """
+    try:
+        (added_str, removed_str, path) = field.split('\t', 2)
+        if added_str == '-' and removed_str == '-':
+            stats = (None, None, True)
+        else:
+            stats = (int(added_str), int(removed_str), False)
+    except ValueError:
+        msg = 'unexpected output from git diff: ' \
+                'invalid numstat record %r' % (field,)
+        raise GitError(msg)
+
+    if not path:
+        # This is a rename or copy.
+        # The old and new paths follow in the next two fields.
         try:
-            out = repo.runSimpleGitCmd(cmd)
-        except proc.CmdFailedError, ex:
-            match = re.search("bad revision '(.*)'\n", ex.stderr)
-            if match:
-                bad_rev = match.group(1)
-                raise NoSuchCommitError(bad_rev)
-            raise
-
-    fields = out.split('\0')
-    # When the diff is non-empty, it will have a terminating '\0'
-    # Remove the empty field after the last '\0'
-    if fields and not fields[-1]:
-        del fields[-1]
-    num_fields = len(fields)
-
-    entries = DiffFileList(parent, child)
+            fields.next()
+            path = fields.next()
+        except StopIteration:
+            msg = 'unexpected output from git diff: ' \
+                    'missing file name for numstat record %r' % (field,)
+            raise GitError(msg)
+
+    return (path, stats)
+
+
+def _set_line_stats(entry, stats, reverse):
+    (added, removed, binary) = stats
+    if reverse:
+        (added, removed) = (removed, added)
+    entry.setLineStats(added, removed, binary)
+
+
+def _parse_diff_raw(fields, entries, reverse):
+    """
+    Parse the NUL-separated fields output by "git diff --raw -z",
+    and add the resulting DiffEntry objects to entries.
+
+    If the output also contains "--numstat" records, the line statistics
+    are stored in the corresponding entries.
+    """
+    # Entries indexed by the path git reported for them,
+    # so we can match up numstat records
+    entries_by_git_path = {}
 
     n = 0
-    while n < num_fields:
-        field = fields[n]
+    for field in fields:
+        if field and field[0] != ':':
+            # All of the raw records are output before the numstat records
+            (git_path, stats) = _parse_numstat_field(fields, field)
+            try:
+                entry = entries_by_git_path[git_path]
+            except KeyError:
+                msg = 'unexpected output from git diff: ' \
+                        'numstat for unknown path %r' % (git_path,)
+                raise GitError(msg)
+            _set_line_stats(entry, stats, reverse)
+            continue
+
         # The field should start with ':'
         if not field or field[0] != ':':
             msg = 'unexpected output from git diff: ' \
@@ -326,23 +822,27 @@ def get_diff_list(repo, parent, child, paths=None):
 
         # Advance n to read the first file name
         n += 1
-        if n >= num_fields:
+        try:
+            name = fields.next()
+        except StopIteration:
             msg = 'unexpected output from git diff: ' \
                     'missing file name for field %d' % (n - 1,)
             raise GitError(msg)
 
         # Read the file name(s)
         if status == Status.RENAMED or status == Status.COPIED:
-            old_name = fields[n]
+            old_name = name
             # Advance n to read the second file name
             n += 1
-            if n >= num_fields:
+            try:
+                new_name = fields.next()
+            except StopIteration:
                 msg = 'unexpected output from git diff: ' \
                         'missing second file name for field %d' % (n,)
                 raise GitError(msg)
-            new_name = fields[n]
+            git_path = new_name
         else:
-            name = fields[n]
+            git_path = name
             if status == Status.DELETED:
                 old_name = name
                 new_name = None
@@ -359,8 +859,9 @@ def get_diff_list(repo, parent, child, paths=None):
         if reverse:
             entry.reverse()
         entries.add(entry)
+        # entries.add() may merge this entry with an existing one for the
+        # same path, so look up the entry it actually stored
+        entries_by_git_path[git_path] = entries[entry.getPath()]
 
         # Advance n, to prepare for the next iteration around the loop
         n += 1
-
-    return entries
@@ -23,10 +23,55 @@ import tempfile
 import gitreview.proc as proc
 
 from exceptions import *
+import attributes as git_attributes
+import batch_check as git_batch_check
 import constants
 import commit as git_commit
+import commit_cache as git_commit_cache
+import commit_graph as git_commit_graph
 import diff as git_diff
 import obj as git_obj
+import snapshot as git_snapshot
+import textconv as git_textconv
+import wdhash as git_wdhash
+
+
+# The amount read at a time while skipping the middle of a blob
+_PREVIEW_BLOCK_SIZE = 1024 * 1024
+
+# listTree() reports entries to its caller in batches of this size
+_TREE_BATCH_SIZE = 256
+
+
+def _raise_blob_error(name, ex):
+    """
+    Convert a failed "git cat-file blob" command to NoSuchBlobError or
+    NotABlobError where possible, and raise it.
+    """
+    if ex.stderr.find('Not a valid object name') >= 0 or \
+            ex.stderr.find('does not exist in') >= 0:
+        raise NoSuchBlobError(name)
+    elif ex.stderr.find('bad file') >= 0:
+        raise NotABlobError(name)
+    raise ex
+
+
+def _is_single_rev(name):
+    """
+    Returns True if name refers to a single revision, and can be resolved
+    by the batch checker.  Ranges and other rev-list syntax can't be.
+    Neither can ":/<message>" searches, since the "^{commit}" suffix used
+    by getCommitSha1s() would become part of the message pattern.
+    """
+    if not git_batch_check.can_check(name):
+        return False
+    if name.startswith('^') or name.startswith('-') or \
+            name.startswith(':/'):
+        return False
+    for syntax in ('..', '^!', '^@', '^-'):
+        if syntax in name:
+            return False
+    return True
 
 
 class Repository(object):
@@ -45,6 +90,15 @@ class Repository(object):
             if self.__gitCmdEnv.has_key('GIT_WORK_TREE'):
                 del(self.__gitCmdEnv['GIT_WORK_TREE'])
 
+        self.__attributeChecker = None
+        self.__batchChecker = None
+        self.__commitCache = None
+        self.__commitGraph = None
+        self.__commitGraphKey = None
+        self.__snapshotter = None
+        self.__textconvCache = None
+        self.__wdHasher = None
+
     def __str__(self):
         if self.workingDir:
             return self.workingDir
@@ -129,6 +183,31 @@ class Repository(object):
         env = self.__getCmdEnv(extra_env)
         return proc.run_oneline_cmd(cmd, cwd=self.__gitCmdCwd, env=env)
 
+    def streamGitCmd(self, args, delimiter=None, expected_rc=0,
+                     expected_sig=None, extra_env=None):
+        """
+        Run a git command, and return an iterator over its output.
+
+        See proc.stream_cmd() for details.
+        """
+        cmd = [constants.GIT_EXE] + args
+        env = self.__getCmdEnv(extra_env)
+        return proc.stream_cmd(cmd, cwd=self.__gitCmdCwd, env=env,
+                               expected_rc=expected_rc,
+                               expected_sig=expected_sig,
+                               delimiter=delimiter)
+
+    def streamSimpleGitCmd(self, args, delimiter=None, extra_env=None):
+        """
+        Run a git command, and return an iterator over its output.
+
+        See proc.stream_simple_cmd() for details.
+        """
+        cmd = [constants.GIT_EXE] + args
+        env = self.__getCmdEnv(extra_env)
+        return proc.stream_simple_cmd(cmd, cwd=self.__gitCmdCwd, env=env,
+                                      delimiter=delimiter)
+
     def runCmdWithInput(self, args, input, stdout=subprocess.PIPE,
                         extra_env=None):
         """
@@ -164,12 +243,39 @@ class Repository(object):
 
         return cmd_out
 
-    def getDiff(self, parent, child, paths=None):
-        return git_diff.get_diff_list(self, parent, child, paths=paths)
+    def getDiff(self, parent, child, paths=None, numstat=False):
+        return git_diff.get_diff_list(self, parent, child, paths=paths,
+                                      numstat=numstat)
 
     def getCommit(self, name):
+        """
+        repo.getCommit(name) --> Commit
+
+        The special names COMMIT_INDEX and COMMIT_WD are also accepted.
+        Other names are looked up with getCommits().
+        """
         return git_commit.get_commit(self, name)
 
+    def getCommits(self, names):
+        """
+        repo.getCommits(names) --> list of Commit
+
+        Get Commit objects for several commits at once.  This is much faster
+        than calling getCommit() for each one, especially for commits that
+        haven't been seen before.
+        """
+        return git_commit.get_commits(self, names)
+
+    def getCommitCache(self):
+        """
+        repo.getCommitCache() --> CommitCache
+
+        Returns the persistent cache of parsed commits.
+        """
+        if self.__commitCache is None:
+            self.__commitCache = git_commit_cache.get_cache(self)
+        return self.__commitCache
+
     def getCommitSha1(self, name, extra_args=None):
         """
         repo.getCommitSha1(name) --> sha1
@@ -179,6 +285,9 @@ class Repository(object):
         underlying commit object referred to in the tag.  (Use getSha1() if
         you want to get the SHA1 of the tag object itself.)
         """
+        if extra_args is None and _is_single_rev(name):
+            return self.getCommitSha1s([name])[0]
+
         # Note: 'git rev-list' returns the SHA1 value of the commit,
         # even if "name" refers to a tag object.
         cmd = ['rev-list', '-1']
@@ -193,6 +302,32 @@ class Repository(object):
             raise
         return sha1
 
+    def getCommitSha1s(self, names):
+        """
+        repo.getCommitSha1s(names) --> list of sha1
+
+        Like getCommitSha1(), but resolves many names at once, using the
+        batch checker.  Raises NoSuchCommitError for the first name that
+        doesn't refer to a commit.
+        """
+        sha1s = [None] * len(names)
+        to_check = []
+        for n in range(len(names)):
+            if _is_single_rev(names[n]):
+                to_check.append(names[n] + '^{commit}')
+            else:
+                sha1s[n] = self.getCommitSha1(names[n])
+
+        results = self.getBatchChecker().check(to_check)
+        for n in range(len(names)):
+            if sha1s[n] is not None:
+                continue
+            info = results[names[n] + '^{commit}']
+            if info is None:
+                raise NoSuchCommitError(names[n])
+            sha1s[n] = info.sha1
+        return sha1s
+
     def getSha1(self, name):
         """
         repo.getSha1(name) --> sha1
@@ -209,35 +344,98 @@ class Repository(object):
             raise
         return sha1
 
+    def getBatchChecker(self):
+        """
+        repo.getBatchChecker() --> BatchChecker
+
+        Returns the BatchChecker used to look up object names.  Its cache
+        should be cleared whenever refs or the index may have changed.
+        """
+        if self.__batchChecker is None:
+            self.__batchChecker = git_batch_check.BatchChecker(self)
+        return self.__batchChecker
+
+    def getAttributeChecker(self):
+        """
+        repo.getAttributeChecker() --> AttributeChecker
+
+        Returns the AttributeChecker used to look up gitattributes.
+        """
+        if self.__attributeChecker is None:
+            self.__attributeChecker = git_attributes.AttributeChecker(self)
+        return self.__attributeChecker
+
+    def getAttributes(self, paths):
+        """
+        repo.getAttributes(paths) --> dict of path --> PathAttributes
+
+        Look up the gitattributes that affect how each path is reviewed,
+        using a single git command for all of them.
+        """
+        return self.getAttributeChecker().check(paths)
+
+    def checkObjects(self, names):
+        """
+        repo.checkObjects(names) --> dict of name --> ObjectInfo or None
+
+        Look up the SHA1, type, and size of many objects at once, without
+        starting a git command for each one.  Names that don't refer to an
+        object map to None.
+        """
+        valid = [name for name in names if git_batch_check.can_check(name)]
+        results = self.getBatchChecker().check(valid)
+        for name in names:
+            if not results.has_key(name):
+                results[name] = None
+        return results
+
+    def getObjectTypes(self, names):
+        """
+        repo.getObjectTypes(names) --> dict of name --> type or None
+        """
+        results = {}
+        for (name, info) in self.checkObjects(names).iteritems():
+            if info is None:
+                results[name] = None
+            else:
+                results[name] = info.type
+        return results
+
     def getObjectType(self, name):
-        cmd = ['cat-file', '-t', name]
-        try:
-            return self.runOnelineCmd(cmd)
-        except proc.CmdExitCodeError, ex:
-            if ex.stderr.find('Not a valid object name') >= 0:
-                raise NoSuchObjectError(name)
-            raise
+        type = self.getObjectTypes([name])[name]
+        if type is None:
+            raise NoSuchObjectError(name)
+        return type
 
     def isRevision(self, name):
-        # Handle our special commit names
-        if name == constants.COMMIT_INDEX or name == constants.COMMIT_WD:
-            return True
+        return self.checkRevisions([name])[name]
 
-        # We also need to handle the other index stage names, since
-        # getObjectType() will fail on them too, even though we want to treat
-        # them as revisions.
-        if name == ':1' or name == ':2' or name == ':3':
-            return True
+    def checkRevisions(self, names):
+        """
+        repo.checkRevisions(names) --> dict of name --> bool
 
-        try:
-            type = self.getObjectType(name)
-        except NoSuchObjectError:
-            return False
+        Determine which of a list of names refer to revisions, using a
+        single batch lookup.
+        """
+        results = {}
+        to_check = []
+        for name in names:
+            # Handle our special commit names
+            if name == constants.COMMIT_INDEX or name == constants.COMMIT_WD:
+                results[name] = True
+            # We also need to handle the other index stage names, since
+            # the object lookup will fail on them too, even though we want
+            # to treat them as revisions.
+            elif name == ':1' or name == ':2' or name == ':3':
+                results[name] = True
+            else:
+                to_check.append(name)
 
-        # tag objects can be treated as commits
-        if type == 'commit' or type == 'tag':
-            return True
-        return False
+        types = self.getObjectTypes(to_check)
+        for name in to_check:
+            # tag objects can be treated as commits
+            results[name] = types[name] in ('commit', 'tag')
+        return results
 
     def isRevisionOrPath(self, name):
         """
@@ -289,16 +487,74 @@ class Repository(object):
         try:
             out = self.runSimpleGitCmd(cmd, stdout=stdout)
         except proc.CmdFailedError, ex:
-            if ex.stderr.find('Not a valid object name') >= 0:
-                raise NoSuchBlobError(name)
-            elif ex.stderr.find('bad file') >= 0:
-                raise NotABlobError(name)
-            raise
+            _raise_blob_error(name, ex)
 
         # Note: the output might not include a trailing newline if the blob
         # itself doesn't have one
         return out
 
+    def getBlobPreview(self, name, head_size, tail_size):
+        """
+        repo.getBlobPreview(name, head_size, tail_size) -->
+                (head, tail, size)
+
+        Get the first head_size bytes and the last tail_size bytes of a blob,
+        and its total size.  The whole blob is still read from git, but only
+        the preview is kept, so this uses little memory even for very large
+        blobs.  If the blob has no more than head_size + tail_size bytes,
+        head contains all of it and tail is empty.
+
+        Raises the same errors as getBlobContents().
+        """
+        cmd = ['cat-file', 'blob', name]
+        p = self.popenGitCmd(cmd)
+        head = p.stdout.read(head_size)
+        size = len(head)
+        # Keep up to tail_size bytes beyond the head
+        tail = ''
+        while True:
+            data = p.stdout.read(_PREVIEW_BLOCK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            tail += data
+            if len(tail) > tail_size:
+                tail = tail[len(tail) - tail_size:]
+        cmd_err = p.stderr.read()
+        status = p.wait()
+        try:
+            proc.check_status([constants.GIT_EXE] + cmd, status,
+                              cmd_err=cmd_err)
+        except proc.CmdFailedError, ex:
+            _raise_blob_error(name, ex)
+
+        if size <= head_size + tail_size:
+            # The head and tail together are the whole blob
+            return (head + tail, '', size)
+        return (head, tail, size)
+
+    def getTextconvContents(self, name):
+        """
+        Get the contents of a blob, converted to text with the textconv
+        command of the diff driver configured for its path.  name must
+        include the path, in the form "<commit>:<path>".
+
+        Raises the same errors as getBlobContents().
+        """
+        cmd = ['cat-file', '--textconv', name]
+        try:
+            return self.runSimpleGitCmd(cmd)
+        except proc.CmdFailedError, ex:
+            _raise_blob_error(name, ex)
+
+    def getTextconvCache(self):
+        """
+        repo.getTextconvCache() --> TextconvCache
+        """
+        if self.__textconvCache is None:
+            self.__textconvCache = git_textconv.TextconvCache(self)
+        return self.__textconvCache
+
     def __revList(self, options):
         """
         repo.__revList(options) --> commit names
@@ -314,11 +570,52 @@ class Repository(object):
         grep options, etc.
         """
         args = ['rev-list'] + options
-        cmd_out = self.runSimpleGitCmd(args)
-        lines = cmd_out.split('\n')
-        while lines and not lines[-1]:
-            del lines[-1]
-        return lines
+        return [line for line in self.streamSimpleGitCmd(args, delimiter='\n')
+                if line]
+
+    def getCommitGraph(self):
+        """
+        repo.getCommitGraph() --> CommitGraph or None
+
+        Returns the repository's commit-graph, or None if the repository does
+        not have a usable commit-graph file.  The graph is reloaded if git
+        has rewritten it since it was last loaded.
+        """
+        key = git_commit_graph.get_stat_key(self.gitDir)
+        if key != self.__commitGraphKey:
+            if self.__commitGraph is not None:
+                self.__commitGraph.close()
+            self.__commitGraph = git_commit_graph.load(self.gitDir)
+            self.__commitGraphKey = key
+        return self.__commitGraph
+
+    def __getGraphPositions(self, graph, names):
+        """
+        Resolve the specified commit names to positions in the commit-graph.
+
+        Returns None if any of the names could not be resolved, or refers to
+        a commit that is not in the graph.  (The commit-graph is only updated
+        by "git gc" and "git commit-graph write", so recent commits are
+        frequently missing from it.)
+        """
+        cmd = ['rev-parse', '--revs-only']
+        cmd.extend(['%s^{commit}' % (name,) for name in names])
+        try:
+            cmd_out = self.runSimpleGitCmd(cmd)
+        except proc.CmdFailedError:
+            return None
+
+        sha1s = cmd_out.split()
+        if len(sha1s) != len(names):
+            return None
+
+        positions = []
+        for sha1 in sha1s:
+            pos = graph.lookup(sha1)
+            if pos < 0:
+                return None
+            positions.append(pos)
+        return positions
 
     def getCommitRangeNames(self, parent, child):
         """
@@ -328,6 +625,10 @@ class Repository(object):
         not included in parent.  (The resulting list will never include the
         commit referred to by parent.  It will include the commit referred to
         by child, as long is child is not equal to or an ancestor of parent.)
+
+        If the repository has a commit-graph containing both commits, the
+        range is computed in-process, and commits are returned as SHA1s.
+        Otherwise this falls back to running "git rev-list".
         """
         # If the parent is COMMIT_WD or COMMIT_INDEX, we don't need
         # to run rev-list at all.
@@ -351,10 +652,59 @@ class Repository(object):
             extra_commits = []
             rev_list_start = str(child)
 
+        graph = self.getCommitGraph()
+        if graph is not None:
+            positions = self.__getGraphPositions(graph, [str(parent),
+                                                         rev_list_start])
+            if positions is not None:
+                (parent_pos, child_pos) = positions
+                range_pos = graph.getRange([parent_pos], [child_pos])
+                commits = [graph.getSha1(pos) for pos in range_pos]
+                return extra_commits + commits
+
         rev_list_args = ['^' + str(parent), rev_list_start]
-        commits = self.revList(rev_list_args)
+        commits = self.__revList(rev_list_args)
         return extra_commits + commits
 
+    def getMergeBases(self, commit1, commit2):
+        """
+        repo.getMergeBases(commit1, commit2) --> list of SHA1s
+
+        Get the best common ancestors of two commits, like
+        "git merge-base --all".  This is computed in-process when both
+        commits are in the repository's commit-graph.
+        """
+        graph = self.getCommitGraph()
+        if graph is not None:
+            positions = self.__getGraphPositions(graph, [str(commit1),
+                                                         str(commit2)])
+            if positions is not None:
+                bases = graph.getMergeBases(*positions)
+                return [graph.getSha1(pos) for pos in bases]
+
+        cmd = ['merge-base', '--all', str(commit1), str(commit2)]
+        # merge-base exits with status 1 if there are no common ancestors
+        (status, cmd_out, cmd_err) = self.runGitCmd(cmd, expected_rc=[0, 1])
+        return cmd_out.split()
+
+    def isAncestor(self, ancestor, descendant):
+        """
+        repo.isAncestor(ancestor, descendant) --> bool
+
+        Returns True if ancestor is reachable from descendant.  (A commit is
+        considered to be its own ancestor.)
+        """
+        graph = self.getCommitGraph()
+        if graph is not None:
+            positions = self.__getGraphPositions(graph, [str(ancestor),
+                                                         str(descendant)])
+            if positions is not None:
+                return graph.isAncestor(*positions)
+
+        cmd = ['merge-base', '--is-ancestor', str(ancestor), str(descendant)]
+        (status, cmd_out, cmd_err) = self.runGitCmd(cmd, expected_rc=[0, 1])
+        return status == 0
+
     def getRefs(self, glob=None):
         """
         repo.getRefNames(glob=None) --> dict of "ref name --> SHA1" keys
@@ -373,8 +723,7 @@ class Repository(object):
                 cmd.append(glob)
 
         refs = {}
-        cmd_out = self.runSimpleGitCmd(cmd)
-        for line in cmd_out.split('\n'):
+        for line in self.streamSimpleGitCmd(cmd, delimiter='\n'):
             if not line:
                 continue
             try:
@@ -495,18 +844,61 @@ class Repository(object):
         commit_sha1 = commit_out.strip()
         return commit_sha1
 
-    def listTree(self, commit, dirname=None):
+    def snapshotWorkingDir(self):
+        """
+        repo.snapshotWorkingDir() --> Snapshot
+
+        Record the current contents of the index and working directory as
+        commits.  See git.snapshot.Snapshotter for details.
+        """
+        if self.__snapshotter is None:
+            self.__snapshotter = git_snapshot.Snapshotter(self)
+        return self.__snapshotter.snapshot()
+
+    def hashWorkingDirFiles(self, paths):
+        """
+        repo.hashWorkingDirFiles(paths) --> dict of path --> sha1
+
+        Compute the blob SHA1s for files in the working directory, without
+        writing them to the object database.  See
+        git.wdhash.WorkingDirHasher for details.
+        """
+        if self.__wdHasher is None:
+            self.__wdHasher = git_wdhash.WorkingDirHasher(self)
+        results = self.__wdHasher.hashFiles(paths)
+        self.__wdHasher.save()
+        return results
+
+    def listTree(self, commit, dirname=None, on_entries=None):
+        """
+        repo.listTree(commit, dirname=None, on_entries=None) -->
+                list of TreeEntry
+
+        List the entries in a directory of a commit.
+
+        If on_entries is supplied, it is called with each batch of entries
+        as they are read, so callers can use them before the listing
+        finishes.
+        """
         if commit == constants.COMMIT_WD:
-            return self.__listWorkingDir(dirname)
+            entries = self.__listWorkingDir(dirname)
         elif commit == constants.COMMIT_INDEX:
-            return self.__listIndexTree(dirname)
+            entries = self.__listIndexTree(dirname)
+        else:
+            entries = self.__listCommitTree(commit, dirname, on_entries)
+            on_entries = None
+        if on_entries is not None:
+            on_entries(entries)
+        return entries
 
+    def __listCommitTree(self, commit, dirname, on_entries):
         entries = []
+        reported = 0
         cmd = ['ls-tree', '-z', commit, '--']
-        if dirname is not None:
+        # Newer versions of git reject an empty pathspec
+        if dirname:
             cmd.append(dirname)
-        cmd_out = self.runSimpleGitCmd(cmd)
-        for line in cmd_out.split('\0'):
+        for line in self.streamSimpleGitCmd(cmd, delimiter='\0'):
             if not line:
                 continue
 
@@ -528,7 +920,13 @@ class Repository(object):
             name = os.path.basename(name)
             entry = git_obj.TreeEntry(name, mode, type, sha1)
             entries.append(entry)
+            if on_entries is not None and \
+                    len(entries) - reported >= _TREE_BATCH_SIZE:
+                on_entries(entries[reported:])
+                reported = len(entries)
 
+        if on_entries is not None and reported < len(entries):
+            on_entries(entries[reported:])
         return entries
 
     def listIndex(self, dirname=None):
@@ -547,11 +945,9 @@ class Repository(object):
             cmd.append(dirname)
         else:
             prefix = ''
-        cmd_out = self.runSimpleGitCmd(cmd)
 
-        tree_entries = {}
         entries = []
-        for line in cmd_out.split('\0'):
+        for line in self.streamSimpleGitCmd(cmd, delimiter='\0'):
             if not line:
                 continue
 
@@ -647,11 +1043,10 @@ class Repository(object):
                 # the new name should be the same as the old name
                 assert de.new.path == de.old.path
                 ie.mode = de.new.mode
-                # Use all zeros for the SHA1 hash.
-                # If we really wanted, we could use 'git hash-object'
-                # to compute what the has would be, and optionally create
-                # an actual blob object.
-                ie.sha1 = '0000000000000000000000000000000000000000'
+                # getDiff() computes the SHA1s of modified files.  It is all
+                # zeros if the file couldn't be hashed (e.g., because it was
+                # deleted after we ran git diff, or it is a submodule).
+                ie.sha1 = de.new.sha1
 
         # Now convert all of the IndexEntry objects into TreeEntries
         return self.__convertIndexToTree(ie_by_path.values())
@@ -0,0 +1,294 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Snapshots of the index and working directory as real git objects.
+
+Diffs against COMMIT_WD read files from the working directory as the review
+progresses, so they can change mid-review, and modified files have no SHA1.
+A snapshot hashes the modified files into blobs, and records the index and
+the working directory as commits, which can then be reviewed like any other
+commits.
+"""
+
+import errno
+import os
+import shutil
+import stat
+import tempfile
+
+import gitreview.proc as proc
+
+from exceptions import *
+import constants
+import diff as git_diff
+import wdhash as git_wdhash
+
+__all__ = ['SnapshotError', 'Snapshot', 'Snapshotter']
+
+_NULL_SHA1 = '0' * 40
+
+_SNAPSHOT_MSG = 'git-review snapshot of the %s\n'
+
+
+class SnapshotError(GitError):
+    pass
+
+
+class Snapshot(object):
+    """
+    The result of snapshotting the index and working directory.
+
+    indexCommit is a commit containing the index contents, or None if the
+    index could not be written as a tree (because it contains unmerged
+    entries).  workingDirCommit is a commit containing the working directory
+    contents.  Untracked files are not included.
+    """
+    def __init__(self, index_commit, wd_commit):
+        self.indexCommit = index_commit
+        self.workingDirCommit = wd_commit
+
+    def resolve(self, name):
+        """
+        snapshot.resolve(name) --> commit name
+
+        Replace COMMIT_WD and COMMIT_INDEX with the snapshot commits.  Other
+        commit names are returned unchanged.
+        """
+        if name == constants.COMMIT_WD:
+            return self.workingDirCommit
+        if name == constants.COMMIT_INDEX and self.indexCommit is not None:
+            return self.indexCommit
+        return name
+
+
+class Snapshotter(object):
+    """
+    Creates snapshots of the index and working directory.
+
+    The SHA1s of the files that differ from the index come from the
+    repository's working directory hash cache (see
+    git.wdhash.WorkingDirHasher), so files that haven't changed since they
+    were last hashed are not read again.  Files whose blobs aren't in the
+    object database yet are written through a single "git hash-object"
+    process that is kept running between snapshots.  If nothing has changed
+    at all, the previous snapshot is returned.
+
+    Gitlinks (submodules) are recorded as they are in the index.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.__hasher = None
+
+        self.__lastKey = None
+        self.__lastSnapshot = None
+
+    def close(self):
+        if self.__hasher is not None:
+            self.__hasher.close()
+            self.__hasher = None
+
+    def __getHasher(self):
+        if self.__hasher is None or not self.__hasher.isRunning():
+            self.__hasher = git_wdhash.HashObjectProcess(self.repo,
+                                                         write=True)
+        return self.__hasher
+
+    def snapshot(self):
+        """
+        snapshotter.snapshot() --> Snapshot
+        """
+        if not self.repo.hasWorkingDirectory():
+            raise NoWorkingDirError(self.repo)
+
+        head = self.__getHead()
+        index_path = os.path.join(self.repo.getGitDir(), 'index')
+        try:
+            st = os.stat(index_path)
+            index_key = git_wdhash.get_stat_key(st)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            index_key = None
+
+        # Determine which files differ from the index.
+        # git uses the stat information in the index to avoid reading
+        # files that haven't changed.
+        diff = self.repo.getDiff(constants.COMMIT_INDEX, constants.COMMIT_WD)
+        updates = self.__getUpdates(diff)
+
+        key = (head, index_key, tuple(updates))
+        if key == self.__lastKey:
+            return self.__lastSnapshot
+
+        # Write the trees from a copy of the index,
+        # so the real index isn't modified
+        tmp_index = tempfile.NamedTemporaryFile(dir=self.repo.getGitDir(),
+                                                prefix='snapshot.index.')
+        try:
+            if index_key is not None:
+                shutil.copyfile(index_path, tmp_index.name)
+            extra_env = {'GIT_INDEX_FILE': tmp_index.name}
+
+            index_tree = self.__writeTree(extra_env)
+            if updates:
+                index_info = []
+                for (path, mode, sha1) in updates:
+                    index_info.append('%o %s\t%s\0' % (mode, sha1, path))
+                self.repo.runCmdWithInput(['update-index', '-z',
+                                           '--index-info'],
+                                          input=''.join(index_info),
+                                          extra_env=extra_env)
+                wd_tree = self.__writeTree(extra_env)
+            else:
+                wd_tree = index_tree
+        finally:
+            tmp_index.close()
+
+        if wd_tree is None:
+            raise SnapshotError('unable to write a tree for the working '
+                                'directory')
+
+        if head is None:
+            parents = []
+        else:
+            parents = [head]
+        if index_tree is None:
+            index_commit = None
+            wd_parents = parents
+        else:
+            index_commit = self.repo.commitTree(index_tree, parents,
+                                                _SNAPSHOT_MSG % ('index',))
+            wd_parents = [index_commit]
+        wd_msg = _SNAPSHOT_MSG % ('working directory',)
+        wd_commit = self.repo.commitTree(wd_tree, wd_parents, wd_msg)
+
+        self.__lastKey = key
+        self.__lastSnapshot = Snapshot(index_commit, wd_commit)
+        return self.__lastSnapshot
+
+    def __getHead(self):
+        try:
+            return self.repo.getCommitSha1('HEAD')
+        except NoSuchCommitError:
+            # A repository with no commits yet
+            return None
+
+    def __writeTree(self, extra_env):
+        cmd = [constants.GIT_EXE, 'write-tree']
+        p = self.repo.popenGitCmd(['write-tree'], extra_env=extra_env)
+        (out, err) = p.communicate()
+        status = p.wait()
+        if status == 0:
+            return out.strip()
+        if err.find('unmerged') >= 0:
+            # The index has unmerged entries
+            return None
+        proc.check_status(cmd, status, cmd_err=err)
+
+    def __getUpdates(self, diff):
+        """
+        Compute the index updates needed to turn the index into the working
+        directory contents.
+
+        Returns a sorted list of (path, mode, sha1).  Deleted files have a
+        mode of 0.
+        """
+        updates = []
+        # (path, st, mode, sha1) for files whose SHA1 we know, but whose
+        # blob may not have been written yet
+        known = []
+        to_hash = []
+        work_dir = self.repo.getWorkingDir()
+        for entry in diff:
+            path = entry.getPath()
+            if entry.status == git_diff.Status.DELETED:
+                updates.append((path, 0, _NULL_SHA1))
+                continue
+
+            full_path = os.path.join(work_dir, path)
+            try:
+                st = os.lstat(full_path)
+            except OSError, ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                # The file was deleted after we ran "git diff"
+                updates.append((path, 0, _NULL_SHA1))
+                continue
+
+            mode = entry.new.mode
+            if not mode:
+                # Unmerged entries don't have a working directory mode
+                mode = self.__getMode(st)
+            if stat.S_ISDIR(st.st_mode) or mode == 0160000:
+                # Submodule.  Keep the index entry.
+                continue
+
+            # getDiff() fills in the SHA1s of working directory files, unless
+            # they couldn't be hashed
+            sha1 = entry.new.sha1
+            if sha1 is None or sha1 == _NULL_SHA1:
+                to_hash.append((path, st, mode))
+            else:
+                known.append((path, st, mode, sha1))
+
+        if known:
+            sha1s = list(set([sha1 for (path, st, mode, sha1) in known]))
+            objects = self.repo.checkObjects(sha1s)
+            for (path, st, mode, sha1) in known:
+                if objects[sha1] is None:
+                    to_hash.append((path, st, mode))
+                else:
+                    updates.append((path, mode, sha1))
+
+        updates.extend(self.__hashFiles(to_hash))
+        updates.sort()
+        return updates
+
+    def __getMode(self, st):
+        if stat.S_ISLNK(st.st_mode):
+            return 0120000
+        if st.st_mode & 0100:
+            return 0100755
+        return 0100644
+
+    def __hashFiles(self, files):
+        """
+        Hash the specified files, and return a list of (path, mode, sha1).
+        """
+        if not files:
+            return []
+
+        work_dir = self.repo.getWorkingDir()
+        results = []
+        regular_files = []
+        for (path, st, mode) in files:
+            if stat.S_ISLNK(st.st_mode):
+                # hash-object follows symlinks, so hash the link target
+                # name ourselves
+                target = os.readlink(os.path.join(work_dir, path))
+                sha1 = self.repo.runCmdWithInput(['hash-object', '-w',
+                                                  '--stdin'],
+                                                 input=target).strip()
+                results.append((path, mode, sha1))
+            else:
+                regular_files.append((path, st, mode))
+
+        paths = [path for (path, st, mode) in regular_files]
+        sha1s = self.__getHasher().hashPaths(paths)
+        for ((path, st, mode), sha1) in zip(regular_files, sha1s):
+            results.append((path, mode, sha1))
+        return results
@@ -14,12 +14,29 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 #
+import errno
+import hashlib
+import os
 import re
 
+import gitreview.proc as proc
+
 from exceptions import *
 import commit as git_commit
+import constants
+
+__all__ = ['GitSvnError', 'SvnIndex', 'get_svn_index', 'get_svn_info',
+           'get_svn_url', 'get_svn_commit']
+
+# This pattern is the same one used by the perl git-svn code
+_SVN_ID_RE = re.compile(r'^\s*git-svn-id:\s+(.*)@(\d+)\s([a-f\d\-]+)$',
+                        re.MULTILINE)
+
+_INDEX_HEADER = '# git-review svn index v2\n'
 
-__all__ = ['GitSvnError', 'get_svn_info', 'get_svn_url']
+# If the index has more tips than this, reduce them to the independent
+# set the next time the index is updated
+_MAX_TIPS = 64
 
 
 class GitSvnError(GitError):
@@ -27,9 +44,7 @@ class GitSvnError(GitError):
 
 
 def _parse_svn_info(commit_msg):
-    # This pattern is the same one used by the perl git-svn code
-    m = re.search(r'^\s*git-svn-id:\s+(.*)@(\d+)\s([a-f\d\-]+)$',
-                  commit_msg, re.MULTILINE)
+    m = _SVN_ID_RE.search(commit_msg)
     if not m:
         raise GitSvnError('failed to parse git-svn-id from commit message')
 
@@ -39,11 +54,327 @@ def _parse_svn_info(commit_msg):
     return (url, revision, uuid)
 
 
+class SvnIndex(object):
+    """
+    An on-disk index mapping commit SHA1s to git-svn information.
+
+    For every commit it has seen, the index records the commit's first parent
+    and the (URL, revision, UUID) from its git-svn-id line, if it has one.
+    This allows get_svn_url() to find the nearest svn commit without
+    scanning the history with "git log --grep".
+
+    The index is stored as an append-only text file in the git directory:
+
+      U <id> <uuid> <url>
+          Defines a (URL, UUID) pair.  Commit lines refer to it by id.
+      C <sha1> <first parent> <revision> <url id>
+          A commit.  Missing values are recorded as "-".
+      T <sha1>...
+          The commits from which all ancestors have been indexed.
+
+    The index is extended by streaming "git rev-list" output for commits
+    that are not reachable from the recorded tips.
+
+    Several git-review processes may append to the index at once.  Each
+    update is appended with a single write, and URL ids are derived from
+    the URL and UUID, so they mean the same thing in every process.  Lines
+    that can't be parsed, such as one left partly written by an interrupted
+    update, are ignored.
+    """
+    def __init__(self, repo, path=None):
+        self.repo = repo
+        if path is None:
+            path = os.path.join(repo.getGitDir(), 'git-review', 'svn-index')
+        self.path = path
+
+        # sha1 --> (first parent, revision, url id)
+        self.__commits = {}
+        # (url, revision) --> sha1
+        self.__byRevision = {}
+        # url id --> (url, uuid), and the reverse mapping
+        self.__urls = {}
+        self.__urlIds = {}
+        self.__tips = []
+
+        # Set if the index file is missing or was written by an
+        # incompatible version, and needs to be started from scratch
+        self.__reset = True
+        self.__writable = True
+
+        self.__load()
+
+    def __load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        if not data.startswith(_INDEX_HEADER):
+            # Ignore indexes written by an incompatible version.
+            # The index will be rebuilt from scratch.
+            return
+
+        self.__reset = False
+        offset = len(_INDEX_HEADER)
+        end = len(data)
+        while offset < end:
+            line_end = data.find('\n', offset)
+            if line_end < 0:
+                # A partial line left by an interrupted update
+                break
+            self.__parseLine(data[offset:line_end])
+            offset = line_end + 1
+
+    def __parseLine(self, line):
+        parts = line.split(' ')
+        kind = parts[0]
+        if kind == 'C' and len(parts) == 5:
+            (sha1, parent, revision, url_id) = parts[1:]
+            if parent == '-':
+                parent = None
+            if revision == '-':
+                self.__commits[sha1] = (parent, None, None)
+            elif self.__urls.has_key(url_id):
+                self.__commits[sha1] = (parent, revision, url_id)
+                url = self.__urls[url_id][0]
+                self.__byRevision[(url, revision)] = sha1
+        elif kind == 'U' and len(parts) >= 4:
+            (url_id, uuid) = parts[1:3]
+            url = line.split(' ', 3)[3]
+            self.__urls[url_id] = (url, uuid)
+            self.__urlIds[(url, uuid)] = url_id
+        elif kind == 'T':
+            self.__tips = parts[1:]
+        # Anything else is garbage, such as part of a line whose update was
+        # interrupted.  Skip it.
+
+    def __getUrlId(self, url, uuid, new_lines):
+        key = (url, uuid)
+        try:
+            return self.__urlIds[key]
+        except KeyError:
+            url_id = hashlib.sha1('%s %s' % (uuid, url)).hexdigest()[:16]
+            self.__urls[url_id] = key
+            self.__urlIds[key] = url_id
+            new_lines.append('U %s %s %s\n' % (url_id, uuid, url))
+            return url_id
+
+    def __getRevListCmd(self, sha1, tips):
+        cmd = ['rev-list', '--format=%P%n%B%x00', sha1]
+        if tips:
+            cmd.append('--not')
+            cmd.extend(tips)
+        return cmd
+
+    def __getValidTips(self):
+        """
+        Get the recorded tips that still exist.  Tips are arbitrary
+        commits, and may have been removed by "git gc" since they were
+        recorded.
+        """
+        objects = self.repo.checkObjects(self.__tips)
+        return [tip for tip in self.__tips if objects[tip] is not None]
+
+    def __readNewCommits(self, sha1, tips):
+        """
+        Return a list of (sha1, parents, svn info) for every commit
+        reachable from sha1 that is not reachable from tips.  The svn info
+        is None for commits without a git-svn-id.
+        """
+        commits = []
+        cmd = self.__getRevListCmd(sha1, tips)
+        for record in self.repo.streamSimpleGitCmd(cmd, delimiter='\0'):
+            # The final record is just the newline printed after the last
+            # commit's format output.
+            if record == '\n':
+                continue
+            (commit_sha1, parents, message) = self.__parseRecord(cmd, record)
+            try:
+                svn_info = _parse_svn_info(message)
+            except GitSvnError:
+                svn_info = None
+            commits.append((commit_sha1, parents, svn_info))
+        return commits
+
+    def __parseRecord(self, cmd, record):
+        # Each record after the first starts with the newline that
+        # rev-list prints after the previous record's format output.
+        if record.startswith('\n'):
+            record = record[1:]
+        try:
+            (commit_line, parents, message) = record.split('\n', 2)
+            (header, sha1) = commit_line.split(' ', 1)
+            if header != 'commit':
+                raise ValueError(header)
+        except ValueError:
+            msg = 'unexpected output from git rev-list: %r' % (record[:80],)
+            args = [constants.GIT_EXE] + cmd
+            raise proc.CmdFailedError(args, msg)
+        return (sha1, parents.split(), message)
+
+    def update(self, sha1):
+        """
+        Index all ancestors of the specified commit SHA1 that have not been
+        indexed yet.
+        """
+        if self.__commits.has_key(sha1):
+            return
+
+        self.__tips = self.__getValidTips()
+        try:
+            commits = self.__readNewCommits(sha1, self.__tips)
+        except proc.CmdFailedError:
+            if not self.__tips:
+                raise
+            # A tip may have been removed since it was checked.  Index the
+            # whole history again, without relying on the tips.
+            self.__tips = []
+            commits = self.__readNewCommits(sha1, self.__tips)
+
+        new_lines = []
+        reached = set()
+        for (commit_sha1, parents, svn_info) in commits:
+            reached.update(parents)
+            if parents:
+                parent = parents[0]
+            else:
+                parent = None
+
+            if svn_info is None:
+                self.__commits[commit_sha1] = (parent, None, None)
+                new_lines.append('C %s %s - -\n' %
+                                 (commit_sha1, parent or '-'))
+                continue
+
+            (url, revision, uuid) = svn_info
+            url_id = self.__getUrlId(url, uuid, new_lines)
+            self.__commits[commit_sha1] = (parent, revision, url_id)
+            self.__byRevision[(url, revision)] = commit_sha1
+            new_lines.append('C %s %s %s %s\n' %
+                             (commit_sha1, parent or '-', revision, url_id))
+
+        # Any old tip that is a parent of a newly indexed commit is
+        # reachable from sha1, and no longer needs to be listed.
+        self.__tips = [tip for tip in self.__tips if tip not in reached]
+        self.__tips.append(sha1)
+        if len(self.__tips) > _MAX_TIPS:
+            cmd = ['merge-base', '--independent'] + self.__tips
+            self.__tips = self.repo.runSimpleGitCmd(cmd).split()
+        new_lines.append('T %s\n' % (' '.join(self.__tips),))
+
+        self.__append(new_lines)
+
+    def __append(self, lines):
+        if not self.__writable:
+            return
+
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT,
+                         0666)
+            try:
+                data = ''.join(lines)
+                size = os.fstat(fd).st_size
+                if self.__reset or size < len(_INDEX_HEADER):
+                    os.ftruncate(fd, 0)
+                    data = _INDEX_HEADER + data
+                    self.__reset = False
+                else:
+                    # Another process may have appended to the file since
+                    # it was loaded, so its real size is used.  If the last
+                    # line was left partly written by an interrupted update,
+                    # end it, so it is skipped when loading.
+                    os.lseek(fd, size - 1, os.SEEK_SET)
+                    if os.read(fd, 1) != '\n':
+                        data = '\n' + data
+                # Append everything with a single write, so the lines can't
+                # be interleaved with those of another process
+                while data:
+                    data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
+        except (IOError, OSError):
+            # The index is only a cache.  If we can't write to the git
+            # directory, keep using the in-memory index for this session.
+            self.__writable = False
+
+    def getSvnInfo(self, sha1):
+        """
+        index.getSvnInfo(sha1) --> (url, revision, uuid)
+
+        Get the git-svn information for the specified commit SHA1.
+        Raises GitSvnError if the commit does not have a git-svn-id.
+        """
+        self.update(sha1)
+        (parent, revision, url_id) = self.__commits[sha1]
+        if revision is None:
+            raise GitSvnError('commit %s does not have a git-svn-id' % (sha1,))
+        (url, uuid) = self.__urls[url_id]
+        return (url, revision, uuid)
+
+    def findSvnInfo(self, sha1):
+        """
+        index.findSvnInfo(sha1) --> (url, revision, uuid)
+
+        Get the git-svn information from the nearest commit with a git-svn-id,
+        following first parents starting at the specified commit SHA1.
+        """
+        self.update(sha1)
+        commit = sha1
+        while commit is not None:
+            (parent, revision, url_id) = self.__commits[commit]
+            if revision is not None:
+                (url, uuid) = self.__urls[url_id]
+                return (url, revision, uuid)
+            commit = parent
+        raise GitSvnError('no commit with a git-svn-id found in the history '
+                          'of %s' % (sha1,))
+
+    def getCommit(self, url, revision):
+        """
+        index.getCommit(url, revision) --> sha1
+
+        Get the SHA1 of the commit for the specified svn URL and revision.
+        Only commits that have already been indexed are searched.
+        """
+        try:
+            return self.__byRevision[(url, str(revision))]
+        except KeyError:
+            raise GitSvnError('no commit found for %s@%s' % (url, revision))
+
+
+_indexes = {}
+
+
+def get_svn_index(repo):
+    """
+    Get the SvnIndex for a repository.
+
+    Index objects are shared between all callers for the same git directory.
+    """
+    key = os.path.abspath(repo.getGitDir())
+    try:
+        return _indexes[key]
+    except KeyError:
+        index = SvnIndex(repo)
+        _indexes[key] = index
+        return index
+
+
 def get_svn_info(commit):
     """
     Parse the SVN URL, revision number, and UUID out of a git commit's message.
     """
-    return _parse_svn_info(commit.message)
+    return _parse_svn_info(commit.comment)
 
 
 def get_svn_url(repo, commit=None):
@@ -61,7 +392,7 @@ def get_svn_url(repo, commit=None):
         # try to parse it first.  If it contains a git-svn-id,
         # we will have avoided making an external call to git.
         try:
-            (url, rev, uuid) = _parse_svn_info(commit.message)
+            (url, rev, uuid) = _parse_svn_info(commit.comment)
             return url
         except GitSvnError:
             # It probably doesn't have a git-svn-id in the message.
@@ -69,11 +400,22 @@ def get_svn_url(repo, commit=None):
             pass
         commit = commit.sha1
 
-    # Look through the commit history for a commit with a git-svn-id
-    # in the commit message
-    args = ['log', '-1', '--no-color', '--first-parent', '--pretty=medium',
-            '--grep=^git-svn-id: ', commit]
-    out = repo.runSimpleGitCmd(args)
-
-    (url, rev, uuid) = _parse_svn_info(out)
+    # Look up the nearest commit with a git-svn-id in the index
+    sha1 = repo.getCommitSha1(commit)
+    (url, rev, uuid) = get_svn_index(repo).findSvnInfo(sha1)
     return url
+
+
+def get_svn_commit(repo, url, revision, commit=None):
+    """
+    Get the SHA1 of the commit for the specified SVN URL and revision.
+
+    The history of the specified commit (or HEAD if not specified) is indexed
+    before searching, so the result is found as long as it is reachable from
+    that commit.
+    """
+    if commit is None:
+        commit = 'HEAD'
+    index = get_svn_index(repo)
+    index.update(repo.getCommitSha1(str(commit)))
+    return index.getCommit(url, revision)
@@ -0,0 +1,221 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A persistent cache of textconv output.
+
+Files whose diff driver has a textconv command configured (for example,
+"diff.pdf.textconv = pdftotext") are shown converted to text.  Conversion
+may be slow, so the output is stored in $GIT_DIR/git-review/textconv, keyed
+by the blob SHA1 and the textconv command.  Each blob is converted at most
+once, even if it appears in several commits, or is requested by several
+threads at the same time.
+
+The directory is kept below review.textconvCacheSize megabytes (64 by
+default) by deleting the least recently used files whenever new output is
+stored.  If a MemoryBudget is supplied with setMemoryBudget(), output that
+was used recently is also kept in memory, and counted against the budget.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+# The default limit on the size of the cache directory, in megabytes.
+# Can be overridden with the review.textconvCacheSize config setting.
+DEFAULT_CACHE_SIZE = 64
+
+_MB = 1024 * 1024
+
+
+class TextconvCache(object):
+    def __init__(self, repo, path=None):
+        self.repo = repo
+        if path is None:
+            path = os.path.join(repo.getGitDir(), 'git-review', 'textconv')
+        self.path = path
+        try:
+            max_size = int(repo.config.get('review.textconvcachesize',
+                                           DEFAULT_CACHE_SIZE))
+        except ValueError:
+            max_size = DEFAULT_CACHE_SIZE
+        self.maxSize = max_size * _MB
+        # cache key --> contents, or None if no memory budget was supplied
+        self.__memCache = None
+
+        self.__lock = threading.Lock()
+        # cache file path --> lock held while that file is being created
+        self.__pending = {}
+
+    def setMemoryBudget(self, budget):
+        """
+        cache.setMemoryBudget(budget)
+
+        Keep recently used output in memory, counted against a MemoryBudget.
+        """
+        self.__memCache = budget.createCache('textconv')
+
+    def getCommand(self, driver):
+        """
+        cache.getCommand(driver) --> command, or None
+
+        Returns the textconv command configured for a diff driver, or None
+        if it has none.
+        """
+        return self.repo.config.get('diff.%s.textconv' % (driver,), None)
+
+    def writeContents(self, name, sha1, driver, outfile):
+        """
+        cache.writeContents(name, sha1, driver, outfile)
+
+        Write the textconv output for a blob to outfile, a file object.
+        name is a "<commit>:<path>" name for the blob, since git chooses the
+        textconv command based on the path, and sha1 is the blob's SHA1.
+        The driver must have a textconv command.
+        """
+        command = self.getCommand(driver)
+        key = hashlib.sha1('%s\0%s' % (command, sha1)).hexdigest()
+        cache_path = os.path.join(self.path, key[:2], key[2:])
+
+        lock = self.__getLock(cache_path)
+        lock.acquire()
+        try:
+            contents = None
+            if self.__memCache is not None:
+                contents = self.__memCache.get(key)
+            if contents is None:
+                contents = self.__read(cache_path)
+            if contents is None:
+                contents = self.__convert(name, cache_path)
+            if self.__memCache is not None:
+                self.__memCache.put(key, contents, len(contents))
+        finally:
+            lock.release()
+            self.__releaseLock(cache_path)
+        outfile.write(contents)
+        outfile.flush()
+
+    def __getLock(self, cache_path):
+        self.__lock.acquire()
+        try:
+            try:
+                (lock, count) = self.__pending[cache_path]
+            except KeyError:
+                lock = threading.Lock()
+                count = 0
+            self.__pending[cache_path] = (lock, count + 1)
+            return lock
+        finally:
+            self.__lock.release()
+
+    def __releaseLock(self, cache_path):
+        self.__lock.acquire()
+        try:
+            (lock, count) = self.__pending[cache_path]
+            if count == 1:
+                del self.__pending[cache_path]
+            else:
+                self.__pending[cache_path] = (lock, count - 1)
+        finally:
+            self.__lock.release()
+
+    def __read(self, cache_path):
+        try:
+            f = open(cache_path, 'rb')
+        except IOError:
+            return None
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        # Record the use, so __prune() deletes the least recently used files
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+        return contents
+
+    def __convert(self, name, cache_path):
+        contents = self.repo.getTextconvContents(name)
+
+        try:
+            dirname = os.path.dirname(cache_path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            (fd, tmp_path) = tempfile.mkstemp(dir=dirname,
+                                              prefix='.textconv-')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(contents)
+                finally:
+                    f.close()
+                os.rename(tmp_path, cache_path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError):
+            # The cache is only an optimization.  If we can't write to the
+            # git directory, the blob will just be converted again next time.
+            return contents
+
+        self.__prune()
+        return contents
+
+    def __prune(self):
+        """
+        Delete the least recently used files until the cache directory is
+        below its size limit.
+        """
+        files = []
+        total = 0
+        try:
+            subdirs = os.listdir(self.path)
+        except OSError:
+            return
+        for subdir in subdirs:
+            dirname = os.path.join(self.path, subdir)
+            try:
+                names = os.listdir(dirname)
+            except OSError:
+                # Not a directory, or removed by another process
+                continue
+            for filename in names:
+                if filename.startswith('.'):
+                    # A file still being written
+                    continue
+                path = os.path.join(dirname, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.maxSize:
+            return
+        files.sort()
+        for (mtime, size, path) in files:
+            try:
+                os.unlink(path)
+            except OSError, ex:
+                if ex.errno != errno.ENOENT:
+                    continue
+            total -= size
+            if total <= self.maxSize:
+                break
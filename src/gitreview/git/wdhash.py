@@ -0,0 +1,587 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Computing blob SHA1s for files in the working directory.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import Queue
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+from exceptions import *
+
+__all__ = ['get_stat_key', 'HashObjectProcess', 'hash_blob_file',
+           'WorkingDirHasher']
+
+# Files at least this large are read through mmap, rather than read()
+_MMAP_THRESHOLD = 1024 * 1024
+_READ_SIZE = 256 * 1024
+
+_MAX_THREADS = 8
+
+# The number of paths to send to "git hash-object" before reading back
+# the results.  The results are 41 bytes each, so this keeps the output
+# well below the pipe buffer size, and avoids deadlock.
+_HASH_BATCH_SIZE = 256
+
+_CACHE_HEADER = '# git-review working directory hash cache v2\n'
+
+# The maximum number of entries to keep in the cache file.  Beyond this,
+# entries that haven't been used in the current session are dropped.
+_MAX_CACHE_ENTRIES = 100000
+
+
+def _quote_path(path):
+    """
+    Quote a path for "git hash-object --stdin-paths", if necessary.
+
+    Paths that contain a newline, or start with a double quote, have to be
+    quoted C-style.
+    """
+    if '\n' not in path and not path.startswith('"'):
+        return path
+    result = ['"']
+    for c in path:
+        if c == '"' or c == '\\':
+            result.append('\\' + c)
+        elif c == '\n':
+            result.append('\\n')
+        else:
+            result.append(c)
+    result.append('"')
+    return ''.join(result)
+
+
+def get_stat_key(st):
+    """
+    get_stat_key(st) --> tuple
+
+    The parts of an os.lstat() result that change when a file is modified.
+    """
+    return (st.st_ino, st.st_mtime, st.st_ctime, st.st_size, st.st_mode)
+
+
+def _get_file_state(path):
+    try:
+        return get_stat_key(os.stat(path))
+    except OSError:
+        return None
+
+
+class _FilterState(object):
+    """
+    The configuration that decides whether git converts a file when adding
+    it: the line ending settings, and the attributes files that apply to
+    it.  Only os.stat() is used, so no git command is run.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.workDir = repo.getWorkingDir()
+
+        config = []
+        for name in ('core.autocrlf', 'core.eol'):
+            config.append(repo.config.get(name, '').lower())
+        self.convertsEol = config[0] not in ('', 'false', 'no', 'off', '0')
+
+        try:
+            global_attrs = os.path.expanduser(
+                    repo.config.get('core.attributesfile'))
+        except NoSuchConfigError:
+            config_home = os.environ.get('XDG_CONFIG_HOME')
+            if not config_home:
+                config_home = os.path.expanduser('~/.config')
+            global_attrs = os.path.join(config_home, 'git', 'attributes')
+        info_attrs = os.path.join(repo.getGitDir(), 'info', 'attributes')
+        self.globalStates = (tuple(config), _get_file_state(global_attrs),
+                             _get_file_state(info_attrs))
+
+        # directory --> tuple of .gitattributes states for the directory and
+        # its parents
+        self.__dirStates = {}
+
+    def __getDirStates(self, dirname):
+        try:
+            return self.__dirStates[dirname]
+        except KeyError:
+            pass
+        if dirname:
+            parent_states = self.__getDirStates(os.path.dirname(dirname))
+        else:
+            parent_states = ()
+        attrs_path = os.path.join(self.workDir, dirname, '.gitattributes')
+        states = parent_states + (_get_file_state(attrs_path),)
+        self.__dirStates[dirname] = states
+        return states
+
+    def getKey(self, path):
+        """
+        Returns a short string that changes whenever the filters that apply
+        to path may have changed.
+        """
+        dir_states = self.__getDirStates(os.path.dirname(path))
+        states = (self.globalStates, dir_states)
+        return hashlib.sha1(repr(states)).hexdigest()[:16]
+
+    def usesFilters(self, path):
+        """
+        Returns True if git may convert path when adding it to the
+        repository.
+        """
+        if self.convertsEol:
+            return True
+        if self.globalStates[1] is not None or \
+                self.globalStates[2] is not None:
+            return True
+        for state in self.__getDirStates(os.path.dirname(path)):
+            if state is not None:
+                return True
+        return False
+
+
+class HashObjectProcess(object):
+    """
+    A long-running "git hash-object --stdin-paths" process.
+
+    Unlike hash_blob_file(), this applies any filters configured for each
+    path, so the results are what "git add" would store.  If write is True,
+    the blobs are also written to the object database.
+    """
+    def __init__(self, repo, write=False):
+        self.repo = repo
+        self.args = ['hash-object', '--stdin-paths']
+        if write:
+            self.args.insert(1, '-w')
+        # git prints warnings (e.g., about line ending conversion) for
+        # individual files.  Send them to a file rather than a pipe, so they
+        # can't fill up the pipe and block git.
+        self.errFile = tempfile.TemporaryFile()
+        self.process = repo.popenGitCmd(self.args, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=self.errFile)
+
+    def hashPaths(self, paths):
+        """
+        Hash the specified files, and return a list of their blob SHA1s.
+        The paths are relative to the top of the working directory.
+        """
+        sha1s = []
+        for start in range(0, len(paths), _HASH_BATCH_SIZE):
+            batch = paths[start:start + _HASH_BATCH_SIZE]
+            data = ''.join([_quote_path(path) + '\n' for path in batch])
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+                for path in batch:
+                    line = self.process.stdout.readline()
+                    if len(line) != 41:
+                        raise self.__getError(path)
+                    sha1s.append(line[:40])
+            except IOError, ex:
+                if ex.errno != errno.EPIPE:
+                    raise
+                raise self.__getError(None)
+        return sha1s
+
+    def __getError(self, path):
+        self.close()
+        self.errFile.seek(0)
+        err = self.errFile.read()
+        if path is None:
+            msg = 'git hash-object exited unexpectedly'
+        else:
+            msg = 'failed to hash %r' % (path,)
+        if err:
+            msg += ': ' + err.strip()
+        return GitError(msg)
+
+    def isRunning(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            self.process.stdin = None
+        self.process.wait()
+        self.process.stdout.close()
+
+
+def hash_blob_file(path):
+    """
+    hash_blob_file(path) --> sha1
+
+    Compute the git blob SHA1 for a file: the SHA1 of "blob <size>\\0"
+    followed by the file contents.  For symbolic links, the contents are the
+    link target.  No conversion (e.g., of line endings) is performed.
+    """
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(path)
+        sha = hashlib.sha1('blob %d\0' % (len(target),))
+        sha.update(target)
+        return sha.hexdigest()
+
+    f = open(path, 'rb')
+    try:
+        # Use the size of the open file, in case it changed after lstat()
+        size = os.fstat(f.fileno()).st_size
+        if size >= _MMAP_THRESHOLD:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                sha = hashlib.sha1('blob %d\0' % (len(m),))
+                sha.update(m)
+            finally:
+                m.close()
+        else:
+            sha = hashlib.sha1('blob %d\0' % (size,))
+            length = 0
+            while True:
+                data = f.read(_READ_SIZE)
+                if not data:
+                    break
+                length += len(data)
+                sha.update(data)
+            if length != size:
+                # The file changed while we were reading it.  Recompute
+                # with the correct length.
+                f.seek(0)
+                data = f.read()
+                sha = hashlib.sha1('blob %d\0' % (len(data),))
+                sha.update(data)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+
+class _HashWorker(threading.Thread):
+    def __init__(self, work_queue, results):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.workQueue = work_queue
+        self.results = results
+
+    def run(self):
+        while True:
+            item = self.workQueue.get()
+            if item is None:
+                return
+            (path, full_path) = item
+            try:
+                result = hash_blob_file(full_path)
+            except (IOError, OSError), ex:
+                result = ex
+            # list.append() is atomic
+            self.results.append((path, result))
+
+
+class WorkingDirHasher(object):
+    """
+    Computes blob SHA1s for files in a repository's working directory.
+
+    Files are hashed in parallel using a pool of threads.  (hashlib and file
+    I/O release the interpreter lock, so the threads do run concurrently.)
+    Results are cached along with each file's stat information, and the
+    cache is saved in the git directory, so files that haven't changed are
+    not read again, even by later git-review processes.  The snapshot code
+    uses the same cache.
+
+    If line ending conversion or gitattributes may apply to a file, the
+    contents git would store can differ from the contents in the working
+    directory.  Such files are hashed with "git hash-object" instead, so the
+    results match what git would compute.  The state of the attributes
+    files and the line ending configuration is part of each cache entry, so
+    changing them invalidates the cached results.
+    """
+    def __init__(self, repo, path=None):
+        self.repo = repo
+        if path is None:
+            path = os.path.join(repo.getGitDir(), 'git-review',
+                                'wd-hash-cache')
+        self.path = path
+        self.numThreads = _get_num_threads()
+
+        # path --> (stat key, filter key, sha1)
+        self.__cache = {}
+        # The paths whose cache entries were used or added in this session
+        self.__used = set()
+        self.__dirty = False
+        # Snapshot threads and diff callers may hash files at the same time
+        self.__lock = threading.Lock()
+
+        self.__load()
+
+    def __load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        if not data.startswith(_CACHE_HEADER):
+            # A missing header, or a cache written by an older version.
+            # It will be replaced the next time it is saved.
+            return
+
+        records = data[len(_CACHE_HEADER):].split('\0')
+        # The last record is empty if the file was completely written
+        for record in records[:-1]:
+            try:
+                (sha1, inode, mtime, ctime, size, mode, filter_key,
+                 path) = record.split(' ', 7)
+                key = (int(inode), float(mtime), float(ctime), int(size),
+                       int(mode, 8))
+                self.__cache[path] = (key, filter_key, sha1)
+            except ValueError:
+                # Ignore damaged records.  The file will be rewritten
+                # without them.
+                self.__dirty = True
+
+    def save(self):
+        """
+        Write the cache to disk, if it has changed.
+        """
+        self.__lock.acquire()
+        try:
+            self.__save()
+        finally:
+            self.__lock.release()
+
+    def __save(self):
+        if not self.__dirty:
+            return
+
+        items = self.__cache.items()
+        if len(items) > _MAX_CACHE_ENTRIES:
+            items = [(path, value) for (path, value) in items
+                     if path in self.__used]
+
+        records = []
+        for (path, (key, filter_key, sha1)) in items:
+            (inode, mtime, ctime, size, mode) = key
+            records.append('%s %d %r %r %d %o %s %s\0' %
+                           (sha1, inode, mtime, ctime, size, mode,
+                            filter_key, path))
+
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            (fd, tmp_path) = tempfile.mkstemp(dir=dirname,
+                                              prefix='.wd-hash-cache-')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(_CACHE_HEADER)
+                    f.write(''.join(records))
+                finally:
+                    f.close()
+                os.rename(tmp_path, self.path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError):
+            # The cache is only an optimization.  If we can't write to the
+            # git directory, just keep the in-memory cache.
+            return
+        self.__dirty = False
+
+    def getCachedSha1(self, path, st):
+        """
+        hasher.getCachedSha1(path, st) --> sha1, or None
+
+        Returns the cached SHA1 for a file, if its stat information (as
+        returned by os.lstat()) and its filters haven't changed since it
+        was hashed.
+        """
+        filters = _FilterState(self.repo)
+        self.__lock.acquire()
+        try:
+            return self.__getCachedSha1(path, st, filters.getKey(path))
+        finally:
+            self.__lock.release()
+
+    def __getCachedSha1(self, path, st, filter_key):
+        try:
+            (key, cached_filter_key, sha1) = self.__cache[path]
+        except KeyError:
+            return None
+        if key != get_stat_key(st) or cached_filter_key != filter_key:
+            return None
+        self.__used.add(path)
+        return sha1
+
+    def hashFiles(self, paths):
+        """
+        hasher.hashFiles(paths) --> dict of path --> sha1
+
+        Compute the blob SHA1s for the specified files, which are relative to
+        the top of the working directory.  Files that don't exist (or are
+        directories, such as submodules) are left out of the result.
+        """
+        work_dir = self.repo.getWorkingDir()
+        if work_dir is None:
+            raise NoWorkingDirError(self.repo)
+
+        filters = _FilterState(self.repo)
+        results = {}
+        to_hash = []
+        stats = {}
+        filter_keys = {}
+        self.__lock.acquire()
+        try:
+            for path in paths:
+                full_path = os.path.join(work_dir, path)
+                try:
+                    st = os.lstat(full_path)
+                except OSError, ex:
+                    if ex.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        raise
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    continue
+
+                stats[path] = st
+                filter_keys[path] = filters.getKey(path)
+                sha1 = self.__getCachedSha1(path, st, filter_keys[path])
+                if sha1 is None:
+                    to_hash.append(path)
+                else:
+                    results[path] = sha1
+        finally:
+            self.__lock.release()
+
+        if not to_hash:
+            return results
+
+        hashed_time = time.time()
+        with_git = []
+        without_git = []
+        for path in to_hash:
+            if filters.usesFilters(path):
+                with_git.append(path)
+            else:
+                without_git.append(path)
+        hashed = self.__hashInThreads(work_dir, without_git)
+        if with_git:
+            hashed.extend(self.__hashWithGit(with_git))
+
+        self.__lock.acquire()
+        try:
+            for (path, sha1) in hashed:
+                results[path] = sha1
+
+                # Only cache the result if the file didn't change while we
+                # were hashing it, and wasn't modified so recently that a
+                # subsequent change might not update the mtime.
+                st = stats[path]
+                if st.st_mtime >= hashed_time - 1:
+                    continue
+                try:
+                    new_st = os.lstat(os.path.join(work_dir, path))
+                except OSError:
+                    continue
+                key = get_stat_key(st)
+                if get_stat_key(new_st) != key:
+                    continue
+                self.__cache[path] = (key, filter_keys[path], sha1)
+                self.__used.add(path)
+                self.__dirty = True
+        finally:
+            self.__lock.release()
+
+        return results
+
+    def __hashInThreads(self, work_dir, paths):
+        results = []
+        num_threads = min(self.numThreads, len(paths))
+        if num_threads <= 1:
+            for path in paths:
+                try:
+                    sha1 = hash_blob_file(os.path.join(work_dir, path))
+                except (IOError, OSError), ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    continue
+                results.append((path, sha1))
+            return results
+
+        work_queue = Queue.Queue()
+        thread_results = []
+        threads = [_HashWorker(work_queue, thread_results)
+                   for n in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for path in paths:
+            work_queue.put((path, os.path.join(work_dir, path)))
+        for thread in threads:
+            work_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        for (path, result) in thread_results:
+            if isinstance(result, EnvironmentError):
+                if result.errno == errno.ENOENT:
+                    # The file was deleted after we checked it
+                    continue
+                raise result
+            results.append((path, result))
+        return results
+
+    def __hashWithGit(self, paths):
+        # Symlinks aren't affected by filters, and hash-object would follow
+        # them, so hash those directly
+        work_dir = self.repo.getWorkingDir()
+        results = []
+        file_paths = []
+        for path in paths:
+            full_path = os.path.join(work_dir, path)
+            if os.path.islink(full_path):
+                results.append((path, hash_blob_file(full_path)))
+            else:
+                file_paths.append(path)
+
+        if file_paths:
+            process = HashObjectProcess(self.repo)
+            try:
+                sha1s = process.hashPaths(file_paths)
+            finally:
+                process.close()
+            results.extend(zip(file_paths, sha1s))
+        return results
+
+
+def _get_num_threads():
+    try:
+        num_cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError, OSError):
+        num_cpus = 1
+    return max(1, min(_MAX_THREADS, num_cpus))
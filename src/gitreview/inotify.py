@@ -0,0 +1,196 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A minimal interface to the Linux inotify API.
+
+This calls the C library via ctypes, so no extension modules are required.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+# Event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# Flags for inotify_init1().  These have the same values as O_NONBLOCK and
+# O_CLOEXEC.
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+# The events that indicate a file's contents or metadata may have changed
+CHANGE_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+class InotifyError(Exception):
+    def __init__(self, msg, errno=None):
+        Exception.__init__(self, msg)
+        self.errno = errno
+
+
+class _Libc(object):
+    def __init__(self):
+        self.lib = None
+
+        path = ctypes.util.find_library('c')
+        if path is None:
+            return
+        try:
+            lib = ctypes.CDLL(path, use_errno=True)
+        except OSError:
+            return
+        if not hasattr(lib, 'inotify_init1'):
+            return
+        self.lib = lib
+
+
+_libc = _Libc()
+
+
+def is_available():
+    """
+    Returns True if inotify is available on this platform.
+    """
+    return _libc.lib is not None
+
+
+def _raise_errno(msg):
+    err = ctypes.get_errno()
+    raise InotifyError('%s: %s' % (msg, os.strerror(err)), err)
+
+
+class Event(object):
+    def __init__(self, wd, path, name, mask, cookie):
+        # The watch descriptor and watched path, and the name of the file
+        # within it that the event is for.  name is empty for events about
+        # the watched path itself.
+        self.wd = wd
+        self.path = path
+        self.name = name
+        self.mask = mask
+        self.cookie = cookie
+
+    def __repr__(self):
+        return 'Event(%r, %r, 0x%x)' % (self.path, self.name, self.mask)
+
+
+class Inotify(object):
+    """
+    An inotify instance.
+
+    The file descriptor is non-blocking, so readEvents() returns immediately
+    if no events are pending.  fileno() can be used with select() or poll()
+    to wait for events.
+    """
+    def __init__(self):
+        if not is_available():
+            raise InotifyError('inotify is not available on this platform')
+        self.fd = _libc.lib.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            _raise_errno('inotify_init1')
+        # watch descriptor --> path
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self.watches = {}
+
+    def addWatch(self, path, mask=CHANGE_EVENTS):
+        """
+        Watch the specified path.  Returns the watch descriptor.
+        """
+        wd = _libc.lib.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            _raise_errno('unable to watch %r' % (path,))
+        self.watches[wd] = path
+        return wd
+
+    def removeWatch(self, wd):
+        if _libc.lib.inotify_rm_watch(self.fd, wd) < 0:
+            _raise_errno('inotify_rm_watch')
+        del self.watches[wd]
+
+    def readEvents(self):
+        """
+        inotify.readEvents() --> list of Event
+
+        Read all of the pending events.
+
+        If the kernel's event queue overflowed, an event with the
+        IN_Q_OVERFLOW flag set and a path of None is returned, and some
+        events have been lost.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, _READ_SIZE)
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+            self.__parseEvents(data, events)
+        return events
+
+    def __parseEvents(self, data, events):
+        offset = 0
+        end = len(data)
+        while offset < end:
+            (wd, mask, cookie, name_len) = \
+                    _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip('\0')
+            offset += name_len
+
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                # The watch was removed, either explicitly or because the
+                # watched path was deleted
+                try:
+                    del self.watches[wd]
+                except KeyError:
+                    pass
+            events.append(Event(wd, path, name, mask, cookie))
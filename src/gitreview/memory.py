@@ -0,0 +1,463 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A memory budget shared by all of git-review's caches.
+
+Each cache is created with MemoryBudget.createCache(), and reports the
+approximate size of every entry it stores.  When the total exceeds the
+budget, entries are evicted from whichever cache the eviction policy
+chooses.  Data that can't be evicted, such as the diff being reviewed, is
+registered with addUsage() so that it is counted against the budget, and
+leaves less room for the caches.
+"""
+
+import collections
+import heapq
+import itertools
+import sys
+import threading
+
+POLICY_LRU = 'lru'
+POLICY_LFU = 'lfu'
+POLICY_ARC = 'arc'
+POLICIES = (POLICY_LRU, POLICY_LFU, POLICY_ARC)
+
+# The default budget, in megabytes.
+# Can be overridden with the review.memoryBudget config setting.
+DEFAULT_BUDGET = 128
+
+MB = 1024 * 1024
+
+# When estimating the size of a long list, only look at this many of its
+# items, and assume the rest are similar
+_SAMPLE_SIZE = 100
+
+
+class BudgetError(Exception):
+    pass
+
+
+def estimate_size(obj):
+    """
+    estimate_size(obj) --> bytes
+
+    Estimate the memory used by an object and everything it refers to.
+    Objects referred to more than once are only counted once.  Long lists
+    and dicts are sampled, so this is only approximate, but the cost does not
+    grow with their length.
+    """
+    seen = set()
+    def get_size(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+
+        size = sys.getsizeof(obj)
+        if isinstance(obj, (str, unicode, int, long, float, bool)) or \
+                obj is None:
+            return size
+        if isinstance(obj, dict):
+            # Dicts have no particular order, so the first items are as
+            # good a sample as any
+            sample = list(itertools.islice(obj.iteritems(), _SAMPLE_SIZE))
+            sample_size = sum([get_size(key) + get_size(value)
+                               for (key, value) in sample])
+            if sample:
+                size += sample_size * len(obj) // len(sample)
+            return size
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            items = list(obj)
+            if len(items) > _SAMPLE_SIZE:
+                step = len(items) // _SAMPLE_SIZE
+                sample = items[::step][:_SAMPLE_SIZE]
+                sample_size = sum([get_size(item) for item in sample])
+                return size + sample_size * len(items) // len(sample)
+            return size + sum([get_size(item) for item in items])
+
+        if hasattr(obj, '__dict__'):
+            size += get_size(obj.__dict__)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                size += get_size(getattr(obj, name))
+        return size
+
+    return get_size(obj)
+
+
+def format_size(size):
+    if size < 1024:
+        return '%d B' % (size,)
+    if size < MB:
+        return '%.1f KB' % (size / 1024.0,)
+    if size < 1024 * MB:
+        return '%.1f MB' % (float(size) / MB,)
+    return '%.1f GB' % (float(size) / (1024 * MB),)
+
+
+class LruPolicy(object):
+    """
+    Evicts the least recently used entry.
+    """
+    def __init__(self, limit):
+        self.__entries = collections.OrderedDict()
+
+    def add(self, key, size):
+        self.__entries[key] = True
+
+    def hit(self, key):
+        del self.__entries[key]
+        self.__entries[key] = True
+
+    def remove(self, key):
+        del self.__entries[key]
+
+    def victim(self):
+        for key in self.__entries:
+            del self.__entries[key]
+            return key
+        return None
+
+
+class LfuPolicy(object):
+    """
+    Evicts the least frequently used entry.  Ties are broken in favor of
+    evicting the least recently used.
+    """
+    def __init__(self, limit):
+        # key --> (count, sequence number)
+        self.__entries = {}
+        # A heap of (count, sequence number, key).  Entries whose values
+        # don't match self.__entries are stale, and are skipped.
+        self.__heap = []
+        self.__sequence = 0
+
+    def __push(self, key, count):
+        self.__sequence += 1
+        self.__entries[key] = (count, self.__sequence)
+        heapq.heappush(self.__heap, (count, self.__sequence, key))
+        # Rebuild the heap if most of it is stale
+        if len(self.__heap) > 2 * len(self.__entries) + 64:
+            self.__heap = [(count, seq, key) for (key, (count, seq))
+                           in self.__entries.iteritems()]
+            heapq.heapify(self.__heap)
+
+    def add(self, key, size):
+        self.__push(key, 1)
+
+    def hit(self, key):
+        self.__push(key, self.__entries[key][0] + 1)
+
+    def remove(self, key):
+        del self.__entries[key]
+
+    def victim(self):
+        while self.__heap:
+            (count, seq, key) = heapq.heappop(self.__heap)
+            if self.__entries.get(key) == (count, seq):
+                del self.__entries[key]
+                return key
+        return None
+
+
+class ArcPolicy(object):
+    """
+    Adaptive replacement cache.
+
+    Entries that have been used once are kept in t1, and entries that have
+    been used more than once in t2.  Keys recently evicted from each are
+    remembered in the "ghost" lists b1 and b2.  A miss on a ghost key shows
+    that the corresponding list was too small, and shifts the target size
+    of t1 accordingly.  This adapts between LRU and LFU behavior, and
+    resists being flushed by a scan of entries that are used only once.
+
+    The lists are sized in bytes rather than entries, since cache entries
+    vary greatly in size.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        # The target size of t1
+        self.target = 0
+        # key --> size, in least recently used order
+        self.__t1 = collections.OrderedDict()
+        self.__t2 = collections.OrderedDict()
+        self.__b1 = collections.OrderedDict()
+        self.__b2 = collections.OrderedDict()
+        self.__sizes = {'t1': 0, 't2': 0, 'b1': 0, 'b2': 0}
+
+    def __insert(self, name, entries, key, size):
+        entries[key] = size
+        self.__sizes[name] += size
+
+    def __pop(self, name, entries, key):
+        size = entries.pop(key)
+        self.__sizes[name] -= size
+        return size
+
+    def add(self, key, size):
+        sizes = self.__sizes
+        if key in self.__b1:
+            # t1 was too small
+            delta = max(sizes['b2'] // max(sizes['b1'], 1), 1) * size
+            self.target = min(self.target + delta, self.limit)
+            self.__pop('b1', self.__b1, key)
+            self.__insert('t2', self.__t2, key, size)
+        elif key in self.__b2:
+            # t2 was too small
+            delta = max(sizes['b1'] // max(sizes['b2'], 1), 1) * size
+            self.target = max(self.target - delta, 0)
+            self.__pop('b2', self.__b2, key)
+            self.__insert('t2', self.__t2, key, size)
+        else:
+            self.__insert('t1', self.__t1, key, size)
+
+    def hit(self, key):
+        if key in self.__t1:
+            size = self.__pop('t1', self.__t1, key)
+        else:
+            size = self.__pop('t2', self.__t2, key)
+        self.__insert('t2', self.__t2, key, size)
+
+    def remove(self, key):
+        if key in self.__t1:
+            self.__pop('t1', self.__t1, key)
+        else:
+            self.__pop('t2', self.__t2, key)
+
+    def victim(self):
+        if self.__t1 and (self.__sizes['t1'] > self.target or
+                          not self.__t2):
+            (name, entries, ghost_name, ghosts) = \
+                    ('t1', self.__t1, 'b1', self.__b1)
+        elif self.__t2:
+            (name, entries, ghost_name, ghosts) = \
+                    ('t2', self.__t2, 'b2', self.__b2)
+        else:
+            return None
+
+        for key in entries:
+            break
+        size = self.__pop(name, entries, key)
+        self.__insert(ghost_name, ghosts, key, size)
+
+        # Only remember as many ghosts as would fit in the budget
+        while self.__sizes['b1'] + self.__sizes['b2'] > self.limit:
+            if self.__sizes['b1'] > self.__sizes['b2']:
+                for ghost in self.__b1:
+                    break
+                self.__pop('b1', self.__b1, ghost)
+            else:
+                for ghost in self.__b2:
+                    break
+                self.__pop('b2', self.__b2, ghost)
+        return key
+
+
+_POLICY_CLASSES = {
+    POLICY_LRU: LruPolicy,
+    POLICY_LFU: LfuPolicy,
+    POLICY_ARC: ArcPolicy,
+}
+
+
+class BudgetCache(object):
+    """
+    A cache whose entries are counted against a MemoryBudget.
+
+    Entries may be evicted at any time to make room for new entries in this
+    or any other cache sharing the budget.  If on_evict was specified, it is
+    called with the key and value of each entry that is evicted.
+    """
+    def __init__(self, budget, name, on_evict=None):
+        self.budget = budget
+        self.name = name
+        self.onEvict = on_evict
+        # key --> (value, size)
+        self.entries = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        return self.budget._get(self, key, default)
+
+    def put(self, key, value, size=None):
+        """
+        Store a value in the cache.  If size is not specified, it is
+        estimated with estimate_size().
+        """
+        if size is None:
+            size = estimate_size(value)
+        self.budget._put(self, key, value, size)
+
+    def discard(self, key):
+        self.budget._discard(self, key)
+
+    def clear(self):
+        for key in self.entries.keys():
+            self.budget._discard(self, key)
+
+
+class MemoryBudget(object):
+    """
+    Limits the total memory used by a set of caches.
+    """
+    def __init__(self, limit, policy=POLICY_LRU):
+        try:
+            policy_class = _POLICY_CLASSES[policy]
+        except KeyError:
+            raise BudgetError('unknown cache policy %r: expected one of %s' %
+                              (policy, ', '.join(POLICIES)))
+        self.limit = limit
+        self.policyName = policy
+        self.__policy = policy_class(limit)
+        self.__lock = threading.RLock()
+        # name --> BudgetCache
+        self.__caches = {}
+        # name --> [function, size]
+        self.__usage = {}
+        self.__cacheSize = 0
+        self.__fixedSize = 0
+
+    def createCache(self, name, on_evict=None):
+        if self.__caches.has_key(name) or self.__usage.has_key(name):
+            raise BudgetError('%r is already registered' % (name,))
+        cache = BudgetCache(self, name, on_evict)
+        self.__caches[name] = cache
+        return cache
+
+    def addUsage(self, name, function):
+        """
+        Count memory that can't be evicted against the budget.  function
+        is called with no arguments by updateUsage(), and returns the
+        current size, in bytes.
+        """
+        if self.__caches.has_key(name) or self.__usage.has_key(name):
+            raise BudgetError('%r is already registered' % (name,))
+        self.__usage[name] = [function, 0]
+        self.updateUsage()
+
+    def updateUsage(self):
+        """
+        Recompute the memory registered with addUsage(), and evict cache
+        entries if the total is now over budget.
+        """
+        self.__lock.acquire()
+        try:
+            total = 0
+            for info in self.__usage.itervalues():
+                info[1] = info[0]()
+                total += info[1]
+            self.__fixedSize = total
+            self.__makeRoom()
+        finally:
+            self.__lock.release()
+
+    def getTotalSize(self):
+        return self.__cacheSize + self.__fixedSize
+
+    def getUsage(self):
+        """
+        budget.getUsage() --> list of (name, size, cache)
+
+        Returns the memory used by each cache and each addUsage()
+        registration, sorted by name.  cache is None for the latter.
+        """
+        results = []
+        for (name, cache) in self.__caches.iteritems():
+            results.append((name, cache.size, cache))
+        for (name, (function, size)) in self.__usage.iteritems():
+            results.append((name, size, None))
+        results.sort()
+        return results
+
+    def _get(self, cache, key, default):
+        self.__lock.acquire()
+        try:
+            try:
+                (value, size) = cache.entries[key]
+            except KeyError:
+                cache.misses += 1
+                return default
+            cache.hits += 1
+            self.__policy.hit((cache.name, key))
+            return value
+        finally:
+            self.__lock.release()
+
+    def _put(self, cache, key, value, size):
+        self.__lock.acquire()
+        try:
+            if key in cache.entries:
+                self.__remove(cache, key)
+            if size > self.limit - self.__fixedSize:
+                # This would evict everything else, and still not fit
+                return
+            cache.entries[key] = (value, size)
+            cache.size += size
+            self.__cacheSize += size
+            self.__policy.add((cache.name, key), size)
+            self.__makeRoom()
+        finally:
+            self.__lock.release()
+
+    def _discard(self, cache, key):
+        self.__lock.acquire()
+        try:
+            if key in cache.entries:
+                self.__remove(cache, key)
+        finally:
+            self.__lock.release()
+
+    def __remove(self, cache, key):
+        (value, size) = cache.entries.pop(key)
+        cache.size -= size
+        self.__cacheSize -= size
+        self.__policy.remove((cache.name, key))
+        return value
+
+    def __makeRoom(self):
+        while self.__cacheSize + self.__fixedSize > self.limit:
+            victim = self.__policy.victim()
+            if victim is None:
+                return
+            (name, key) = victim
+            cache = self.__caches[name]
+            (value, size) = cache.entries.pop(key)
+            cache.size -= size
+            cache.evictions += 1
+            self.__cacheSize -= size
+            if cache.onEvict is not None:
+                cache.onEvict(key, value)
+
+
+def get_budget(repo):
+    """
+    get_budget(repo) --> MemoryBudget
+
+    Create a MemoryBudget, using the size and policy configured with the
+    review.memoryBudget (in megabytes) and review.cachePolicy settings.
+    """
+    limit = int(repo.config.get('review.memorybudget', DEFAULT_BUDGET)) * MB
+    policy = repo.config.get('review.cachepolicy', POLICY_LRU).lower()
+    return MemoryBudget(limit, policy)
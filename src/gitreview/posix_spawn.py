@@ -0,0 +1,246 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A subprocess.Popen subclass that launches children with posix_spawn().
+
+subprocess.Popen uses fork(), which has to copy the parent's page tables.
+Once the parent process holds large caches, this makes each command
+noticeably more expensive.  glibc and macOS implement posix_spawn() with
+vfork-like semantics, so the cost of launching a command does not grow with
+the size of the parent.
+
+This module calls posix_spawn() from the C library via ctypes, since the
+os module does not provide it.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import subprocess
+import types
+
+
+class _Libc(object):
+    def __init__(self):
+        self.lib = None
+        self.supportsCwd = False
+        self.supportsClosefrom = False
+
+        path = ctypes.util.find_library('c')
+        if path is None:
+            return
+        try:
+            lib = ctypes.CDLL(path, use_errno=True)
+        except OSError:
+            return
+        if not hasattr(lib, 'posix_spawn'):
+            return
+
+        self.lib = lib
+        self.supportsCwd = hasattr(lib, 'posix_spawn_file_actions_addchdir_np')
+        self.supportsClosefrom = \
+                hasattr(lib, 'posix_spawn_file_actions_addclosefrom_np')
+
+
+_libc = _Libc()
+
+# posix_spawn_file_actions_t is opaque.  It is 80 bytes with glibc, and a
+# single pointer on macOS.  Allocate more than enough for either.
+_FILE_ACTIONS_SIZE = 512
+
+
+def is_available():
+    """
+    Returns True if posix_spawn() is available on this platform.
+    """
+    return _libc.lib is not None
+
+
+def supports_cwd():
+    """
+    Returns True if children can be started in a different working
+    directory.  This requires posix_spawn_file_actions_addchdir_np(),
+    which is available in glibc 2.29 and later, and macOS 10.15 and later.
+    """
+    return _libc.supportsCwd
+
+
+def _set_cloexec(fd):
+    try:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    except (IOError, OSError):
+        pass
+
+
+def supports_close_fds():
+    """
+    Returns True if all other descriptors can be closed in the child, for
+    close_fds=True.  This requires posix_spawn_file_actions_addclosefrom_np(),
+    which is available in glibc 2.34 and later.
+    """
+    return _libc.supportsClosefrom
+
+
+def _find_executable(name, env):
+    """
+    Search PATH for the specified program, the same way os.execvpe() does.
+
+    posix_spawnp() searches the parent's PATH, rather than the PATH in the
+    child's environment, so the search is performed here instead.
+    """
+    if os.path.dirname(name):
+        return name
+
+    if env is None:
+        env = os.environ
+    path = env.get('PATH', os.defpath)
+    last_error = errno.ENOENT
+    for dirname in path.split(os.pathsep):
+        full_path = os.path.join(dirname, name)
+        if os.access(full_path, os.X_OK) and not os.path.isdir(full_path):
+            return full_path
+        if os.path.exists(full_path):
+            last_error = errno.EACCES
+    raise OSError(last_error, os.strerror(last_error))
+
+
+def _make_string_array(strings):
+    array = (ctypes.c_char_p * (len(strings) + 1))()
+    array[:-1] = strings
+    array[-1] = None
+    return array
+
+
+def _check_call(ret):
+    # The posix_spawn functions return an error number,
+    # rather than setting errno.
+    if ret != 0:
+        raise OSError(ret, os.strerror(ret))
+
+
+class PosixSpawnPopen(subprocess.Popen):
+    """
+    A subprocess.Popen that starts the child with posix_spawn().
+
+    preexec_fn, shell, and Windows-specific arguments are not supported.
+
+    Where posix_spawn() can't close the other descriptors in the child (see
+    supports_close_fds()), close_fds=True falls back to fork() and exec().
+    Marking descriptors close-on-exec in the parent instead would race with
+    other threads opening new descriptors.
+    """
+    def _execute_child(self, args, executable, preexec_fn, close_fds,
+                       cwd, env, universal_newlines,
+                       startupinfo, creationflags, shell, to_close,
+                       p2cread, p2cwrite,
+                       c2pread, c2pwrite,
+                       errread, errwrite):
+        if close_fds and not supports_close_fds():
+            return subprocess.Popen._execute_child(
+                    self, args, executable, preexec_fn, close_fds,
+                    cwd, env, universal_newlines,
+                    startupinfo, creationflags, shell, to_close,
+                    p2cread, p2cwrite,
+                    c2pread, c2pwrite,
+                    errread, errwrite)
+        if preexec_fn is not None:
+            raise ValueError('preexec_fn is not supported with posix_spawn')
+        if shell:
+            raise ValueError('shell is not supported with posix_spawn')
+        if cwd is not None and not supports_cwd():
+            raise ValueError('cwd is not supported with posix_spawn '
+                             'on this platform')
+
+        if isinstance(args, types.StringTypes):
+            args = [args]
+        else:
+            args = list(args)
+        if executable is None:
+            executable = args[0]
+        executable = _find_executable(executable, env)
+
+        if env is None:
+            env = os.environ
+        env_list = ['%s=%s' % (name, value) for (name, value) in env.items()]
+
+        lib = _libc.lib
+        actions = ctypes.create_string_buffer(_FILE_ACTIONS_SIZE)
+        _check_call(lib.posix_spawn_file_actions_init(actions))
+
+        # The child's ends of the pipes, which we close in the parent once
+        # the child has started
+        child_ends = []
+        for (child_end, parent_end) in ((p2cread, p2cwrite),
+                                        (c2pwrite, c2pread),
+                                        (errwrite, errread)):
+            if child_end is not None and parent_end is not None:
+                child_ends.append(child_end)
+
+        # Descriptors we dup in the parent to avoid clobbering 0, 1, or 2
+        # before they have been dup'ed into place (see Python issue #12607)
+        tmp_fds = []
+        try:
+            if c2pwrite == 0:
+                c2pwrite = os.dup(c2pwrite)
+                tmp_fds.append(c2pwrite)
+            if errwrite == 0 or errwrite == 1:
+                errwrite = os.dup(errwrite)
+                tmp_fds.append(errwrite)
+
+            for (fd, child_fd) in ((p2cread, 0), (c2pwrite, 1),
+                                   (errwrite, 2)):
+                if fd is None:
+                    continue
+                # dup2() clears FD_CLOEXEC on the new descriptor, so the
+                # original can be marked close-on-exec.
+                if fd != child_fd:
+                    _set_cloexec(fd)
+                _check_call(lib.posix_spawn_file_actions_adddup2(
+                        actions, fd, child_fd))
+            for fd in (p2cwrite, c2pread, errread):
+                if fd is not None:
+                    _set_cloexec(fd)
+
+            if cwd is not None:
+                _check_call(lib.posix_spawn_file_actions_addchdir_np(
+                        actions, cwd))
+
+            if close_fds:
+                # This runs after the dup2() actions, so only descriptors
+                # other than 0, 1, and 2 are closed
+                _check_call(lib.posix_spawn_file_actions_addclosefrom_np(
+                        actions, 3))
+
+            pid = ctypes.c_int()
+            argv = _make_string_array(args)
+            envp = _make_string_array(env_list)
+            _check_call(lib.posix_spawn(ctypes.byref(pid), executable,
+                                        actions, None, argv, envp))
+        finally:
+            lib.posix_spawn_file_actions_destroy(actions)
+            for fd in tmp_fds:
+                os.close(fd)
+
+        self.pid = pid.value
+        self._child_created = True
+
+        for fd in child_ends:
+            if fd in to_close:
+                os.close(fd)
+                to_close.remove(fd)
@@ -18,9 +18,14 @@
 Utility wrapper functions around Python's subprocess module.
 """
 
+import errno
+import os
+import select
 import subprocess
 import types
 
+import posix_spawn
+
 PIPE = subprocess.PIPE
 STDOUT = subprocess.STDOUT
 
@@ -41,6 +46,34 @@ to indicate that any exit code or signal should be allowed.
 """
 ANY = -1
 
+"""
+The default number of bytes read from a command's stdout at a time by
+stream_cmd().
+"""
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+"""
+The default maximum number of bytes of stderr output retained by
+stream_cmd().  Additional stderr output is read and discarded.
+"""
+DEFAULT_MAX_STDERR = 64 * 1024
+
+"""
+Process launch backends, for use with set_spawn_backend().
+
+SPAWN_FORK uses subprocess.Popen, which forks the current process.
+SPAWN_POSIX uses posix_spawn(), which doesn't need to copy the parent's page
+tables, and so stays cheap as the parent process grows.
+"""
+SPAWN_FORK = 'fork'
+SPAWN_POSIX = 'posix_spawn'
+SPAWN_BACKENDS = (SPAWN_FORK, SPAWN_POSIX)
+
+_spawn_backend = SPAWN_FORK
+
+# Functions called by popen_cmd() before launching each command
+_spawn_hooks = []
+
 
 class ProcError(Exception):
     pass
@@ -112,11 +145,61 @@ def check_status(args, status, expected_rc=0, expected_sig=None, cmd_err=None):
         check_signal(args, -status, expected_sig, cmd_err)
 
 
+def set_spawn_backend(backend):
+    """
+    set_spawn_backend(backend)
+
+    Select the mechanism used by popen_cmd() and the run_*() functions to
+    launch commands.  backend must be one of SPAWN_BACKENDS.
+
+    Raises ProcError if the backend is not supported on this platform.
+    """
+    global _spawn_backend
+    if backend not in SPAWN_BACKENDS:
+        raise ProcError('unknown spawn backend %r: must be one of %s' %
+                        (backend, ', '.join(SPAWN_BACKENDS)))
+    if backend == SPAWN_POSIX and not posix_spawn.is_available():
+        raise ProcError('posix_spawn() is not available on this platform')
+    _spawn_backend = backend
+
+
+def get_spawn_backend():
+    return _spawn_backend
+
+
+def add_spawn_hook(hook):
+    """
+    add_spawn_hook(hook)
+
+    Register a function to be called as hook(args, cwd) each time
+    popen_cmd() or any of the run_*() or stream_*() functions launches a
+    command.  This is intended for recording the commands run, e.g., to
+    check how many times an operation runs git.
+    """
+    _spawn_hooks.append(hook)
+
+
+def remove_spawn_hook(hook):
+    _spawn_hooks.remove(hook)
+
+
+def _get_popen_class(cwd):
+    if _spawn_backend == SPAWN_POSIX:
+        # Fall back to fork() for the rare platforms where posix_spawn()
+        # can't change the child's working directory.
+        if cwd is None or posix_spawn.supports_cwd():
+            return posix_spawn.PosixSpawnPopen
+    return subprocess.Popen
+
+
 def popen_cmd(args, cwd=None, env=None, stdin='/dev/null',
               stdout=subprocess.PIPE, stderr=subprocess.PIPE):
     """
     Wrapper around subprocess.Popen() that also accepts filenames
     for stdin/stdout/stderr.
+
+    The command is launched using the backend selected with
+    set_spawn_backend().
     """
     if isinstance(stdin, types.StringTypes):
         stdin = file(stdin, 'r')
@@ -125,9 +208,13 @@ def popen_cmd(args, cwd=None, env=None, stdin='/dev/null',
     if isinstance(stderr, types.StringTypes):
         stderr = file(stderr, 'w')
 
+    for hook in _spawn_hooks:
+        hook(args, cwd)
+
     # close_fds=True is always a good thing
-    p = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr,
-                         cwd=cwd, env=env, close_fds=True)
+    popen_class = _get_popen_class(cwd)
+    p = popen_class(args, stdin=stdin, stdout=stdout, stderr=stderr,
+                    cwd=cwd, env=env, close_fds=True)
     return p
 
 
@@ -206,3 +293,179 @@ def run_oneline_cmd(args, cwd=None, env=None):
         raise CmdFailedError(args, msg)
 
     return lines[0]
+
+
+class _StderrBuffer(object):
+    """
+    Accumulates a command's stderr output, retaining at most max_size bytes.
+    """
+    def __init__(self, max_size):
+        self.maxSize = max_size
+        self.chunks = []
+        self.size = 0
+        self.discarded = 0
+
+    def add(self, data):
+        room = self.maxSize - self.size
+        if room > 0:
+            kept = data[:room]
+            self.chunks.append(kept)
+            self.size += len(kept)
+        self.discarded += max(len(data) - room, 0)
+
+    def getvalue(self):
+        value = ''.join(self.chunks)
+        if self.discarded:
+            value += '\n[%d more bytes of output discarded]' % \
+                    (self.discarded,)
+        return value
+
+
+def _read_fd(fd, size):
+    while True:
+        try:
+            return os.read(fd, size)
+        except OSError, ex:
+            if ex.errno != errno.EINTR:
+                raise
+
+
+def _wait_readable(fds):
+    """
+    Block until at least one of the specified file descriptors is readable,
+    and return the list of readable descriptors.
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        while True:
+            try:
+                events = poller.poll()
+                break
+            except select.error, ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+        # POLLHUP and POLLERR are also reported as readable,
+        # so the caller will see EOF or the error when it reads.
+        return [fd for (fd, event) in events]
+
+    while True:
+        try:
+            (readable, writable, exceptional) = select.select(fds, [], [])
+            return readable
+        except select.error, ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+
+
+def _stream_chunks(p, chunk_size, stderr_buf):
+    """
+    Yield data from p.stdout as it becomes available, while also reading
+    p.stderr into stderr_buf, so the command can never block writing to
+    stderr while we wait for stdout.
+    """
+    out_fd = p.stdout.fileno()
+    err_fd = p.stderr.fileno()
+    fds = [out_fd, err_fd]
+    while fds:
+        for fd in _wait_readable(fds):
+            data = _read_fd(fd, chunk_size)
+            if not data:
+                fds.remove(fd)
+            elif fd == out_fd:
+                yield data
+            else:
+                stderr_buf.add(data)
+
+
+def _split_records(chunks, delimiter):
+    partial = ''
+    for data in chunks:
+        records = data.split(delimiter)
+        if partial:
+            records[0] = partial + records[0]
+        partial = records.pop()
+        for record in records:
+            yield record
+    # Output that doesn't end with the delimiter still has one last record
+    if partial:
+        yield partial
+
+
+def stream_cmd(args, cwd=None, env=None, expected_rc=0, expected_sig=None,
+               stdin='/dev/null', delimiter=None,
+               chunk_size=DEFAULT_CHUNK_SIZE, max_stderr=DEFAULT_MAX_STDERR,
+               stderr_out=None):
+    """
+    stream_cmd(args, cwd=None, env=None, expected_rc=0, expected_sig=None,
+               delimiter=None) --> iterator
+
+    Run a command and iterate over its output as the command writes it,
+    rather than buffering all of the output in memory.
+
+    If delimiter is None, the iterator yields chunks of at most chunk_size
+    bytes.  Otherwise the output is split on the delimiter (normally a NUL
+    or newline), and each record is yielded without its delimiter.  If the
+    output does not end with a delimiter, the trailing data is yielded as
+    the final record.
+
+    At most max_stderr bytes of the command's stderr output are retained.
+    If stderr_out is a list, the retained stderr output is appended to it
+    once the command has exited.
+
+    Once all output has been consumed, the exit status is checked as in
+    run_cmd(): CmdExitCodeError or CmdTerminatedError are raised from the
+    iterator if the command did not exit as expected.  If the iterator is
+    closed or garbage collected before the output has been consumed, the
+    command is killed.
+    """
+    p = popen_cmd(args, cwd=cwd, env=env, stdin=stdin, stdout=subprocess.PIPE,
+                  stderr=subprocess.PIPE)
+    stderr_buf = _StderrBuffer(max_stderr)
+    finished = False
+    try:
+        chunks = _stream_chunks(p, chunk_size, stderr_buf)
+        if delimiter is None:
+            for data in chunks:
+                yield data
+        else:
+            for record in _split_records(chunks, delimiter):
+                yield record
+        finished = True
+    finally:
+        if not finished:
+            try:
+                p.kill()
+            except OSError:
+                # The command already exited
+                pass
+        p.stdout.close()
+        p.stderr.close()
+        status = p.wait()
+
+    cmd_err = stderr_buf.getvalue()
+    if stderr_out is not None:
+        stderr_out.append(cmd_err)
+    check_status(args, status, expected_rc, expected_sig, cmd_err)
+
+
+def stream_simple_cmd(args, cwd=None, env=None, delimiter=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    stream_simple_cmd(args, cwd=None, env=None, delimiter=None) --> iterator
+
+    Wrapper around stream_cmd() that expects the command to exit with a
+    return value of 0, and output no data on stderr.  If any of these
+    conditions fail, a CmdFailedError is raised once the output has been
+    consumed.
+    """
+    stderr_out = []
+    for data in stream_cmd(args, cwd=cwd, env=env, expected_rc=0,
+                           expected_sig=None, delimiter=delimiter,
+                           chunk_size=chunk_size, stderr_out=stderr_out):
+        yield data
+
+    if stderr_out[0]:
+        msg = 'printed error message on stderr'
+        raise CmdFailedError(args, msg, stderr_out[0])
@@ -0,0 +1,174 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Tools for finding out where git-review spends its time.
+
+run_profiled() runs a function under cProfile, and saves the statistics in
+the format read by the pstats module.  Threads started by the function,
+such as the prefetch threads, are profiled too.
+
+SamplingProfiler periodically records the stack of every other thread.  It
+has much lower overhead than cProfile, so it can be left running during an
+interactive session.  The results are written in the "collapsed stack"
+format used by flamegraph.pl and compatible tools: one line per distinct
+stack, with the frames separated by semicolons starting from the outermost,
+followed by the number of samples.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+
+# The default time between samples, in milliseconds
+DEFAULT_INTERVAL = 10
+
+
+class ProfilerError(Exception):
+    pass
+
+
+def run_profiled(path, function, *args, **kwargs):
+    """
+    run_profiled(path, function, *args, **kwargs) --> result
+
+    Call function under cProfile, and write the statistics to path when it
+    returns or raises an exception.  cProfile only sees the thread it was
+    enabled in, so each thread started in the meantime gets its own
+    profiler, and the statistics of all of them are combined.
+    """
+    # list.append() is atomic, so threads can add themselves without a lock
+    thread_profiles = []
+
+    def start_thread_profile(frame, event, arg):
+        # Called for the first event in each new thread.  Enabling the
+        # thread's profiler replaces this function.
+        thread_profile = cProfile.Profile()
+        thread_profiles.append(thread_profile)
+        thread_profile.enable()
+
+    profile = cProfile.Profile()
+    threading.setprofile(start_thread_profile)
+    try:
+        return profile.runcall(function, *args, **kwargs)
+    finally:
+        threading.setprofile(None)
+        stats = pstats.Stats(profile)
+        for thread_profile in thread_profiles:
+            stats.add(thread_profile)
+        stats.dump_stats(path)
+
+
+def _get_frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """
+    Records the stacks of all threads every interval milliseconds.
+    """
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.numSamples = 0
+        # tuple of code objects, outermost first --> number of samples
+        self.__stacks = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def isRunning(self):
+        return self.__thread is not None
+
+    def start(self):
+        if self.__thread is not None:
+            raise ProfilerError('the profiler is already running')
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            raise ProfilerError('the profiler is not running')
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__stacks = {}
+            self.numSamples = 0
+        finally:
+            self.__lock.release()
+
+    def __run(self):
+        my_ident = threading.current_thread().ident
+        interval = self.interval / 1000.0
+        while not self.__stop.wait(interval):
+            self.__sample(my_ident)
+
+    def __sample(self, my_ident):
+        frames = sys._current_frames()
+        self.__lock.acquire()
+        try:
+            for (ident, frame) in frames.iteritems():
+                if ident == my_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                stack = tuple(stack)
+                self.__stacks[stack] = self.__stacks.get(stack, 0) + 1
+            self.numSamples += 1
+        finally:
+            self.__lock.release()
+
+    def getCollapsedStacks(self):
+        """
+        profiler.getCollapsedStacks() --> list of (stack string, count)
+        """
+        self.__lock.acquire()
+        try:
+            stacks = self.__stacks.items()
+        finally:
+            self.__lock.release()
+
+        # Different code objects can have the same name.  Merge them.
+        merged = {}
+        for (stack, count) in stacks:
+            name = ';'.join([_get_frame_name(code) for code in stack])
+            merged[name] = merged.get(name, 0) + count
+        results = merged.items()
+        results.sort()
+        return results
+
+    def writeCollapsed(self, path):
+        """
+        Write the samples collected so far to path, in collapsed stack
+        format.
+        """
+        f = open(path, 'w')
+        try:
+            for (stack, count) in self.getCollapsedStacks():
+                f.write('%s %d\n' % (stack, count))
+        finally:
+            f.close()
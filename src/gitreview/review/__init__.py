@@ -18,20 +18,63 @@ import os
 import tempfile
 
 import gitreview.git as git
+import gitreview.memory as memory
 
 from exceptions import *
 import cli_reviewer
+import journal
+import prefetch
+import rpc
+import watch
 
 CliReviewer = cli_reviewer.CliReviewer
+ReviewJournal = journal.ReviewJournal
+get_review_journal = journal.get_review_journal
+RpcServer = rpc.RpcServer
+WatchError = watch.WatchError
+WorkingDirWatcher = watch.WorkingDirWatcher
+
+# Interdiff modes, controlling what happens to entries whose blob pairs
+# have already been reviewed
+INTERDIFF_HIDE = 'hide'
+INTERDIFF_DEFER = 'defer'
+INTERDIFF_MODES = (INTERDIFF_HIDE, INTERDIFF_DEFER)
+
+# Generated file modes, controlling what happens to entries marked with the
+# linguist-generated attribute
+GENERATED_HIDE = 'hide'
+GENERATED_DEFER = 'defer'
+GENERATED_MODES = (GENERATED_HIDE, GENERATED_DEFER)
+
+
+# The number of bytes from each end of a large file included in its preview
+PREVIEW_SIZE = 256 * 1024
 
 
 class TmpFile(object):
-    def __init__(self, repo, commit, path):
+    def __init__(self, repo, commit, path, max_size=None, textconv=False):
+        """
+        TmpFile(repo, commit, path, max_size=None, textconv=False)
+
+        If max_size is specified and the blob is larger than max_size bytes,
+        only a preview of it is written: the first and last PREVIEW_SIZE
+        bytes, with a note in between saying how much was left out.
+
+        If textconv is True and the diff driver for the path has a textconv
+        command, the converted text is written instead of the blob.
+        Converted text is cached, and is never previewed.
+        """
         self.repo = repo
         self.commit = commit
         self.path = path
 
         self.tmpFile = None
+        # The size of the blob, if it was checked
+        self.size = None
+        # True if only a preview of the blob was written
+        self.isPreview = False
+        # True if the blob was converted with a textconv command
+        self.isConverted = False
 
         if self.commit == git.COMMIT_WD:
             self.tmpPath = os.path.join(repo.getWorkingDir(), path)
@@ -41,9 +84,51 @@ class TmpFile(object):
             self.tmpFile = tempfile.NamedTemporaryFile(prefix=prefix,
                                                        suffix=suffix)
             self.tmpPath = self.tmpFile.name
-            # Invoke git to write the blob contents into the temporary file
-            self.repo.getBlobContents('%s:%s' % (self.commit, self.path),
-                                      outfile=self.tmpFile)
+
+            name = '%s:%s' % (self.commit, self.path)
+            if textconv and self.__writeConverted(name):
+                return
+            if max_size is not None:
+                # Check the size first, without reading the blob
+                info = self.repo.checkObjects([name])[name]
+                if info is not None:
+                    self.size = info.size
+            if self.size is not None and self.size > max_size:
+                self.__writePreview(name)
+            else:
+                # Invoke git to write the blob contents into the temporary
+                # file
+                self.repo.getBlobContents(name, outfile=self.tmpFile)
+
+    def __writeConverted(self, name):
+        driver = self.repo.getAttributeChecker().checkOne(self.path).diffDriver
+        if driver is None:
+            return False
+        cache = self.repo.getTextconvCache()
+        if cache.getCommand(driver) is None:
+            return False
+        info = self.repo.checkObjects([name])[name]
+        if info is None:
+            # Let getBlobContents() report the error
+            return False
+        cache.writeContents(name, info.sha1, driver, self.tmpFile)
+        self.isConverted = True
+        return True
+
+    def __writePreview(self, name):
+        (head, tail, size) = self.repo.getBlobPreview(name, PREVIEW_SIZE,
+                                                      PREVIEW_SIZE)
+        self.tmpFile.write(head)
+        if tail:
+            omitted = size - len(head) - len(tail)
+            self.tmpFile.write('\n\n[git-review: %s omitted from this %s '
+                               'file; use "full" to see all of it]\n\n' %
+                               (memory.format_size(omitted),
+                                memory.format_size(size)))
+            self.tmpFile.write(tail)
+        self.tmpFile.flush()
+        self.size = size
+        self.isPreview = True
 
     def __del__(self):
         if self.tmpFile:
@@ -53,6 +138,29 @@ class TmpFile(object):
         return self.tmpPath
 
 
+class DirectoryStats(object):
+    """
+    Aggregate line statistics for a directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.numFiles = 0
+        self.numBinaryFiles = 0
+        self.linesAdded = 0
+        self.linesRemoved = 0
+
+    def add(self, entry):
+        self.numFiles += 1
+        if entry.binary:
+            self.numBinaryFiles += 1
+        else:
+            self.linesAdded += entry.linesAdded
+            self.linesRemoved += entry.linesRemoved
+
+    def getChurn(self):
+        return self.linesAdded + self.linesRemoved
+
+
 def sort_reasonably(entries):
     def get_key(entry):
         path = entry.getPath()
@@ -75,16 +183,63 @@ def sort_reasonably(entries):
 
 
 class Review(object):
-    def __init__(self, repo, diff):
+    def __init__(self, repo, diff, journal=None, interdiff=None,
+                 cluster=False, generated=None):
+        """
+        Review(repo, diff, journal=None, interdiff=None, cluster=False,
+               generated=None)
+
+        If a ReviewJournal is supplied, entries are recorded in it as they
+        are reviewed.  If interdiff is INTERDIFF_HIDE, entries that the
+        journal shows have already been reviewed are left out of the review.
+        If it is INTERDIFF_DEFER, they are moved to the end.
+
+        If cluster is True, entries with identical normalized patches are
+        grouped into clusters, and only the first entry of each cluster is
+        reviewed.  Marking it as reviewed marks the whole cluster.
+
+        If generated is GENERATED_HIDE, entries whose gitattributes mark
+        them as generated are left out of the review.  If it is
+        GENERATED_DEFER, they are moved to the end.
+        """
+        if generated is not None and generated not in GENERATED_MODES:
+            raise ValueError('invalid generated file mode %r' % (generated,))
+        if interdiff is not None:
+            if interdiff not in INTERDIFF_MODES:
+                raise ValueError('invalid interdiff mode %r' % (interdiff,))
+            if journal is None:
+                raise ValueError('interdiff mode requires a journal')
+
         self.repo = repo
         self.diff = diff
+        self.journal = journal
+        self.interdiff = interdiff
+        self.cluster = cluster
+        self.generated = generated
+
+        # Fetches files and resolves commit names in the background, once
+        # prefetching has been requested
+        self.prefetcher = None
+
+        # getFile() only fetches a preview of files larger than this many
+        # bytes.  If None, files are always fetched in full.
+        self.maxFileSize = None
+        # If True, getFile() converts files with the textconv command of
+        # their diff driver, if they have one
+        self.textconv = True
+
+        # path --> PathAttributes, for every entry
+        self.attributes = {}
 
         self.commitAliases = {}
         self.setCommitAlias('parent', self.diff.parent)
         self.setCommitAlias('child', self.diff.child)
 
         self.currentIndex = 0
+        self.__computeOrdering()
+        self.loadBlobSizes()
 
+    def __computeOrdering(self):
         # Assign a fixed ordering to the file list
         #
         # TODO: read user-specified file orderings in the future
@@ -93,8 +248,151 @@ class Review(object):
             self.ordering.append(entry)
 
         sort_reasonably(self.ordering)
+
+        # Hide or defer generated entries.  The attributes of every entry
+        # are looked up with a single git command.
+        self.loadAttributes()
+        self.numHiddenGenerated = 0
+        if self.generated is not None:
+            normal = []
+            generated = []
+            for entry in self.ordering:
+                if self.isGenerated(entry):
+                    generated.append(entry)
+                else:
+                    normal.append(entry)
+            if self.generated == GENERATED_HIDE:
+                self.ordering = normal
+                self.numHiddenGenerated = len(generated)
+            else:
+                self.ordering = normal + generated
+
+        # Hide or defer the entries that have already been reviewed.
+        # Each lookup is a single dictionary access, so this is cheap even
+        # for very large diffs.
+        self.numPreviouslyReviewed = 0
+        self.numHidden = 0
+        if self.interdiff is not None:
+            unreviewed = []
+            reviewed = []
+            for entry in self.ordering:
+                if self.journal.isReviewed(entry):
+                    reviewed.append(entry)
+                else:
+                    unreviewed.append(entry)
+            self.numPreviouslyReviewed = len(reviewed)
+            if self.interdiff == INTERDIFF_HIDE:
+                self.ordering = unreviewed
+                self.numHidden = len(reviewed)
+            else:
+                self.ordering = unreviewed + reviewed
+
+        # Clusters are computed on demand, unless we are only reviewing
+        # one entry per cluster
+        self.__clusterEntries = self.ordering
+        self.__clusters = None
+        self.__clustersByEntry = None
+        if self.cluster:
+            self.ordering = [cluster[0] for cluster in self.getClusters()]
+
         self.numEntries = len(self.ordering)
 
+    def refresh(self, paths=None):
+        """
+        review.refresh(paths=None) --> number of paths updated
+
+        Recompute the diff, to pick up changes made to the working directory
+        or index since the review started.  If paths is specified, only the
+        entries for those paths are recomputed, so the cost is proportional
+        to the number of paths rather than the size of the diff.  Paths
+        that name directories update everything below them.
+
+        The current entry stays the same, as long as its path is still
+        part of the diff.  Commit aliases are unaffected.
+        """
+        try:
+            current_path = self.getCurrentEntry().getPath()
+        except NoCurrentEntryError:
+            current_path = None
+
+        if paths is None:
+            self.diff = self.repo.getDiff(self.diff.parent, self.diff.child,
+                                          numstat=self.diff.hasLineStats())
+            num_updated = len(self.diff)
+        else:
+            num_updated = self.__refreshPaths(paths)
+
+        self.__computeOrdering()
+        self.__restorePosition(current_path)
+        self.loadBlobSizes()
+        return num_updated
+
+    def __refreshPaths(self, paths):
+        paths = set(paths)
+        if not paths:
+            return 0
+
+        def is_affected(path):
+            if path is None:
+                return False
+            while path:
+                if path in paths:
+                    return True
+                path = os.path.dirname(path)
+            return False
+
+        # Find the existing entries for the changed paths.  Renames and
+        # copies are recomputed together with the path on the other side,
+        # so git can detect them again.
+        affected = []
+        for entry in self.diff:
+            if is_affected(entry.old.path) or is_affected(entry.new.path):
+                affected.append(entry)
+        for entry in affected:
+            if entry.old.path is not None:
+                paths.add(entry.old.path)
+            if entry.new.path is not None:
+                paths.add(entry.new.path)
+
+        # Match the paths literally, in case they contain glob characters
+        pathspecs = [':(literal)' + path for path in sorted(paths)]
+        new_diff = git.diff.get_diff_list(self.repo, self.diff.parent,
+                                          self.diff.child, paths=pathspecs,
+                                          numstat=self.diff.hasLineStats())
+        if self.diff.hasPatchIds():
+            git.diff.add_patch_ids(self.repo, new_diff, paths=pathspecs)
+
+        updated = set()
+        for entry in affected:
+            path = entry.getPath()
+            self.diff.remove(path)
+            updated.add(path)
+        for entry in new_diff:
+            path = entry.getPath()
+            if self.diff.has_key(path):
+                self.diff.remove(path)
+            self.diff.add(entry)
+            updated.add(path)
+        return len(updated)
+
+    def __restorePosition(self, path):
+        if path is not None:
+            for index in range(len(self.ordering)):
+                entry = self.ordering[index]
+                if self.cluster:
+                    cluster = self.getCluster(entry)
+                else:
+                    cluster = [entry]
+                for cluster_entry in cluster:
+                    if cluster_entry.getPath() == path:
+                        self.currentIndex = index
+                        return
+
+        # The current entry is no longer part of the diff.
+        # Stay at the same index, so the next entry becomes current.
+        self.currentIndex = max(min(self.currentIndex, self.numEntries - 1),
+                                0)
+
     def getEntries(self):
         # XXX: we return a shallow copy.
         # Callers shouldn't modify the returned value directly
@@ -114,6 +412,172 @@ class Review(object):
     def getEntry(self, index):
         return self.ordering[index]
 
+    def loadPatchIds(self):
+        """
+        Compute patch IDs for all entries, if they haven't been computed
+        already.  This runs a single "git diff -p" command for the whole
+        diff.
+        """
+        if not self.diff.hasPatchIds():
+            git.diff.add_patch_ids(self.repo, self.diff)
+
+    def getClusters(self):
+        """
+        review.getClusters() --> list of lists of DiffEntry
+
+        Group the entries being reviewed into clusters of entries with the
+        same patch ID.  The clusters are returned in review order, and
+        the entries in each cluster are also in review order.
+
+        This is a single pass over the entries, using a dictionary keyed by
+        patch ID, so it is fast even for very large diffs.
+        """
+        if self.__clusters is not None:
+            return self.__clusters
+
+        self.loadPatchIds()
+        clusters = []
+        clusters_by_id = {}
+        clusters_by_entry = {}
+        for entry in self.__clusterEntries:
+            if entry.patchId is None:
+                cluster = None
+            else:
+                cluster = clusters_by_id.get(entry.patchId)
+            if cluster is None:
+                cluster = []
+                clusters.append(cluster)
+                if entry.patchId is not None:
+                    clusters_by_id[entry.patchId] = cluster
+            cluster.append(entry)
+            clusters_by_entry[entry] = cluster
+
+        self.__clusters = clusters
+        self.__clustersByEntry = clusters_by_entry
+        return clusters
+
+    def getCluster(self, entry):
+        """
+        review.getCluster(entry) --> list of DiffEntry
+
+        Get the cluster containing the specified entry.
+        """
+        self.getClusters()
+        return self.__clustersByEntry[entry]
+
+    def isReviewed(self, entry):
+        """
+        review.isReviewed(entry) --> bool
+
+        Returns True if the journal shows that the same pair of blobs as the
+        specified entry has been reviewed before.
+        """
+        if self.journal is None:
+            return False
+        return self.journal.isReviewed(entry)
+
+    def markReviewed(self, entry):
+        """
+        Record in the journal that the specified entry has been reviewed.
+        In cluster mode, all of the entries in its cluster are recorded.
+        """
+        if self.journal is None:
+            return
+        if self.cluster:
+            # Reviewing the representative of a cluster
+            # reviews all of the entries in it.
+            for cluster_entry in self.getCluster(entry):
+                self.journal.markReviewed(cluster_entry)
+        else:
+            self.journal.markReviewed(entry)
+
+    def hasLineStats(self):
+        return self.diff.hasLineStats()
+
+    def loadLineStats(self):
+        """
+        Compute line statistics for all entries, if they haven't been
+        computed already.  This runs a single "git diff --numstat" command for
+        the whole diff.
+        """
+        if not self.diff.hasLineStats():
+            git.diff.add_line_stats(self.repo, self.diff)
+
+    def loadBlobSizes(self):
+        """
+        Look up the sizes of the blobs in every entry that doesn't have them
+        yet.  This runs a single batch lookup, and doesn't read any blobs.
+        """
+        git.diff.add_blob_sizes(self.repo, self.diff)
+
+    def loadAttributes(self):
+        """
+        Look up the gitattributes of every entry.  Only entries whose
+        attributes may have changed since they were last looked up are
+        checked again.
+        """
+        paths = [entry.getPath() for entry in self.diff]
+        self.attributes = self.repo.getAttributes(paths)
+
+    def getAttributes(self, entry):
+        """
+        review.getAttributes(entry) --> PathAttributes
+        """
+        try:
+            return self.attributes[entry.getPath()]
+        except KeyError:
+            return self.repo.getAttributeChecker().checkOne(entry.getPath())
+
+    def isGenerated(self, entry):
+        """
+        Returns True if the entry's gitattributes mark it as generated.
+        """
+        return self.getAttributes(entry).generated
+
+    def isBinary(self, entry):
+        """
+        Returns True if git treats the entry as binary, either because of
+        its gitattributes, or because of its contents.  The contents are
+        only known once line statistics have been loaded.
+        """
+        return bool(entry.binary) or self.getAttributes(entry).binary
+
+    def isLargeEntry(self, entry):
+        """
+        Returns True if either side of the entry is too large for getFile()
+        to fetch in full.
+        """
+        if self.maxFileSize is None:
+            return False
+        size = entry.getMaxSize()
+        return size is not None and size > self.maxFileSize
+
+    def getDirectoryStats(self):
+        """
+        review.getDirectoryStats() --> dict of dirname --> DirectoryStats
+
+        Compute the total line statistics for every directory containing
+        modified files, including the changes in all of its subdirectories.
+        The root directory is reported as ''.  Every entry in the diff is
+        counted, including ones left out of the review order by clustering,
+        --interdiff or --generated.
+
+        Line statistics must already have been loaded with loadLineStats().
+        """
+        stats = {}
+        for entry in self.diff:
+            path = entry.getPath()
+            dirname = path
+            while dirname:
+                dirname = os.path.dirname(dirname)
+                try:
+                    dir_stats = stats[dirname]
+                except KeyError:
+                    dir_stats = DirectoryStats(dirname)
+                    stats[dirname] = dir_stats
+                dir_stats.add(entry)
+        return stats
+
     def hasNext(self):
         return (self.currentIndex + 1 < self.numEntries)
 
@@ -141,13 +605,62 @@ class Review(object):
             raise git.NoSuchBlobError('%s:<None>' % (commit,))
 
         try:
-            return TmpFile(self.repo, expanded_commit, path)
+            if self.prefetcher is not None:
+                key = ('file', expanded_commit, path, self.maxFileSize,
+                       self.textconv)
+                f = self.prefetcher.take(key)
+                if f is not None:
+                    return f
+            return TmpFile(self.repo, expanded_commit, path,
+                           self.maxFileSize, self.textconv)
         except (git.NoSuchBlobError, git.NotABlobError), ex:
             # For user-friendliness,
             # change the name in the exception to the unexpanded name
             ex.name = '%s:%s' % (commit, path)
             raise
 
+    def prefetchFiles(self, requests):
+        """
+        Start fetching the files named by a list of (commit, path) tuples in
+        the background.  A later getFile() call for one of them returns the
+        fetched file, instead of running git again.  Files in the working
+        directory don't need to be fetched, and are skipped.
+        """
+        if self.prefetcher is None:
+            self.prefetcher = prefetch.Prefetcher()
+        for (commit, path) in requests:
+            if commit is None or path is None:
+                continue
+            expanded_commit = self.expandCommitName(commit)
+            if expanded_commit == git.COMMIT_WD:
+                continue
+            key = ('file', expanded_commit, path, self.maxFileSize,
+                   self.textconv)
+            self.prefetcher.add(key, TmpFile, self.repo, expanded_commit,
+                                path, self.maxFileSize, self.textconv)
+
+    def prefetchCommits(self, names):
+        """
+        Start resolving a list of commit names to SHA1s in the background,
+        for later setCommitAlias() calls.
+        """
+        if self.prefetcher is None:
+            self.prefetcher = prefetch.Prefetcher()
+        for name in names:
+            expanded_commit = self.expandCommitName(name)
+            if expanded_commit in (git.COMMIT_INDEX, git.COMMIT_WD):
+                continue
+            self.prefetcher.add(('commit', expanded_commit),
+                                self.repo.getCommitSha1, expanded_commit)
+
+    def stopPrefetching(self):
+        """
+        Discard any prefetched results that haven't been used.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
     def isRevisionOrPath(self, name):
         """
         Like git.repo.isRevisionOrPath(), but handles commit aliases too.
@@ -185,7 +698,11 @@ class Review(object):
             expanded_commit == git.COMMIT_WD):
             sha1 = expanded_commit
         else:
-            sha1 = self.repo.getCommitSha1(expanded_commit)
+            sha1 = None
+            if self.prefetcher is not None:
+                sha1 = self.prefetcher.take(('commit', expanded_commit))
+            if sha1 is None:
+                sha1 = self.repo.getCommitSha1(expanded_commit)
 
         self.commitAliases[alias] = sha1
 
@@ -15,12 +15,20 @@
 # under the License.
 #
 import os
-import subprocess
+import sys
 
 import gitreview.cli as cli
 import gitreview.git as git
+import gitreview.memory as memory
+import gitreview.profiler as profiler
 
 from exceptions import *
+import viewer
+import watch
+
+# By default, files larger than this many megabytes are only shown as
+# previews
+DEFAULT_LARGE_FILE_THRESHOLD = 16
 
 
 class FileIndexArgument(cli.Argument):
@@ -256,31 +264,183 @@ class ExitCommand(cli.ArgCommand):
 
 
 class ListCommand(cli.ArgCommand):
+    ORDER_REVIEW = 'review'
+    ORDER_CHURN = 'churn'
+    ORDER_PATH = 'path'
+
     def __init__(self):
-        help = 'Show the file list'
-        args = []
+        help = \
+            'Show the file list\n' \
+            '\n' \
+            'The file list may be sorted in review order (the default),\n' \
+            'by number of changed lines, or by path name.  If a minimum\n' \
+            'number of changed lines is specified, only files with at\n' \
+            'least that many changed lines are shown.\n' \
+            '\n' \
+            'Sorting or filtering by changed lines computes line\n' \
+            'statistics for the whole diff, which are then shown with\n' \
+            'each file.\n' \
+            '\n' \
+            'Generated and binary files are marked, based on their\n' \
+            'gitattributes (linguist-generated, binary, and -diff), and\n' \
+            'also on their contents once line statistics are known.\n' \
+            'Files larger than review.largeFileThreshold are marked as\n' \
+            'large, and are only shown as previews (see "help full").'
+        orders = [self.ORDER_REVIEW, self.ORDER_CHURN, self.ORDER_PATH]
+        args = [cli.ChoiceArgument('order', orders, optional=True),
+                cli.IntArgument('min_churn', hr_name='minimum changed lines',
+                                min=0, optional=True)]
         cli.ArgCommand.__init__(self, args, help)
 
     def runParsed(self, cli_obj, name, args):
-        entries = cli_obj.review.getEntries()
+        review = cli_obj.review
+        if args.order == self.ORDER_CHURN or args.min_churn is not None:
+            review.loadLineStats()
+        show_stats = review.hasLineStats()
+
+        # Keep track of each entry's index in the review order,
+        # so it can still be used with the goto command
+        # after sorting or filtering.
+        entries = list(enumerate(review.getEntries()))
+        if args.min_churn is not None:
+            entries = [(n, entry) for (n, entry) in entries
+                       if entry.getChurn() >= args.min_churn]
+        if args.order == self.ORDER_CHURN:
+            entries.sort(key=lambda (n, entry): -entry.getChurn())
+        elif args.order == self.ORDER_PATH:
+            entries.sort(key=lambda (n, entry): entry.getPath())
 
         # Compute the width needed for the index field
-        num_entries = len(entries)
-        max_index = num_entries - 1
+        max_index = review.getNumEntries() - 1
         index_width = len(str(max_index))
 
+        stats_width = 0
+        if show_stats:
+            stats_strs = {}
+            for (n, entry) in entries:
+                stats_strs[n] = format_line_stats(entry)
+            if stats_strs:
+                stats_width = max([len(s) for s in stats_strs.itervalues()])
+
         # List the entries
-        n = 0
-        for entry in entries:
+        for (n, entry) in entries:
             msg = '%*s: %s ' % (index_width, n, entry.status.getChar())
+            indent = index_width + 4
+            if show_stats:
+                msg += '%-*s ' % (stats_width, stats_strs[n])
+                indent += stats_width + 1
             if entry.status == git.diff.Status.RENAMED or \
                     entry.status == git.diff.Status.COPIED:
-                msg += '%s\n%*s    --> %s' % (entry.old.path, index_width, '',
-                                              entry.new.path)
+                msg += '%s\n%*s--> %s' % (entry.old.path, indent, '',
+                                          entry.new.path)
             else:
                 msg += entry.getPath()
+            if review.cluster:
+                num_similar = len(review.getCluster(entry)) - 1
+                if num_similar:
+                    msg += ' (+%d similar)' % (num_similar,)
+            if review.isGenerated(entry):
+                msg += ' (generated)'
+            if review.isBinary(entry) and not show_stats:
+                msg += ' (binary)'
+            if review.isLargeEntry(entry):
+                msg += ' (large: %s)' % \
+                        (memory.format_size(entry.getMaxSize()),)
+            if review.isReviewed(entry):
+                msg += ' (reviewed)'
             cli_obj.output(msg)
+
+        if review.numHidden:
+            cli_obj.output('(%d previously reviewed files not shown)' %
+                           (review.numHidden,))
+        if review.numHiddenGenerated:
+            cli_obj.output('(%d generated files not shown)' %
+                           (review.numHiddenGenerated,))
+
+
+class ClustersCommand(cli.ArgCommand):
+    def __init__(self):
+        help = \
+            'Show groups of files with identical changes\n' \
+            '\n' \
+            'Files are grouped together if the lines added and removed are\n' \
+            'the same, ignoring whitespace.  Only groups with at least the\n' \
+            'specified number of files are shown (2 by default).'
+        args = [cli.IntArgument('min_size', hr_name='minimum cluster size',
+                                default=2, min=1, optional=True)]
+        cli.ArgCommand.__init__(self, args, help)
+
+    def runParsed(self, cli_obj, name, args):
+        review = cli_obj.review
+        clusters = review.getClusters()
+
+        # Map each entry to its index in the review order
+        indices = {}
+        n = 0
+        for entry in review.getEntries():
+            indices[entry] = n
             n += 1
+        index_width = len(str(max(review.getNumEntries() - 1, 0)))
+
+        num_shown = 0
+        for cluster in clusters:
+            if len(cluster) < args.min_size:
+                continue
+            num_shown += 1
+            if len(cluster) == 1:
+                cli_obj.output('1 file:')
+            else:
+                cli_obj.output('%d files:' % (len(cluster),))
+            for entry in cluster:
+                # In cluster mode only the first entry in each cluster
+                # has an index
+                index = indices.get(entry)
+                if index is None:
+                    index = ''
+                cli_obj.output('  %*s: %s %s' %
+                               (index_width, index, entry.status.getChar(),
+                                entry.getPath()))
+
+        if not num_shown:
+            cli_obj.output('No clusters with at least %d files' %
+                           (args.min_size,))
+
+
+class DirStatCommand(cli.ArgCommand):
+    def __init__(self):
+        help = \
+            'Show the number of changed lines in each directory\n' \
+            '\n' \
+            'The totals for each directory include the changes in all of\n' \
+            'its subdirectories.  If a minimum number of changed lines is\n' \
+            'specified, only directories with at least that many changed\n' \
+            'lines are shown.'
+        args = [cli.IntArgument('min_churn', hr_name='minimum changed lines',
+                                min=0, optional=True)]
+        cli.ArgCommand.__init__(self, args, help)
+
+    def runParsed(self, cli_obj, name, args):
+        review = cli_obj.review
+        review.loadLineStats()
+
+        dir_stats = review.getDirectoryStats().values()
+        if args.min_churn is not None:
+            dir_stats = [stats for stats in dir_stats
+                         if stats.getChurn() >= args.min_churn]
+        dir_stats.sort(key=lambda stats: stats.path)
+
+        for stats in dir_stats:
+            if stats.numFiles == 1:
+                files_str = '1 file'
+            else:
+                files_str = '%d files' % (stats.numFiles,)
+            if stats.numBinaryFiles:
+                files_str += ' (%d binary)' % (stats.numBinaryFiles,)
+            added_str = '+%d' % (stats.linesAdded,)
+            removed_str = '-%d' % (stats.linesRemoved,)
+            cli_obj.output('%7s %7s  %-18s %s' %
+                           (added_str, removed_str, files_str,
+                            stats.path or '.'))
 
 
 class NextCommand(cli.ArgCommand):
@@ -375,24 +535,13 @@ class DiffCommand(cli.ArgCommand):
             return (file1, file2)
 
         # If we're still here, no arguments were specified.
-        if current_entry.status == git.diff.Status.DELETED:
-            # If the current file is a deleted file,
-            # diff the file in the parent against /dev/null
-            file1 = cli_obj.review.getFile('parent',
-                                           current_entry.old.path)
-            file2 = '/dev/null'
-            return (file1, file2)
-        elif current_entry.status == git.diff.Status.ADDED:
-            # If the current file is a new file, diff /dev/null
-            # against the file in the child.
-            file1 = '/dev/null'
-            file2 = cli_obj.review.getFile('child', current_entry.new.path)
-            return (file1, file2)
-        else:
-            # Diff the parent file against the child file
-            file1 = cli_obj.review.getFile('parent', current_entry.old.path)
-            file2 = cli_obj.review.getFile('child', current_entry.new.path)
-            return (file1, file2)
+        # Fetch both sides of the current entry in parallel.
+        files = viewer.prefetch_files(cli_obj.review,
+                                      get_diff_requests(current_entry))
+        for f in files:
+            if isinstance(f, Exception):
+                raise f
+        return tuple(files)
 
     def runParsed(self, cli_obj, name, args):
         try:
@@ -410,14 +559,115 @@ class DiffCommand(cli.ArgCommand):
             cli_obj.outputError('not a file %r' % (ex.name,))
             return 1
 
-        cmd = cli_obj.getDiffCommand(*files)
+        report_previews(cli_obj, files)
         try:
-            p = subprocess.Popen(cmd)
-        except OSError, ex:
-            cli_obj.outputError('failed to invoke %r: %s' % (cmd[0], ex))
+            ret = cli_obj.viewer.diff(files)
+        except viewer.ViewerError, ex:
+            cli_obj.outputError(ex)
+            return 1
+        cli_obj.viewer.hold(files)
+
+        if args.path1 is None and report_tool_status(cli_obj, ret):
+            # We showed the changes for the current entry
+            cli_obj.review.markReviewed(cli_obj.review.getCurrentEntry())
+        cli_obj.setSuggestedCommand('next')
+        return ret
+
+
+class FullCommand(cli.Command):
+    def run(self, cli_obj, name, args, line):
+        if len(args) < 2:
+            cli_obj.outputError('no command specified')
+            return 1
+
+        review = cli_obj.review
+        old_max_size = review.maxFileSize
+        review.maxFileSize = None
+        try:
+            return cli_obj.invokeCommand(args[1], args[1:], line)
+        finally:
+            review.maxFileSize = old_max_size
+
+    def help(self, cli_obj, name, args, line):
+        cli_obj.output('%s <command> [<args>]' % (args[0],))
+        cli_obj.output()
+        cli_obj.output('Run a command, showing large files in full\n'
+                       '\n'
+                       'Files larger than review.largeFileThreshold are\n'
+                       'normally only shown as previews of their beginning\n'
+                       'and end.  "full diff", "full view", and "full batch"\n'
+                       'fetch the whole file instead.')
+
+    def complete(self, cli_obj, name, args, text):
+        if len(args) == 1:
+            return cli_obj.completeCommand(text, add_space=True)
+        try:
+            cmd = cli_obj.getCommand(args[1])
+        except (cli.NoSuchCommandError, cli.AmbiguousCommandError):
+            return []
+        return cmd.complete(cli_obj, args[1], args[1:], text)
+
+
+class BatchCommand(cli.ArgCommand):
+    def __init__(self):
+        help = \
+            'Show the diffs for several files at once\n' \
+            '\n' \
+            'The diffs for the current file and the files after it are\n' \
+            'shown together (10 files by default).  The files are fetched\n' \
+            'from the repository in parallel first.  vim shows each diff\n' \
+            'in its own tab.  Other diff programs are run once per file,\n' \
+            'all at the same time.  Afterwards the last file shown becomes\n' \
+            'the current file.'
+        args = [cli.IntArgument('count', hr_name='number of files',
+                                default=10, min=1, optional=True)]
+        cli.ArgCommand.__init__(self, args, help)
+
+    def runParsed(self, cli_obj, name, args):
+        review = cli_obj.review
+        try:
+            review.getCurrentEntry()
+        except NoCurrentEntryError, ex:
+            cli_obj.outputError(ex)
             return 1
 
-        ret = p.wait()
+        start = review.currentIndex
+        entries = review.getEntries()[start:start + args.count]
+        requests = []
+        for entry in entries:
+            requests.extend(get_diff_requests(entry))
+        files = viewer.prefetch_files(review, requests)
+
+        file_lists = []
+        shown = []
+        for entry in entries:
+            entry_files = files[:2]
+            files = files[2:]
+            errors = [f for f in entry_files if isinstance(f, Exception)]
+            if errors:
+                cli_obj.outputError('unable to show %s: %s' %
+                                    (entry.getPath(), errors[0]))
+                continue
+            file_lists.append(entry_files)
+            shown.append(entry)
+        if not file_lists:
+            return 1
+
+        for entry_files in file_lists:
+            report_previews(cli_obj, entry_files)
+        try:
+            ret = cli_obj.viewer.diffMany(file_lists)
+        except viewer.ViewerError, ex:
+            cli_obj.outputError(ex)
+            return 1
+        for entry_files in file_lists:
+            cli_obj.viewer.hold(entry_files)
+
+        if report_tool_status(cli_obj, ret):
+            for entry in shown:
+                review.markReviewed(entry)
+        review.goto(start + len(entries) - 1)
+        cli_obj.indexUpdated()
         cli_obj.setSuggestedCommand('next')
         return ret
 
@@ -430,6 +680,7 @@ class ViewCommand(cli.ArgCommand):
         cli.ArgCommand.__init__(self, args, help)
 
     def runParsed(self, cli_obj, name, args):
+        current_entry = None
         if args.path is None:
             # If no path was specified, pick the path from the current entry
             try:
@@ -461,14 +712,16 @@ class ViewCommand(cli.ArgCommand):
             cli_obj.outputError('not a file %r' % (ex.name,))
             return 1
 
-        cmd = cli_obj.getViewCommand(file)
+        report_previews(cli_obj, [file])
         try:
-            p = subprocess.Popen(cmd)
-        except OSError, ex:
-            cli_obj.outputError('failed to invoke %r: %s' % (cmd[0], ex))
+            ret = cli_obj.viewer.view(file)
+        except viewer.ViewerError, ex:
+            cli_obj.outputError(ex)
             return 1
+        cli_obj.viewer.hold([file])
 
-        ret = p.wait()
+        if current_entry is not None and report_tool_status(cli_obj, ret):
+            cli_obj.review.markReviewed(current_entry)
         cli_obj.setSuggestedCommand('next')
         return ret
 
@@ -521,6 +774,306 @@ class UnaliasCommand(cli.ArgCommand):
         return 0
 
 
+class RefreshCommand(cli.ArgCommand):
+    def __init__(self):
+        help = \
+            'Update the file list with changes to the working directory\n' \
+            '\n' \
+            'When watching for changes with --watch, only the files that\n' \
+            'have been modified are recomputed.  (The file list is also\n' \
+            'updated automatically before each command.)  Otherwise, or if\n' \
+            '"all" is specified, the entire diff is recomputed.'
+        args = [cli.ChoiceArgument('all', ['all'], optional=True)]
+        cli.ArgCommand.__init__(self, args, help)
+
+    def runParsed(self, cli_obj, name, args):
+        cli_obj.refreshReview(full=(args.all is not None), verbose=True)
+
+
+class MemoryCommand(cli.ArgCommand):
+    def __init__(self):
+        help = \
+            'Show the memory used by git-review\'s caches\n' \
+            '\n' \
+            'All caches share a single budget, set in megabytes with the\n' \
+            'review.memoryBudget config setting.  When it is exceeded,\n' \
+            'entries are evicted according to the review.cachePolicy\n' \
+            'setting: "lru", "lfu", or "arc".  Memory used by the review\n' \
+            'itself is counted against the budget, but is never evicted.'
+        cli.ArgCommand.__init__(self, [], help)
+
+    def runParsed(self, cli_obj, name, args):
+        budget = cli_obj.memory
+        budget.updateUsage()
+        cli_obj.output('%s used of %s (%s policy)' %
+                       (memory.format_size(budget.getTotalSize()),
+                        memory.format_size(budget.limit),
+                        budget.policyName))
+        for (name, size, cache) in budget.getUsage():
+            if cache is None:
+                details = 'not evictable'
+            else:
+                details = '%d entries, %d hits, %d misses, %d evicted' % \
+                        (len(cache), cache.hits, cache.misses,
+                         cache.evictions)
+            cli_obj.output('  %-14s %10s  %s' %
+                           (name, memory.format_size(size), details))
+
+
+class ProfileCommand(cli.ArgCommand):
+    def __init__(self):
+        help = \
+            'Profile git-review with a sampling profiler\n' \
+            '\n' \
+            '"profile start [<interval>]" starts recording the stacks of\n' \
+            'all threads, every <interval> milliseconds (%d by default).\n' \
+            '"profile stop" stops recording.  "profile dump <file>" writes\n' \
+            'the stacks recorded so far to <file>, in the collapsed stack\n' \
+            'format read by flamegraph.pl, and discards them.' % \
+            (profiler.DEFAULT_INTERVAL,)
+        args = [cli.ChoiceArgument('action', ['start', 'stop', 'dump']),
+                cli.StringArgument('arg', hr_name='interval or file',
+                                   optional=True)]
+        cli.ArgCommand.__init__(self, args, help)
+
+    def runParsed(self, cli_obj, name, args):
+        if args.action == 'start':
+            interval = profiler.DEFAULT_INTERVAL
+            if args.arg is not None:
+                try:
+                    interval = int(args.arg)
+                except ValueError:
+                    interval = 0
+                if interval <= 0:
+                    cli_obj.outputError('the interval must be a positive '
+                                        'number of milliseconds')
+                    return 1
+            if cli_obj.profiler is not None and \
+                    cli_obj.profiler.isRunning():
+                cli_obj.outputError('the profiler is already running')
+                return 1
+            cli_obj.profiler = profiler.SamplingProfiler(interval)
+            cli_obj.profiler.start()
+            return 0
+
+        if cli_obj.profiler is None:
+            cli_obj.outputError('the profiler has not been started')
+            return 1
+        if args.action == 'stop':
+            if not cli_obj.profiler.isRunning():
+                cli_obj.outputError('the profiler is not running')
+                return 1
+            cli_obj.profiler.stop()
+            cli_obj.output('Recorded %d samples' %
+                           (cli_obj.profiler.numSamples,))
+            return 0
+
+        if args.arg is None:
+            cli_obj.outputError('no file specified')
+            return 1
+        try:
+            cli_obj.profiler.writeCollapsed(args.arg)
+        except EnvironmentError, ex:
+            cli_obj.outputError('unable to write %s: %s' % (args.arg, ex))
+            return 1
+        cli_obj.output('Wrote %d samples to %s' %
+                       (cli_obj.profiler.numSamples, args.arg))
+        cli_obj.profiler.clear()
+        return 0
+
+
+class TimingsCommand(cli.ArgCommand):
+    def __init__(self):
+        help = \
+            'Show how long commands and completions have taken\n' \
+            '\n' \
+            'The number of times each command was run is shown, along with\n' \
+            'the mean, median, 90th and 99th percentile, and maximum\n' \
+            'times, in milliseconds.  "timings reset" discards the times\n' \
+            'recorded so far.'
+        args = [cli.ChoiceArgument('action', ['reset'], optional=True)]
+        cli.ArgCommand.__init__(self, args, help)
+
+    def runParsed(self, cli_obj, name, args):
+        if args.action == 'reset':
+            cli_obj.timings.clear()
+            return 0
+
+        histograms = cli_obj.timings.getHistograms()
+        if not histograms:
+            cli_obj.output('No commands have been timed yet')
+            return 0
+
+        cli_obj.output('%-20s %6s %8s %8s %8s %8s %8s' %
+                       ('command', 'count', 'mean', 'p50', 'p90', 'p99',
+                        'max'))
+        for (timing_name, histogram) in histograms:
+            values = [histogram.getMean(), histogram.getPercentile(50),
+                      histogram.getPercentile(90),
+                      histogram.getPercentile(99), histogram.max]
+            values_str = ' '.join(['%8.1f' % (value / 1000.0,)
+                                   for value in values])
+            cli_obj.output('%-20s %6d %s' %
+                           (timing_name, histogram.count, values_str))
+
+
+def get_diff_requests(entry):
+    """
+    get_diff_requests(entry) --> [(commit, path), (commit, path)]
+
+    Get the files to diff to show the changes in a DiffEntry, in the form
+    accepted by viewer.prefetch_files().  Added and deleted files are
+    diffed against /dev/null.
+    """
+    if entry.status == git.diff.Status.DELETED:
+        return [('parent', entry.old.path), (None, '/dev/null')]
+    elif entry.status == git.diff.Status.ADDED:
+        return [(None, '/dev/null'), ('child', entry.new.path)]
+    else:
+        return [('parent', entry.old.path), ('child', entry.new.path)]
+
+
+def report_tool_status(cli_obj, ret):
+    """
+    report_tool_status(cli_obj, ret) --> bool
+
+    Returns True if the diff or view tool exited successfully.  Otherwise,
+    tell the user that the files it showed were not marked as reviewed.
+    """
+    if ret == 0:
+        return True
+    cli_obj.outputError('the tool exited with status %s; not marking the '
+                        'file as reviewed' % (ret,))
+    return False
+
+
+def report_previews(cli_obj, files):
+    """
+    Tell the user about any files that are only previews of large files.
+    Both sides of a diff usually have the same path, so each path is only
+    reported once, with the largest size.
+    """
+    paths = []
+    sizes = {}
+    for f in files:
+        if not getattr(f, 'isPreview', False):
+            continue
+        if not sizes.has_key(f.path):
+            paths.append(f.path)
+            sizes[f.path] = f.size
+        else:
+            sizes[f.path] = max(sizes[f.path], f.size)
+
+    for path in paths:
+        cli_obj.output('%s is %s; showing a preview (use "full" to see '
+                       'all of it)' % (path, memory.format_size(sizes[path])))
+
+
+def _has_explicit_commits(args):
+    """
+    Returns True if every argument names both a commit and a path, so it
+    can be parsed as a CommitFileArgument without asking git whether it is
+    a commit or a path.
+    """
+    for arg in args:
+        if ':' not in arg.lstrip(':'):
+            return False
+    return True
+
+
+# The commands that get_script_requests() predicts the work for
+_SCRIPT_COMMANDS = (NextCommand, PrevCommand, GotoCommand, BatchCommand,
+                    DiffCommand, ViewCommand, AliasCommand)
+
+
+def get_script_requests(cli_obj, lines):
+    """
+    get_script_requests(cli_obj, lines) --> (file requests, commit names)
+
+    Work out which files the diff, view, and batch commands in a list of
+    upcoming command lines will fetch, and which commit names the alias
+    commands will resolve.  Movement through the review by next, prev,
+    goto, and batch is followed, so commands that use the current file
+    predict the right one.
+
+    This stops at the first command that could change the meaning of the
+    commands after it (by changing an alias, or the file list), and skips
+    lines that don't parse.  Only arguments that can be parsed without
+    running git are considered.
+    """
+    review = cli_obj.review
+    num_entries = review.getNumEntries()
+    index = review.currentIndex
+    file_requests = []
+    commit_names = []
+
+    for line in lines:
+        try:
+            (cmd_name, tokens) = cli_obj.parseLine(line)
+            command = cli_obj.getCommand(cmd_name)
+        except (cli.CLIError, cli.tokenize.TokenizationError):
+            continue
+
+        if isinstance(command, (RefreshCommand, UnaliasCommand,
+                                ExitCommand)):
+            break
+        if not isinstance(command, _SCRIPT_COMMANDS):
+            continue
+        if isinstance(command, (DiffCommand, ViewCommand)) and \
+                not _has_explicit_commits(tokens[1:]):
+            continue
+        try:
+            args = command.parseArgs(cli_obj, tokens)
+        except cli.CLIError:
+            continue
+
+        if isinstance(command, NextCommand):
+            index = min(index + 1, num_entries - 1)
+        elif isinstance(command, PrevCommand):
+            index = max(index - 1, 0)
+        elif isinstance(command, GotoCommand):
+            index = args.index
+        elif isinstance(command, BatchCommand):
+            for entry in review.getEntries()[index:index + args.count]:
+                file_requests.extend(get_diff_requests(entry))
+            index = min(index + args.count, num_entries) - 1
+        elif isinstance(command, DiffCommand):
+            paths = [path for path in (args.path1, args.path2, args.path3)
+                     if path is not None]
+            if paths:
+                file_requests.extend(paths)
+            elif 0 <= index < num_entries:
+                entry = review.getEntry(index)
+                file_requests.extend(get_diff_requests(entry))
+        elif isinstance(command, ViewCommand):
+            if args.path is not None:
+                file_requests.append(args.path)
+            elif 0 <= index < num_entries:
+                entry = review.getEntry(index)
+                if entry.status == git.diff.Status.DELETED:
+                    file_requests.append(('parent', entry.old.path))
+                else:
+                    file_requests.append(('child', entry.new.path))
+        elif isinstance(command, AliasCommand):
+            if args.commit is not None:
+                commit_names.append(args.commit)
+                # Later commands may use the new alias
+                break
+
+    return (file_requests, commit_names)
+
+
+def format_line_stats(entry):
+    """
+    format_line_stats(entry) --> string
+
+    Format the line statistics for a DiffEntry for display.
+    """
+    if entry.binary:
+        return 'binary'
+    return '+%d -%d' % (entry.linesAdded, entry.linesRemoved)
+
+
 class RepoCache(object):
     """
     A wrapper around a Repository object that caches the results from
@@ -530,36 +1083,47 @@ class RepoCache(object):
     otherwise run the same getRefNames() and listTree() multiple times while
     the user is tab completing a commit/path.
     """
-    def __init__(self, repo):
+    def __init__(self, repo, budget):
         self.__repo = repo
-        self.clearCaches()
+        self.__refCache = budget.createCache('refs')
+        self.__treeCache = budget.createCache('trees')
 
     def getRefNames(self):
-        if self.__refNames is None:
-            self.__refNames = self.__repo.getRefNames()
-        return self.__refNames[:]
+        ref_names = self.__refCache.get(None)
+        if ref_names is None:
+            ref_names = self.__repo.getRefNames()
+            self.__refCache.put(None, ref_names)
+        return ref_names[:]
 
-    def listTree(self, commit, dirname=None):
+    def listTree(self, commit, dirname=None, on_entries=None):
         key = (commit, dirname)
-        try:
-            return self.__treeCache[key]
-        except KeyError:
-            result = self.__repo.listTree(commit, dirname=dirname)
-            self.__treeCache[key] = result
-            return result
+        result = self.__treeCache.get(key)
+        if result is None:
+            result = self.__repo.listTree(commit, dirname=dirname,
+                                          on_entries=on_entries)
+            self.__treeCache.put(key, result)
+        elif on_entries is not None:
+            on_entries(result)
+        return result
 
     def clearCaches(self):
-        self.__refNames = None
-        self.__treeCache = {}
+        self.__refCache.clear()
+        self.__treeCache.clear()
 
 
 class CliReviewer(cli.CLI):
-    def __init__(self, review):
+    def __init__(self, review, watcher=None):
         cli.CLI.__init__(self)
 
         # Internal state
         self.review = review
-        self.repoCache = RepoCache(self.review.repo)
+        self.watcher = watcher
+        self.profiler = None
+        self.memory = self.__getMemoryBudget()
+        self.memory.addUsage('review', self.__getReviewSize)
+        self.repoCache = RepoCache(self.review.repo, self.memory)
+        self.review.repo.getTextconvCache().setMemoryBudget(self.memory)
+        self.review.maxFileSize = self.__getLargeFileThreshold()
         self.configureCommands()
 
         # Commands
@@ -567,18 +1131,56 @@ class CliReviewer(cli.CLI):
         self.addCommand('quit', ExitCommand())
         self.addCommand('list', ListCommand())
         self.addCommand('files', ListCommand())
+        self.addCommand('dirstat', DirStatCommand())
+        self.addCommand('clusters', ClustersCommand())
         self.addCommand('next', NextCommand())
         self.addCommand('prev', PrevCommand())
         self.addCommand('goto', GotoCommand())
         self.addCommand('diff', DiffCommand())
+        self.addCommand('batch', BatchCommand())
         self.addCommand('view', ViewCommand())
+        self.addCommand('full', FullCommand())
         self.addCommand('alias', AliasCommand())
         self.addCommand('unalias', UnaliasCommand())
+        self.addCommand('refresh', RefreshCommand())
+        self.addCommand('memory', MemoryCommand())
+        self.addCommand('profile', ProfileCommand())
+        self.addCommand('timings', TimingsCommand())
         self.addCommand('help', cli.HelpCommand())
         self.addCommand('?', cli.HelpCommand())
 
         self.indexUpdated()
 
+    def __getMemoryBudget(self):
+        try:
+            return memory.get_budget(self.review.repo)
+        except (memory.BudgetError, ValueError), ex:
+            self.outputError('invalid memory budget configuration: %s' %
+                             (ex,))
+            return memory.MemoryBudget(memory.DEFAULT_BUDGET * memory.MB)
+
+    def __getLargeFileThreshold(self):
+        value = self.review.repo.config.get('review.largefilethreshold',
+                                            DEFAULT_LARGE_FILE_THRESHOLD)
+        try:
+            threshold = int(value)
+        except ValueError:
+            self.outputError('invalid review.largeFileThreshold setting %r' %
+                             (value,))
+            threshold = DEFAULT_LARGE_FILE_THRESHOLD
+        if threshold <= 0:
+            # Large file previews are disabled
+            return None
+        return threshold * memory.MB
+
+    def __getReviewSize(self):
+        # The review order refers to the diff's entries, so only the list
+        # itself adds to the size of the diff.  estimate_size() samples the
+        # entries, so this is cheap even for very large diffs, and can be
+        # repeated after every refresh.
+        return memory.estimate_size(self.review.diff) + \
+                sys.getsizeof(self.review.ordering)
+
     def configureCommands(self):
         # TODO: It would be nice to support a ~/.gitreviewrc file, too, or
         # maybe even storing configuration via git-config.
@@ -619,12 +1221,80 @@ class CliReviewer(cli.CLI):
             # preferred diff program with GIT_REVIEW_DIFF.
             self.diffCommand = ['vimdiff', '-R']
 
+        # GIT_REVIEW_SESSION selects whether to start a new viewer for each
+        # file, or to reuse a single vim instance
+        session_mode = os.environ.get('GIT_REVIEW_SESSION',
+                                      viewer.SESSION_PROCESS)
+        try:
+            self.viewer = viewer.get_session(session_mode, self.diffCommand,
+                                             self.viewCommand)
+        except viewer.ViewerError, ex:
+            self.outputError('GIT_REVIEW_SESSION: %s' % (ex,))
+            self.viewer = viewer.get_session(viewer.SESSION_PROCESS,
+                                             self.diffCommand,
+                                             self.viewCommand)
+
     def invokeCommand(self, cmd_name, args, line):
-        # Before every command, clear our repository cache
+        # Before every command, clear our repository cache, and forget what
+        # names like branches and index paths referred to
         self.repoCache.clearCaches()
+        self.review.repo.getBatchChecker().clearCache()
+
+        # Pick up any files modified since the last command.  The refresh
+        # command does this itself.
+        if self.watcher is not None and \
+                not isinstance(self.commands.get(cmd_name), RefreshCommand):
+            self.refreshReview()
 
         # Invoke CLI.invokeCommand() to perform the real work
-        cli.CLI.invokeCommand(self, cmd_name, args, line)
+        return cli.CLI.invokeCommand(self, cmd_name, args, line)
+
+    def __getCurrentState(self):
+        try:
+            entry = self.review.getCurrentEntry()
+        except NoCurrentEntryError:
+            return None
+        return (entry.getPath(), entry.status.getChar())
+
+    def refreshReview(self, full=False, verbose=False):
+        """
+        Update the review with changes made to the working directory.
+
+        If we are watching the working directory, only the modified files
+        are recomputed, unless full is True.  Nothing is output unless some
+        files were updated, or verbose is True.
+        """
+        paths = None
+        if self.watcher is not None:
+            try:
+                (paths, full_refresh) = self.watcher.getChanges()
+            except watch.WatchError, ex:
+                self.outputError('%s; no longer watching for changes' %
+                                 (ex,))
+                self.watcher.close()
+                self.watcher = None
+                full = True
+            else:
+                if full_refresh:
+                    full = True
+                elif not paths and not full:
+                    if verbose:
+                        self.output('No files have changed')
+                    return
+        if full:
+            paths = None
+
+        old_state = self.__getCurrentState()
+        num_updated = self.review.refresh(paths)
+        if num_updated:
+            self.memory.updateUsage()
+        if num_updated or verbose:
+            if num_updated == 1:
+                self.output('Updated 1 file')
+            else:
+                self.output('Updated %d files' % (num_updated,))
+        if self.__getCurrentState() != old_state:
+            self.indexUpdated()
 
     def handleEmptyLine(self):
         self.runCommand(self.suggestedCommand)
@@ -675,6 +1345,13 @@ class CliReviewer(cli.CLI):
         except NoCurrentEntryError:
             # Should only happen when there are no files to review.
             msg = 'No files to review'
+            if self.review.numHidden:
+                msg += ' (%d previously reviewed files not shown)' % \
+                        (self.review.numHidden,)
+            if self.review.numHiddenGenerated:
+                msg += ' (%d generated files not shown)' % \
+                        (self.review.numHiddenGenerated,)
+            self.output(msg)
             self.setSuggestedCommand('quit')
             return
 
@@ -684,6 +1361,15 @@ class CliReviewer(cli.CLI):
             msg += '%s\n--> %s' % (entry.old.path, entry.new.path)
         else:
             msg += entry.getPath()
+        if self.review.cluster:
+            num_similar = len(self.review.getCluster(entry)) - 1
+            if num_similar == 1:
+                msg += '\n(The same change was made to 1 other file)'
+            elif num_similar:
+                msg += '\n(The same change was made to %d other files)' % \
+                        (num_similar,)
+        if self.review.isReviewed(entry):
+            msg += '\n(This file has already been reviewed)'
         self.output(msg)
         # setSuggestedCommand() will automatically update the prompt
         self.setSuggestedCommand('lint')
@@ -696,27 +1382,46 @@ class CliReviewer(cli.CLI):
         except NoCurrentEntryError:
             self.prompt = '[%s]> ' % (self.suggestedCommand)
 
-    def getViewCommand(self, path):
-        return self.viewCommand + [str(path)]
-
-    def getDiffCommand(self, path1, path2, path3=None):
-        cmd = self.diffCommand + [str(path1), str(path2)]
-        if path3 != None:
-            cmd.append(str(path3))
-        return cmd
-
-    def run(self):
-        return self.loop()
+    def run(self, script=None):
+        """
+        Run the interactive prompt, or if script is a list of command lines,
+        run those instead.
+        """
+        try:
+            if script is None:
+                return self.loop()
+            return self.runScript(script)
+        finally:
+            self.review.stopPrefetching()
+            if self.profiler is not None and self.profiler.isRunning():
+                self.profiler.stop()
+            self.viewer.close()
+
+    def prepareCommands(self, lines):
+        # Start fetching the files and resolving the commits the upcoming
+        # commands will need, so they are ready when the commands run
+        (file_requests, commit_names) = get_script_requests(self, lines)
+        if file_requests:
+            self.review.prefetchFiles(file_requests)
+        if commit_names:
+            self.review.prefetchCommits(commit_names)
 
     def completeCommit(self, text, append=' ', append_exact=False):
         """
         Complete a commit name or commit alias.
         """
         matches = []
-        ref_names = self.repoCache.getRefNames()
-        # Also match against the special COMMIT_WD and COMMIT_INDEX names.
-        ref_names.extend([git.COMMIT_INDEX, git.COMMIT_WD])
-        for ref in ref_names:
+        # Aliases and the special COMMIT_WD and COMMIT_INDEX names are
+        # available immediately.  Report them before listing the refs,
+        # which may take a while.
+        names = self.review.getCommitAliases()
+        names.extend([git.COMMIT_INDEX, git.COMMIT_WD])
+        for name in names:
+            if name.startswith(text):
+                matches.append(name)
+        self.addPartialCompletions(matches)
+
+        for ref in self.repoCache.getRefNames():
             # Match against any trailing part of the ref name
             # for example, if the ref is "refs/heads/foo",
             # first try to match against the whole thing, then against
@@ -729,10 +1434,6 @@ class CliReviewer(cli.CLI):
                     break
                 ref = parts[1]
 
-        for alias in self.review.getCommitAliases():
-            if alias.startswith(text):
-                matches.append(alias)
-
         if append and len(matches) == 1:
             # If there is only 1 match, check to see if we should append
             # the string specified by append.
@@ -759,11 +1460,25 @@ class CliReviewer(cli.CLI):
             dirname = text[:idx+1]
             basename = text[idx+1:]
 
+        def get_full_match(entry):
+            full_match = dirname + entry.name
+            if entry.type == git.OBJ_TREE:
+                full_match += os.path.sep
+            return full_match
+
+        def on_entries(entries):
+            # Report the matches found so far, while git ls-tree is still
+            # listing a large directory
+            self.addPartialCompletions([get_full_match(entry)
+                                        for entry in entries
+                                        if entry.name.startswith(basename)])
+
         # Expand commit name aliases
         commit = self.review.expandCommitName(commit)
         matches = []
         try:
-            tree_entries = self.repoCache.listTree(commit, dirname)
+            tree_entries = self.repoCache.listTree(commit, dirname,
+                                                   on_entries)
         except OSError, ex:
             return []
 
@@ -776,11 +1491,4 @@ class CliReviewer(cli.CLI):
         if len(matches) == 1 and matches[0].type == git.OBJ_BLOB:
             return [dirname + matches[0].name + ' ']
 
-        string_matches = []
-        for entry in matches:
-            full_match = dirname + entry.name
-            if entry.type == git.OBJ_TREE:
-                full_match += os.path.sep
-            string_matches.append(full_match)
-
-        return string_matches
+        return [get_full_match(entry) for entry in matches]
@@ -0,0 +1,283 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+import errno
+import os
+import tempfile
+
+_JOURNAL_HEADER = '# git-review reviewed pairs v1\n'
+
+# The length of one journal record: two hex SHA1s, a space, and a newline
+_RECORD_LENGTH = 40 + 1 + 40 + 1
+
+_NULL_SHA1 = '0' * 40
+
+# The maximum number of pairs to keep.  When the journal is compacted, the
+# pairs that were least recently reviewed are dropped beyond this limit.
+_MAX_PAIRS = 200000
+
+
+class ReviewJournal(object):
+    """
+    A persistent record of the (old blob, new blob) pairs that have been
+    reviewed.
+
+    When a change is amended or rebased, most of its files usually have
+    exactly the same blob SHA1s on both sides of the diff as in the previous
+    version.  The journal allows those files to be recognized, so they don't
+    have to be reviewed again.
+
+    The journal is stored in the git directory as a text file, with one
+    "<old sha1> <new sha1>" line per reviewed pair.  Newly reviewed pairs
+    are appended to the file immediately.  Re-reviewing a pair appends it
+    again, so the order of the last occurrence of each pair in the file
+    reflects how recently it was reviewed.  When duplicate records make up
+    most of the file, or it holds more than _MAX_PAIRS pairs, the file is
+    rewritten with just the most recent record for each pair.
+
+    Entries whose contents are not known by SHA1 (such as modified files in
+    the working directory) cannot be recorded.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        # (old sha1, new sha1) --> sequence number of the most recent record
+        self.__pairs = {}
+        self.__numRecords = 0
+
+        # Set if the journal file is missing or was written by an
+        # incompatible version, and needs to be started from scratch
+        self.__reset = True
+        # Set if the journal file contains invalid data, and needs to be
+        # rewritten the next time it is updated
+        self.__damaged = False
+        self.__writable = True
+
+        self.__load()
+
+    def __load(self):
+        self.__pairs = {}
+        self.__numRecords = 0
+        self.__reset = True
+        self.__damaged = False
+
+        try:
+            f = open(self.path, 'rb')
+        except IOError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        if not data.startswith(_JOURNAL_HEADER):
+            # Ignore journals written by an incompatible version.
+            # The journal will be rewritten from scratch.
+            return
+
+        offset = len(_JOURNAL_HEADER)
+        end = len(data) - _RECORD_LENGTH
+        while offset <= end:
+            record = data[offset:offset + _RECORD_LENGTH]
+            if record[-1] != '\n' or record[40] != ' ':
+                # Garbage.  Skip to the next line, and rewrite the file
+                # the next time it is updated.
+                self.__damaged = True
+                line_end = data.find('\n', offset)
+                if line_end < 0:
+                    break
+                offset = line_end + 1
+                continue
+            self.__addPair((record[:40], record[41:81]))
+            offset += _RECORD_LENGTH
+        self.__reset = False
+
+    def __addPair(self, key):
+        self.__pairs[key] = self.__numRecords
+        self.__numRecords += 1
+
+    def __getKey(self, entry):
+        old_sha1 = entry.old.sha1
+        new_sha1 = entry.new.sha1
+        if old_sha1 is None:
+            old_sha1 = _NULL_SHA1
+        if new_sha1 is None:
+            new_sha1 = _NULL_SHA1
+
+        # A null SHA1 on both sides, or for the side of the diff that
+        # exists, means git didn't hash the file.  We don't know what the
+        # contents were, so these entries can't be recorded.
+        if new_sha1 == _NULL_SHA1 and entry.new.path is not None:
+            return None
+        if old_sha1 == _NULL_SHA1 and entry.old.path is not None:
+            return None
+        if old_sha1 == _NULL_SHA1 and new_sha1 == _NULL_SHA1:
+            return None
+        return (old_sha1, new_sha1)
+
+    def canRecord(self, entry):
+        """
+        journal.canRecord(entry) --> bool
+
+        Returns True if the contents of both sides of the specified DiffEntry
+        are known by SHA1, so that it can be recorded in the journal.
+        """
+        return self.__getKey(entry) is not None
+
+    def isReviewed(self, entry):
+        """
+        journal.isReviewed(entry) --> bool
+
+        Returns True if the same pair of blobs as the specified DiffEntry has
+        been reviewed before.
+        """
+        key = self.__getKey(entry)
+        if key is None:
+            return False
+        return self.__pairs.has_key(key)
+
+    def markReviewed(self, entry):
+        """
+        Record that the specified DiffEntry has been reviewed.
+
+        Returns False if the entry cannot be recorded.
+        """
+        key = self.__getKey(entry)
+        if key is None:
+            return False
+
+        self.__addPair(key)
+        if self.__needsCompaction():
+            self.__compact()
+        else:
+            self.__append(['%s %s\n' % key])
+        return True
+
+    def __needsCompaction(self):
+        if self.__damaged:
+            return True
+        num_pairs = len(self.__pairs)
+        if num_pairs > _MAX_PAIRS:
+            return True
+        # Don't bother compacting small journals
+        if self.__numRecords < 1024:
+            return False
+        return self.__numRecords > 2 * num_pairs
+
+    def __compact(self):
+        if not self.__writable:
+            return
+
+        # Another git-review process may have appended to the journal since
+        # we loaded it.  Merge in its records before rewriting the file.
+        # Our own pairs sort after the ones from the file.
+        old_pairs = self.__pairs.items()
+        try:
+            self.__load()
+        except IOError:
+            self.__pairs = {}
+            self.__numRecords = 0
+        old_pairs.sort(key=lambda (key, seq): seq)
+        for (key, seq) in old_pairs:
+            self.__addPair(key)
+
+        pairs = self.__pairs.items()
+        pairs.sort(key=lambda (key, seq): seq)
+        pairs = pairs[-_MAX_PAIRS:]
+        lines = ['%s %s\n' % key for (key, seq) in pairs]
+
+        self.__pairs = {}
+        self.__numRecords = 0
+        for (key, seq) in pairs:
+            self.__addPair(key)
+
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            (fd, tmp_path) = tempfile.mkstemp(dir=dirname,
+                                              prefix='.reviewed-')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(_JOURNAL_HEADER)
+                    f.write(''.join(lines))
+                finally:
+                    f.close()
+                os.rename(tmp_path, self.path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError):
+            # The journal is only a convenience.  If we can't write to the
+            # git directory, keep using the in-memory journal.
+            self.__writable = False
+            return
+        self.__reset = False
+        self.__damaged = False
+
+    def __append(self, lines):
+        if not self.__writable:
+            return
+
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            f = open(self.path, 'ab')
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if self.__reset or size < len(_JOURNAL_HEADER):
+                    f.truncate(0)
+                    f.write(_JOURNAL_HEADER)
+                    self.__reset = False
+                else:
+                    # Discard any partial line left by an interrupted
+                    # update.  Complete records appended by other
+                    # git-review processes are kept.
+                    extra = (size - len(_JOURNAL_HEADER)) % _RECORD_LENGTH
+                    if extra:
+                        f.truncate(size - extra)
+                f.write(''.join(lines))
+            finally:
+                f.close()
+        except (IOError, OSError):
+            # The journal is only a convenience.  If we can't write to the
+            # git directory, keep using the in-memory journal.
+            self.__writable = False
+
+
+_journals = {}
+
+
+def get_review_journal(repo):
+    """
+    Get the ReviewJournal for a repository.
+
+    Journal objects are shared between all callers for the same git
+    directory.
+    """
+    key = os.path.abspath(repo.getGitDir())
+    try:
+        return _journals[key]
+    except KeyError:
+        path = os.path.join(key, 'git-review', 'reviewed')
+        journal = ReviewJournal(path)
+        _journals[key] = journal
+        return journal
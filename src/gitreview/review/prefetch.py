@@ -0,0 +1,149 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Background computation of results that will be needed soon.
+
+When the commands to be run are known in advance (for example, when running
+a script of commands), the git work for the upcoming commands can be started
+before they run.  Each piece of work is identified by a key.  The command
+that needs the result takes it with the same key, waiting for it to finish
+if necessary, and falls back to doing the work itself if it was never
+started.
+"""
+
+import Queue
+import threading
+
+DEFAULT_NUM_THREADS = 8
+
+# Results that are never taken are discarded, oldest first, once there are
+# more than this many
+_MAX_RESULTS = 64
+
+
+class _Result(object):
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.value = None
+        self.exception = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args)
+        except Exception, ex:
+            self.exception = ex
+        self.done.set()
+
+    def get(self):
+        self.done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class _Worker(threading.Thread):
+    def __init__(self, work_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.workQueue = work_queue
+
+    def run(self):
+        while True:
+            result = self.workQueue.get()
+            if result is None:
+                return
+            result.run()
+
+
+class Prefetcher(object):
+    def __init__(self, num_threads=DEFAULT_NUM_THREADS):
+        self.numThreads = num_threads
+        self.__lock = threading.Lock()
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        # key --> _Result
+        self.__results = {}
+        # The keys in self.__results, oldest first
+        self.__order = []
+
+    def add(self, key, function, *args):
+        """
+        Start computing function(*args) in the background, unless a result
+        for key has already been started and not yet taken.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__results.has_key(key):
+                return
+            result = _Result(function, args)
+            self.__results[key] = result
+            self.__order.append(key)
+            if len(self.__order) > _MAX_RESULTS:
+                old_key = self.__order.pop(0)
+                del self.__results[old_key]
+
+            if len(self.__threads) < self.numThreads:
+                thread = _Worker(self.__queue)
+                thread.start()
+                self.__threads.append(thread)
+        finally:
+            self.__lock.release()
+        self.__queue.put(result)
+
+    def take(self, key, default=None):
+        """
+        prefetcher.take(key, default=None) --> value
+
+        Remove the result for key, waiting for it to be computed, and return
+        it.  If computing it raised an exception, the exception is raised.
+        Returns default if no result for key was started.
+        """
+        self.__lock.acquire()
+        try:
+            try:
+                result = self.__results.pop(key)
+            except KeyError:
+                return default
+            self.__order.remove(key)
+        finally:
+            self.__lock.release()
+        return result.get()
+
+    def clear(self):
+        """
+        Discard all results that haven't been taken.  Work that has already
+        started is allowed to finish.
+        """
+        self.__lock.acquire()
+        try:
+            self.__results = {}
+            self.__order = []
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        """
+        Discard all results, and wait for the threads to exit.
+        """
+        self.clear()
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
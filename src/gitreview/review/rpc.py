@@ -0,0 +1,526 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+A JSON-RPC 2.0 interface to a Review, for editor integrations.
+
+Requests are read from stdin and responses are written to stdout, one JSON
+value per line.  Requests may be pipelined: the server does not wait for a
+response to be written before reading the next request.  Requests that
+navigate or modify the review are executed one at a time, in the order they
+were received.  Other requests (such as fetching blobs) are executed
+concurrently by a pool of threads, so their responses may be written in a
+different order than the requests.  Clients should match responses to
+requests by ID.
+
+Paths and other strings are exchanged as UTF-8.
+
+Methods:
+
+  review.getInfo()
+      The parent and child commits, the number of entries, the current
+      index, and the numbers of entries hidden by interdiff mode and
+      because they are generated.
+
+  review.listEntries(start=0, count=None)
+      Describe the entries being reviewed, in review order.
+
+  review.getCurrent()
+  review.next()
+  review.prev()
+  review.goto(index=None, path=None)
+      Move through the review.  Each returns the new current entry.
+      Moving past either end of the review is an error.
+
+  review.markReviewed(index=None)
+      Record the current entry, or the entry at the specified index, as
+      reviewed.
+
+  review.refresh(paths=None)
+      Recompute the diff for the specified paths, or the whole diff.
+
+  blob.get(commit, path, inline=False)
+      Fetch the contents of path in the specified commit, which may be an
+      alias.  By default the contents are written to a temporary file, and
+      {"path": <file name>} is returned.  The file remains until it is
+      released with blob.release(), or the server exits.  (For the working
+      directory, the path of the real file is returned.)  If inline is true,
+      {"data": <base64 contents>, "size": <bytes>} is returned instead.
+
+  blob.release(path)
+      Delete a temporary file returned by blob.get().
+
+  alias.list()
+  alias.resolve(name)
+  alias.set(alias, commit)
+  alias.unset(alias)
+      Manage commit aliases.  alias.resolve() expands aliases in a commit
+      name.
+"""
+
+import base64
+import inspect
+import json
+import Queue
+import sys
+import threading
+
+import gitreview.git as git
+import gitreview.proc as proc
+
+from exceptions import *
+
+# The number of threads used to run concurrent requests.  Most of them spend
+# their time waiting for git commands, so this doesn't depend on the number
+# of CPUs.
+DEFAULT_NUM_THREADS = 8
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+# Errors raised by the method itself, such as an unknown commit
+APPLICATION_ERROR = -32000
+
+
+class RpcError(Exception):
+    def __init__(self, code, msg):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+def _to_str(obj):
+    """
+    Convert the unicode strings returned by json.loads() to UTF-8 byte
+    strings.
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_to_str(item) for item in obj]
+    if isinstance(obj, dict):
+        result = {}
+        for (key, value) in obj.iteritems():
+            result[_to_str(key)] = _to_str(value)
+        return result
+    return obj
+
+
+def _format_entry(review, index, entry):
+    return {
+        'index': index,
+        'status': entry.status.getChar(),
+        'description': entry.status.getDescription(),
+        'path': entry.getPath(),
+        'oldPath': entry.old.path,
+        'newPath': entry.new.path,
+        'oldSha1': entry.old.sha1,
+        'newSha1': entry.new.sha1,
+        'oldMode': entry.old.mode,
+        'newMode': entry.new.mode,
+        'linesAdded': entry.linesAdded,
+        'linesRemoved': entry.linesRemoved,
+        'binary': review.isBinary(entry),
+        'generated': review.isGenerated(entry),
+        'reviewed': review.isReviewed(entry),
+    }
+
+
+def _check_params(func, args, kwargs):
+    """
+    Raise an INVALID_PARAMS RpcError if func can't be called with the
+    specified arguments.
+
+    This is checked before the call, rather than by catching the TypeError,
+    so that a TypeError raised inside the method is still reported as an
+    internal error.
+    """
+    (arg_names, varargs, varkw, defaults) = inspect.getargspec(func)
+    if inspect.ismethod(func) and func.im_self is not None:
+        arg_names = arg_names[1:]
+
+    if len(args) > len(arg_names) and varargs is None:
+        raise RpcError(INVALID_PARAMS, 'expected at most %d params, got %d' %
+                       (len(arg_names), len(args)))
+    for name in kwargs:
+        if name in arg_names[:len(args)]:
+            raise RpcError(INVALID_PARAMS,
+                           'param %r specified more than once' % (name,))
+        if name not in arg_names and varkw is None:
+            raise RpcError(INVALID_PARAMS, 'unexpected param %r' % (name,))
+
+    num_required = len(arg_names) - len(defaults or ())
+    for name in arg_names[len(args):num_required]:
+        if name not in kwargs:
+            raise RpcError(INVALID_PARAMS, 'missing param %r' % (name,))
+
+
+class _Method(object):
+    def __init__(self, func, serial):
+        # If serial is True, the method reads or modifies the review state,
+        # and is run in request order
+        self.func = func
+        self.serial = serial
+
+
+class _Worker(threading.Thread):
+    def __init__(self, work_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.workQueue = work_queue
+
+    def run(self):
+        while True:
+            job = self.workQueue.get()
+            try:
+                if job is None:
+                    return
+                job()
+            finally:
+                self.workQueue.task_done()
+
+
+class RpcServer(object):
+    def __init__(self, review, watcher=None, infile=None, outfile=None,
+                 num_threads=DEFAULT_NUM_THREADS):
+        """
+        RpcServer(review, watcher=None, infile=None, outfile=None,
+                  num_threads=DEFAULT_NUM_THREADS)
+
+        If a WorkingDirWatcher is supplied, modified files are refreshed
+        before each request that uses the review state.
+        """
+        self.review = review
+        self.watcher = watcher
+        if infile is None:
+            infile = sys.stdin
+        if outfile is None:
+            outfile = sys.stdout
+        self.infile = infile
+        self.outfile = outfile
+        self.numThreads = num_threads
+
+        self.__outputLock = threading.Lock()
+        self.__reviewLock = threading.Lock()
+        # Temporary files returned by blob.get(), by path
+        self.__tmpFiles = {}
+        self.__tmpFilesLock = threading.Lock()
+
+        self.__methods = {
+            'review.getInfo': _Method(self.__getInfo, True),
+            'review.listEntries': _Method(self.__listEntries, True),
+            'review.getCurrent': _Method(self.__getCurrent, True),
+            'review.next': _Method(self.__next, True),
+            'review.prev': _Method(self.__prev, True),
+            'review.goto': _Method(self.__goto, True),
+            'review.markReviewed': _Method(self.__markReviewed, True),
+            'review.refresh': _Method(self.__refresh, True),
+            'blob.get': _Method(self.__getBlob, False),
+            'blob.release': _Method(self.__releaseBlob, False),
+            'alias.list': _Method(self.__listAliases, True),
+            'alias.resolve': _Method(self.__resolveAlias, True),
+            'alias.set': _Method(self.__setAlias, True),
+            'alias.unset': _Method(self.__unsetAlias, True),
+        }
+
+    def run(self):
+        """
+        Serve requests until end of file on the input.  Returns once all
+        requests have been answered.
+        """
+        # Serial requests are run by a single thread, in order
+        serial_queue = Queue.Queue()
+        concurrent_queue = Queue.Queue()
+        workers = [_Worker(serial_queue)]
+        for n in range(self.numThreads):
+            workers.append(_Worker(concurrent_queue))
+        for worker in workers:
+            worker.start()
+
+        try:
+            while True:
+                line = self.infile.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                self.__handleLine(line, serial_queue, concurrent_queue)
+        finally:
+            serial_queue.put(None)
+            for n in range(self.numThreads):
+                concurrent_queue.put(None)
+            for worker in workers:
+                worker.join()
+            self.__releaseAll()
+        return 0
+
+    def __handleLine(self, line, serial_queue, concurrent_queue):
+        try:
+            request = _to_str(json.loads(line))
+        except ValueError, ex:
+            self.__writeResponse(self.__makeError(None, PARSE_ERROR,
+                                                  'parse error: %s' % (ex,)))
+            return
+
+        if isinstance(request, list):
+            # A batch.  Its requests are run one after another, and the
+            # responses are returned together.
+            if not request:
+                self.__writeResponse(self.__makeError(None, INVALID_REQUEST,
+                                                      'empty batch'))
+                return
+
+            def run_batch():
+                responses = []
+                for item in request:
+                    response = self.__runRequest(item)
+                    if response is not None:
+                        responses.append(response)
+                if responses:
+                    self.__writeResponse(responses)
+            if self.__isSerial(request):
+                serial_queue.put(run_batch)
+            else:
+                concurrent_queue.put(run_batch)
+            return
+
+        def run_one():
+            response = self.__runRequest(request)
+            if response is not None:
+                self.__writeResponse(response)
+        if self.__isSerial([request]):
+            serial_queue.put(run_one)
+        else:
+            concurrent_queue.put(run_one)
+
+    def __isSerial(self, requests):
+        for request in requests:
+            if not isinstance(request, dict):
+                continue
+            method = self.__methods.get(request.get('method'))
+            if method is not None and method.serial:
+                return True
+        return False
+
+    def __makeError(self, request_id, code, msg):
+        return {'jsonrpc': '2.0', 'id': request_id,
+                'error': {'code': code, 'message': msg}}
+
+    def __runRequest(self, request):
+        """
+        Run a single request, and return the response, or None if the
+        request is a notification.
+        """
+        if not isinstance(request, dict) or \
+                request.get('jsonrpc') != '2.0' or \
+                not isinstance(request.get('method'), str):
+            request_id = None
+            if isinstance(request, dict):
+                request_id = request.get('id')
+            return self.__makeError(request_id, INVALID_REQUEST,
+                                    'invalid request')
+
+        is_notification = not request.has_key('id')
+        request_id = request.get('id')
+        try:
+            result = self.__call(request['method'],
+                                 request.get('params', []))
+        except RpcError, ex:
+            response = self.__makeError(request_id, ex.code, str(ex))
+        except (git.GitError, proc.CmdFailedError, ReviewError,
+                IndexError), ex:
+            response = self.__makeError(request_id, APPLICATION_ERROR,
+                                        str(ex))
+        except Exception, ex:
+            response = self.__makeError(request_id, INTERNAL_ERROR,
+                                        '%s: %s' % (type(ex).__name__, ex))
+        else:
+            response = {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+        if is_notification:
+            return None
+        return response
+
+    def __call(self, method_name, params):
+        try:
+            method = self.__methods[method_name]
+        except KeyError:
+            raise RpcError(METHOD_NOT_FOUND,
+                           'unknown method %r' % (method_name,))
+
+        if isinstance(params, list):
+            args = params
+            kwargs = {}
+        elif isinstance(params, dict):
+            args = []
+            kwargs = params
+        else:
+            raise RpcError(INVALID_PARAMS, 'params must be an array or an '
+                           'object')
+        _check_params(method.func, args, kwargs)
+
+        # Refs and the index may have changed since the last request
+        self.review.repo.getBatchChecker().clearCache()
+
+        if method.serial:
+            self.__reviewLock.acquire()
+        try:
+            if method.serial and self.watcher is not None:
+                self.__applyChanges()
+            return method.func(*args, **kwargs)
+        finally:
+            if method.serial:
+                self.__reviewLock.release()
+
+    def __applyChanges(self):
+        (paths, full_refresh) = self.watcher.getChanges()
+        if full_refresh:
+            self.review.refresh()
+        elif paths:
+            self.review.refresh(paths)
+
+    def __writeResponse(self, response):
+        try:
+            data = json.dumps(response, separators=(',', ':'))
+        except UnicodeDecodeError:
+            # A path that isn't valid UTF-8.  Pass the bytes through
+            # unchanged as code points 0-255, rather than failing.
+            data = json.dumps(response, separators=(',', ':'),
+                              encoding='latin-1')
+        self.__outputLock.acquire()
+        try:
+            self.outfile.write(data + '\n')
+            self.outfile.flush()
+        finally:
+            self.__outputLock.release()
+
+    def __getInfo(self):
+        return {
+            'parent': str(self.review.diff.parent),
+            'child': str(self.review.diff.child),
+            'numEntries': self.review.getNumEntries(),
+            'currentIndex': self.review.currentIndex,
+            'numHidden': self.review.numHidden,
+            'numHiddenGenerated': self.review.numHiddenGenerated,
+        }
+
+    def __listEntries(self, start=0, count=None):
+        entries = self.review.getEntries()
+        if count is None:
+            end = len(entries)
+        else:
+            end = start + count
+        result = []
+        for index in range(max(start, 0), min(end, len(entries))):
+            result.append(_format_entry(self.review, index, entries[index]))
+        return result
+
+    def __getCurrent(self):
+        entry = self.review.getCurrentEntry()
+        return _format_entry(self.review, self.review.currentIndex, entry)
+
+    def __next(self):
+        self.review.next()
+        return self.__getCurrent()
+
+    def __prev(self):
+        self.review.prev()
+        return self.__getCurrent()
+
+    def __goto(self, index=None, path=None):
+        if path is not None:
+            index = None
+            entries = self.review.getEntries()
+            for n in range(len(entries)):
+                if entries[n].getPath() == path:
+                    index = n
+                    break
+            if index is None:
+                raise RpcError(APPLICATION_ERROR,
+                               'no file %r in the review' % (path,))
+        elif not isinstance(index, int):
+            raise RpcError(INVALID_PARAMS, 'index or path is required')
+        self.review.goto(index)
+        return self.__getCurrent()
+
+    def __markReviewed(self, index=None):
+        if index is None:
+            entry = self.review.getCurrentEntry()
+        else:
+            entry = self.review.getEntry(index)
+        self.review.markReviewed(entry)
+        return True
+
+    def __refresh(self, paths=None):
+        return self.review.refresh(paths)
+
+    def __getBlob(self, commit, path, inline=False):
+        tmp_file = self.review.getFile(commit, path)
+        if inline:
+            f = open(str(tmp_file), 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            return {'data': base64.b64encode(data), 'size': len(data)}
+
+        tmp_path = str(tmp_file)
+        if tmp_file.tmpFile is not None:
+            # Keep the TmpFile alive, so the file isn't deleted
+            self.__tmpFilesLock.acquire()
+            try:
+                self.__tmpFiles[tmp_path] = tmp_file
+            finally:
+                self.__tmpFilesLock.release()
+        return {'path': tmp_path}
+
+    def __releaseBlob(self, path):
+        self.__tmpFilesLock.acquire()
+        try:
+            tmp_file = self.__tmpFiles.pop(path, None)
+        finally:
+            self.__tmpFilesLock.release()
+        if tmp_file is None:
+            return False
+        tmp_file.tmpFile.close()
+        return True
+
+    def __releaseAll(self):
+        for tmp_file in self.__tmpFiles.itervalues():
+            tmp_file.tmpFile.close()
+        self.__tmpFiles = {}
+
+    def __listAliases(self):
+        result = {}
+        for alias in self.review.getCommitAliases():
+            result[alias] = str(self.review.expandCommitName(alias))
+        return result
+
+    def __resolveAlias(self, name):
+        return str(self.review.expandCommitName(name))
+
+    def __setAlias(self, alias, commit):
+        self.review.setCommitAlias(alias, commit)
+        return str(self.review.expandCommitName(alias))
+
+    def __unsetAlias(self, alias):
+        try:
+            self.review.unsetCommitAlias(alias)
+        except KeyError:
+            raise RpcError(APPLICATION_ERROR, 'unknown alias %r' % (alias,))
+        return True
@@ -0,0 +1,271 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+"""
+Sessions for running the external programs used to view files and diffs.
+"""
+
+import os
+import subprocess
+import tempfile
+
+import gitreview.git as git
+
+from exceptions import *
+
+# Session modes
+SESSION_PROCESS = 'process'
+SESSION_VIM_SERVER = 'vim-server'
+SESSION_MODES = (SESSION_PROCESS, SESSION_VIM_SERVER)
+
+# Programs that accept vim's command line options
+_VIM_PROGRAMS = ('vi', 'vim', 'vimdiff', 'view', 'gvim', 'gvimdiff',
+                 'gview', 'mvim')
+# The subset of those that open their own window
+_GUI_VIM_PROGRAMS = ('gvim', 'gvimdiff', 'gview', 'mvim')
+# The number of recent requests whose files a VimServerSession keeps.  vim
+# has long since read the files of older requests.
+_MAX_HELD_REQUESTS = 16
+
+
+class ViewerError(ReviewError):
+    pass
+
+
+def is_vim_command(cmd):
+    return os.path.basename(cmd[0]) in _VIM_PROGRAMS
+
+
+def _vim_quote(path):
+    # A single-quoted vim string literal
+    return "'" + str(path).replace("'", "''") + "'"
+
+
+def make_vim_script(file_lists):
+    """
+    make_vim_script(file_lists) --> script text
+
+    Generate a vim script that opens each list of files in its own tab.
+    Lists with more than one file are opened in diff mode, side by side.
+    """
+    lines = []
+    first = True
+    for files in file_lists:
+        if first:
+            open_cmd = 'edit'
+            first = False
+        else:
+            open_cmd = 'tabnew'
+        lines.append("execute '%s ' . fnameescape(%s)" %
+                     (open_cmd, _vim_quote(files[0])))
+        if len(files) > 1:
+            lines.append('diffthis')
+        for path in files[1:]:
+            lines.append("execute 'vertical diffsplit ' . fnameescape(%s)" %
+                         (_vim_quote(path),))
+    if file_lists:
+        lines.append('tabfirst')
+    return ''.join(line + '\n' for line in lines)
+
+
+def prefetch_files(review, requests):
+    """
+    prefetch_files(review, requests) --> list of TmpFile or exception
+
+    Fetch the blobs named by a list of (commit, path) tuples from the
+    repository in parallel.  Returns the files in the same order as the
+    requests.  Requests that fail produce the exception instead of a file.
+    A request of (None, '/dev/null') produces '/dev/null'.
+    """
+    # Files that were already prefetched for upcoming commands are used as
+    # they are; the rest are fetched by the review's prefetch threads
+    review.prefetchFiles(requests)
+    results = []
+    for (commit, path) in requests:
+        if commit is None:
+            results.append(path)
+            continue
+        try:
+            results.append(review.getFile(commit, path))
+        except (git.GitError, EnvironmentError), ex:
+            results.append(ex)
+    return results
+
+
+class ProcessSession(object):
+    """
+    Runs a new viewer process for each request, and waits for it to exit.
+
+    When several diffs are shown at once, vim is run once with a tab for
+    each diff.  Other programs are started in parallel, one process per
+    diff, and all of them are waited for.
+    """
+    def __init__(self, diff_cmd, view_cmd):
+        self.diffCommand = diff_cmd
+        self.viewCommand = view_cmd
+
+    def close(self):
+        pass
+
+    def hold(self, files):
+        # Each process is waited for, so the files are no longer needed
+        # once the call that showed them returns
+        pass
+
+    def __run(self, cmd):
+        try:
+            p = subprocess.Popen(cmd)
+        except OSError, ex:
+            raise ViewerError('failed to invoke %r: %s' % (cmd[0], ex))
+        return p.wait()
+
+    def view(self, path):
+        return self.__run(self.viewCommand + [str(path)])
+
+    def diff(self, files):
+        return self.__run(self.diffCommand + [str(f) for f in files])
+
+    def diffMany(self, file_lists):
+        """
+        Show several diffs at once.  file_lists is a list of lists of
+        files to diff.
+        """
+        if is_vim_command(self.diffCommand):
+            script = tempfile.NamedTemporaryFile(prefix='git-review-',
+                                                 suffix='.vim')
+            try:
+                script.write(make_vim_script(file_lists))
+                script.flush()
+                return self.__run(self.diffCommand + ['-S', script.name])
+            finally:
+                script.close()
+
+        procs = []
+        ret = 0
+        try:
+            for files in file_lists:
+                cmd = self.diffCommand + [str(f) for f in files]
+                try:
+                    procs.append(subprocess.Popen(cmd))
+                except OSError, ex:
+                    raise ViewerError('failed to invoke %r: %s' %
+                                      (cmd[0], ex))
+        finally:
+            for p in procs:
+                ret = p.wait() or ret
+        return ret
+
+
+class VimServerSession(object):
+    """
+    Shows files and diffs in a single, persistent vim instance, with a tab
+    for each request.
+
+    The first request starts vim as a server (this requires a vim built
+    with the clientserver feature, which normally means gvim).  Later
+    requests are sent to it with --remote-send, so they open immediately
+    and don't block.  If the user quits vim, the next request starts a new
+    instance.
+
+    Temporary files and scripts are kept for the last _MAX_HELD_REQUESTS
+    requests, since vim opens them asynchronously and may still be reading
+    them.  They are on disk, so they are not counted against the memory
+    budget.
+    """
+    def __init__(self, vim_cmd):
+        self.vimCommand = vim_cmd
+        self.serverName = 'GIT-REVIEW-%d' % (os.getpid(),)
+        self.__process = None
+        # The TmpFiles and scripts vim may still be using, as a list for each
+        # recent request, oldest first
+        self.__held = []
+
+    def close(self):
+        self.__held = []
+
+    def hold(self, files):
+        """
+        Keep the specified TmpFile objects, which were shown by the most
+        recent request, alive until that request is no longer one of the last
+        _MAX_HELD_REQUESTS, or the session is closed.
+        """
+        if not self.__held:
+            self.__held.append([])
+        self.__held[-1].extend(files)
+
+    def __isRunning(self):
+        # vim is run in the foreground (-f), so the server is running for
+        # as long as the process is
+        return self.__process is not None and self.__process.poll() is None
+
+    def __send(self, file_lists):
+        script = tempfile.NamedTemporaryFile(prefix='git-review-',
+                                             suffix='.vim')
+        script.write(make_vim_script(file_lists))
+        script.flush()
+        self.__held.append([script])
+        del self.__held[:-_MAX_HELD_REQUESTS]
+
+        if self.__isRunning():
+            keys = '<C-\\><C-N>:source %s<CR>' % \
+                    (script.name.replace(' ', '\\ '),)
+            cmd = self.vimCommand[:1] + ['--servername', self.serverName,
+                                         '--remote-send', keys]
+            try:
+                return subprocess.call(cmd)
+            except OSError, ex:
+                raise ViewerError('failed to invoke %r: %s' %
+                                  (cmd[0], ex))
+
+        # Start a new server.  Don't wait for it to exit.
+        cmd = self.vimCommand + ['-f', '--servername', self.serverName,
+                                 '-S', script.name]
+        try:
+            self.__process = subprocess.Popen(cmd)
+        except OSError, ex:
+            raise ViewerError('failed to invoke %r: %s' % (cmd[0], ex))
+        return 0
+
+    def view(self, path):
+        return self.__send([[path]])
+
+    def diff(self, files):
+        return self.__send([files])
+
+    def diffMany(self, file_lists):
+        return self.__send(file_lists)
+
+
+def get_session(mode, diff_cmd, view_cmd):
+    """
+    get_session(mode, diff_cmd, view_cmd) --> session
+
+    Create a viewer session.  For SESSION_VIM_SERVER, vim needs its own
+    window, since the terminal is being used by git-review.  If diff_cmd is
+    a graphical vim command it is used as-is.  Otherwise gvim is used,
+    along with the arguments from diff_cmd if it is a terminal vim command.
+    """
+    if mode == SESSION_PROCESS:
+        return ProcessSession(diff_cmd, view_cmd)
+    if mode == SESSION_VIM_SERVER:
+        if os.path.basename(diff_cmd[0]) in _GUI_VIM_PROGRAMS:
+            vim_cmd = diff_cmd
+        elif is_vim_command(diff_cmd):
+            vim_cmd = ['gvim'] + diff_cmd[1:]
+        else:
+            vim_cmd = ['gvim']
+        return VimServerSession(vim_cmd)
+    raise ViewerError('unknown viewer session mode %r' % (mode,))
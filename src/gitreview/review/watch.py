@@ -0,0 +1,210 @@
+#!/usr/bin/python -tt
+#
+# Copyright 2009-2010 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+import errno
+import os
+
+import gitreview.inotify as inotify
+
+from exceptions import *
+
+# Files in the git directory whose modification affects every diff against
+# the index or the working directory
+_GIT_DIR_FILES = ('index', 'HEAD')
+
+
+class WatchError(ReviewError):
+    pass
+
+
+class WorkingDirWatcher(object):
+    """
+    Watches the working directory for modified files, using inotify.
+
+    Every directory containing tracked files is watched, along with the git
+    directory.  getChanges() returns the paths that were modified since the
+    last call.  If the index or HEAD changed, or if the kernel dropped
+    events, the set of changed paths is unknown and a full refresh is
+    required.
+
+    Untracked files are ignored, since they don't appear in diffs against
+    the working directory.  Adding one to the index modifies the index.
+    """
+    def __init__(self, repo):
+        if not inotify.is_available():
+            raise WatchError('inotify is not available on this platform')
+        if not repo.hasWorkingDirectory():
+            raise WatchError('repository has no working directory')
+
+        self.repo = repo
+        self.workDir = repo.getWorkingDir()
+        self.gitDir = os.path.abspath(repo.getGitDir())
+
+        try:
+            self.__inotify = inotify.Inotify()
+        except inotify.InotifyError, ex:
+            raise WatchError(str(ex))
+
+        # watch descriptor --> directory path relative to the working
+        # directory, or None for the git directory
+        self.__watchDirs = {}
+        self.__watchedPaths = set()
+        self.__trackedDirs = set()
+
+        self.__changedPaths = set()
+        self.__needFullRefresh = False
+
+        try:
+            self.__addWatch(self.gitDir, None)
+            self.__loadTrackedDirs()
+            for dirname in self.__trackedDirs:
+                self.__addWatch(self.__getFullPath(dirname), dirname)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        self.__inotify.close()
+        self.__watchDirs = {}
+        self.__watchedPaths = set()
+
+    def fileno(self):
+        return self.__inotify.fileno()
+
+    def __getFullPath(self, dirname):
+        if not dirname:
+            return self.workDir
+        return os.path.join(self.workDir, dirname)
+
+    def __loadTrackedDirs(self):
+        dirs = set([''])
+        cmd = ['ls-files', '-z']
+        for path in self.repo.streamSimpleGitCmd(cmd, delimiter='\0'):
+            dirname = os.path.dirname(path)
+            # Add all parent directories too, so we notice when any of them
+            # are moved or deleted
+            while dirname not in dirs:
+                dirs.add(dirname)
+                dirname = os.path.dirname(dirname)
+        self.__trackedDirs = dirs
+
+    def __addWatch(self, full_path, dirname):
+        mask = inotify.CHANGE_EVENTS | inotify.IN_ONLYDIR | \
+                inotify.IN_DONT_FOLLOW
+        try:
+            wd = self.__inotify.addWatch(full_path, mask)
+        except inotify.InotifyError, ex:
+            err = ex.errno
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # The directory was deleted or replaced by a file.
+                # It will be watched again if it is re-created.
+                return
+            if err == errno.ENOSPC:
+                msg = ('too many directories to watch; increase '
+                       'fs.inotify.max_user_watches')
+                raise WatchError(msg)
+            raise WatchError(str(ex))
+        self.__watchDirs[wd] = dirname
+        self.__watchedPaths.add(dirname)
+
+    def __rewatch(self, dirname):
+        """
+        Watch any tracked directories at or below dirname that aren't
+        being watched.  This is called when a directory is created or moved
+        into place.
+        """
+        prefix = dirname + '/'
+        for tracked in self.__trackedDirs:
+            if tracked in self.__watchedPaths:
+                continue
+            if not dirname or tracked == dirname or \
+                    tracked.startswith(prefix):
+                self.__addWatch(self.__getFullPath(tracked), tracked)
+
+    def __processEvents(self):
+        for event in self.__inotify.readEvents():
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                self.__needFullRefresh = True
+                continue
+
+            dirname = self.__watchDirs.get(event.wd, False)
+            if event.mask & inotify.IN_IGNORED:
+                try:
+                    del self.__watchDirs[event.wd]
+                    self.__watchedPaths.discard(dirname)
+                except KeyError:
+                    pass
+                continue
+            if dirname is False:
+                # An event for a watch that has since been removed
+                continue
+
+            if dirname is None:
+                # The git directory
+                if event.name in _GIT_DIR_FILES:
+                    self.__needFullRefresh = True
+                continue
+
+            if not event.name:
+                # An event on the watched directory itself
+                if event.mask & (inotify.IN_DELETE_SELF |
+                                 inotify.IN_MOVE_SELF):
+                    # Its parent directory receives an event too, which
+                    # reports the change to the paths below it.  Stop
+                    # watching it, since our path for it is now wrong.
+                    self.__removeWatch(event.wd)
+                continue
+
+            if dirname:
+                path = dirname + '/' + event.name
+            else:
+                path = event.name
+            if path == '.git':
+                continue
+            self.__changedPaths.add(path)
+
+            if event.mask & inotify.IN_ISDIR and \
+                    event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.__rewatch(path)
+
+    def __removeWatch(self, wd):
+        dirname = self.__watchDirs.pop(wd)
+        self.__watchedPaths.discard(dirname)
+        try:
+            self.__inotify.removeWatch(wd)
+        except (inotify.InotifyError, KeyError):
+            pass
+
+    def getChanges(self):
+        """
+        watcher.getChanges() --> (paths, full_refresh)
+
+        Return the paths that have changed since the last call, relative to
+        the working directory.  Paths may name directories, in which case
+        anything below them may have changed.  If full_refresh is True, the
+        changed paths are not known, and the whole diff must be recomputed.
+        """
+        self.__processEvents()
+        paths = self.__changedPaths
+        full_refresh = self.__needFullRefresh
+        self.__changedPaths = set()
+        self.__needFullRefresh = False
+
+        if full_refresh:
+            # The set of tracked files may have changed
+            self.__loadTrackedDirs()
+            self.__rewatch('')
+        return (paths, full_refresh)